@@ -33,6 +33,27 @@ try:
 	covertS1CropsToUTM = config["Misc"].getboolean("covertS1CropsToUTM")
 	databaseTimeout = config["Misc"].getint("databaseTimeout")
 	databaseRetryQueries = config["Misc"].getint("databaseRetryQueries")
+	databaseJournalMode = config["Misc"]["databaseJournalMode"]
+	databaseSynchronous = config["Misc"]["databaseSynchronous"]
+	jobLeaseMinutes = config["Misc"].getint("jobLeaseMinutes")
+	jobMaxAttempts = config["Misc"].getint("jobMaxAttempts")
+	downloadWorkers = config["Misc"].getint("downloadWorkers")
+	copernicusMaxDownloads = config["Misc"].getint("copernicusMaxDownloads")
+	asfMaxDownloads = config["Misc"].getint("asfMaxDownloads")
+	usgsMaxDownloads = config["Misc"].getint("usgsMaxDownloads")
+	batchSearch = config["Misc"].getboolean("batchSearch")
+	searchMaxBboxDegrees = config["Misc"].getfloat("searchMaxBboxDegrees")
+	searchMaxPoisPerQuery = config["Misc"].getint("searchMaxPoisPerQuery")
+	searchCacheHours = config["Misc"].getint("searchCacheHours")
+	searchCachePermanentAfterDays = config["Misc"].getint("searchCachePermanentAfterDays")
+	localTileSearch = config["Misc"].getboolean("localTileSearch")
+	keepArchivesPacked = config["Misc"].getboolean("keepArchivesPacked")
+	streamingUnpack = config["Misc"].getboolean("streamingUnpack")
+	verifyDownloads = config["Misc"].getboolean("verifyDownloads")
+	downloadVerifyAttempts = config["Misc"].getint("downloadVerifyAttempts")
+	ltaMaxPendingRequests = config["Misc"].getint("ltaMaxPendingRequests")
+	ltaOnlineCheckBatch = config["Misc"].getint("ltaOnlineCheckBatch")
+	ltaPollMinutes = config["Misc"].getint("ltaPollMinutes")
 	coordinateDecimalsForComparison = config["Misc"].getint("coordinateDecimalsForComparison")
 	requestDelay = config["Misc"].getint("requestDelay")
 	serverFailureRequestRepeats = config["Misc"].getint("serverFailureRequestRepeats")
@@ -62,6 +83,12 @@ try:
 	# logging modes: DEBUG, INFO, WARNING, ERROR, CRITICAL
 	loggingMode = config["Logging"]["loggingMode"]
 
+	# query statistics of the database (summary at the end of the run)
+	databaseStatistics = config["Logging"].getboolean("databaseStatistics")
+
+	# queries slower than this threshold (in milliseconds) get logged, 0 disables the slow query log
+	databaseSlowQueryMs = config["Logging"].getint("databaseSlowQueryMs")
+
 
 	# copy metadata from bigTiles to croppedTiles
 	copyMetadata = config["Meta Data"].getboolean("copyMetadata")
@@ -98,6 +125,15 @@ try:
 	previewTopMarginSecondLabel = config["Combined Preview Images"].getint("previewTopMarginSecondLabel")
 	previewTopMarginThirdLabel = config["Combined Preview Images"].getint("previewTopMarginThirdLabel")
 
+	# patterns of the archive members extracted by unpack_big_tile per product type or platform (lower case keys)
+	# products without patterns are extracted completely
+	unpackFilter = {}
+	if config.has_section("Unpack Filter"):
+		for key, value in config["Unpack Filter"].items():
+			patterns = [pattern.strip() for pattern in value.split(",") if len(pattern.strip()) > 0]
+			if len(patterns) > 0:
+				unpackFilter[key.lower()] = patterns
+
 	# visual selection
 	fontScale = config["Visual Selection"].getfloat("fontScale")
 	fontColorR = config["Visual Selection"].getint("fontColorR")
@@ -0,0 +1,101 @@
+import functools
+import threading
+
+import geocropper.config as config
+
+import logging
+
+# get logger object
+logger = logging.getLogger('root')
+
+
+# max number of memoized coordinates
+cache_size = 100000
+
+
+class CountryIndex:
+    """Spatial index of the world borders shape file.
+
+    The borders are loaded once and stored as prepared geometries in an R-tree,
+    so a lookup only tests the few countries whose bounding box contains the point.
+    """
+
+    def __init__(self, shape_file):
+
+        import fiona
+        from rtree import index
+        from shapely.geometry import shape
+        from shapely.prepared import prep
+
+        self.countries = []
+        self.index = index.Index()
+
+        with fiona.open(shape_file) as borders:
+            for feature in borders:
+                if feature["geometry"] is None:
+                    continue
+                geometry = shape(feature["geometry"])
+                self.index.insert(len(self.countries), geometry.bounds)
+                self.countries.append((feature["properties"]["ISO2"], prep(geometry)))
+
+        logger.info(f"[countryIndex] {len(self.countries)} country borders loaded from {shape_file}")
+
+    def get_country(self, lat, lon):
+        """Returns the ISO2 code of the country containing the point or None."""
+
+        from shapely.geometry import Point
+
+        point = Point(lon, lat)
+        for i in self.index.intersection((lon, lat, lon, lat)):
+            iso, geometry = self.countries[i]
+            if geometry.contains(point):
+                return iso
+        return None
+
+
+# index is loaded once per process (on first lookup)
+country_index = None
+country_index_failed = False
+country_index_lock = threading.Lock()
+
+
+def get_country_index():
+
+    global country_index, country_index_failed
+
+    if country_index == None and not country_index_failed:
+        with country_index_lock:
+            if country_index == None and not country_index_failed:
+                try:
+                    country_index = CountryIndex(config.worldBordersShapeFile)
+                except Exception as e:
+                    country_index_failed = True
+                    logger.error(f"[countryIndex] Could not load world borders: {repr(e)}")
+
+    return country_index
+
+
+@functools.lru_cache(maxsize=cache_size)
+def lookup_country(lat, lon):
+    index = get_country_index()
+    if index == None:
+        return None
+    return index.get_country(lat, lon)
+
+
+def get_country(lat, lon):
+    """Returns the ISO2 code of the country for the geolocation or None if not found.
+
+    Results are memoized for repeated coordinates.
+    """
+    return lookup_country(float(lat), float(lon))
+
+
+def get_countries(lats, lons):
+    """Returns the ISO2 codes for lists of latitudes and longitudes.
+
+    Every distinct coordinate is looked up only once.
+    """
+    coordinates = [(float(lat), float(lon)) for lat, lon in zip(lats, lons)]
+    countries = {coordinate: lookup_country(*coordinate) for coordinate in set(coordinates)}
+    return [countries[coordinate] for coordinate in coordinates]
@@ -3,6 +3,7 @@ import shutil
 import os
 import pathlib
 import time
+import itertools
 
 import logging
 
@@ -10,6 +11,7 @@ import geocropper.geocropper as geocropper
 import geocropper.database as database
 import geocropper.config as config
 import geocropper.utils as utils
+import geocropper.searchPlanner as searchPlanner
 
 
 # NEEDED COLUMNS:
@@ -21,15 +23,20 @@ import geocropper.utils as utils
 
 # Note: If no width and height is specified the tiles are not going to be cropped (download only)
 
+mandatory_columns = ["groupname", "lat", "lon", "dateFrom", "dateTo", "platform"]
+
 # get logger object
 logger = logging.getLogger('root')
 
 # open database
 db = database.Database()
 
+# number of rows planned together for batched searches and country lookups
+batch_search_rows = 10000
+
 
 # import all csv files in import directory
-def import_all_csvs(delimiter=',', quotechar='"', auto_load=True):
+def import_all_csvs(delimiter=',', quotechar='"', auto_load=True, chunk_size=None):
 
     # go through all files in import directory
     for item in os.listdir(config.csvInputDir):
@@ -37,7 +44,8 @@ def import_all_csvs(delimiter=',', quotechar='"', auto_load=True):
         # if file is csv file then import content to database
         if item.endswith(".csv"):
             file_path = config.csvInputDir / item
-            importcsv(file_path = file_path, delimiter = delimiter, quotechar = quotechar, auto_load = False)
+            importcsv(file_path = file_path, delimiter = delimiter, quotechar = quotechar, auto_load = False, 
+                      chunk_size = chunk_size)
     
     # load imported csv data: call geocropper for individual records
     if auto_load:
@@ -45,28 +53,27 @@ def import_all_csvs(delimiter=',', quotechar='"', auto_load=True):
 
 
 # import specific csv file
-def importcsv(file_path, delimiter=',', quotechar='"', auto_load = True):
+# chunk_size: if set, the csv file gets parsed in chunks of rows with pandas
+def importcsv(file_path, delimiter=',', quotechar='"', auto_load = True, chunk_size = None):
     
     # cut filename out of path
     file_name = os.path.basename(file_path)
 
 
-    # open csv file
-    with open(file_path, newline='', encoding = 'utf-8-sig') as csvfile:
+    # check header for mandatory columns before anything gets imported
+    missing_columns = get_missing_columns(file_path, delimiter, quotechar)
 
-        # read content in dictionary
-        content = csv.DictReader(csvfile, delimiter = delimiter, quotechar = quotechar)
+    if len(missing_columns) > 0:
+        print(f"CSV file {file_name} not imported. Missing columns: {', '.join(missing_columns)}")
+        logger.error(f"CSV import of {file_path} aborted. Missing columns: {missing_columns}")
+        return
 
-        # import rows to database
-        counter = 0
-        for row in content:
-            db.import_csv_row(file_name, row)
-            counter += 1
 
-        logger.info("CSV import: " + str(file_path))
-        logger.info("%d rows imported into database." % counter)
+    # import all rows to database with one transaction
+    counter = db.import_csv_rows(file_name, read_csv_rows(file_path, delimiter, quotechar, chunk_size))
 
-    csvfile.close()
+    logger.info("CSV import: " + str(file_path))
+    logger.info("%d rows imported into database." % counter)
     
 
     # check for unique csv file_name in csv archive directory
@@ -108,26 +115,65 @@ def importcsv(file_path, delimiter=',', quotechar='"', auto_load = True):
         load_imported_csv_data()
 
 
+# determine mandatory columns missing in header of csv file
+def get_missing_columns(file_path, delimiter=',', quotechar='"'):
+
+    with open(file_path, newline='', encoding = 'utf-8-sig') as csvfile:
+        header = next(csv.reader(csvfile, delimiter = delimiter, quotechar = quotechar), [])
+
+    return [column for column in mandatory_columns if not column in header]
+
+
+# read rows of csv file as dictionaries
+def read_csv_rows(file_path, delimiter=',', quotechar='"', chunk_size=None):
+
+    if chunk_size == None:
+
+        with open(file_path, newline='', encoding = 'utf-8-sig') as csvfile:
+
+            # read content in dictionary
+            for row in csv.DictReader(csvfile, delimiter = delimiter, quotechar = quotechar):
+                yield row
+
+    else:
+
+        import pandas
+
+        # all values are read as strings and empty fields stay empty strings (like csv.DictReader)
+        chunks = pandas.read_csv(file_path, sep = delimiter, quotechar = quotechar, dtype = str, 
+                                 keep_default_na = False, encoding = 'utf-8-sig', chunksize = chunk_size)
+
+        for chunk in chunks:
+            for row in chunk.to_dict("records"):
+                yield row
+
+
 # load imported csv data: call geocropper for individual records
 def load_imported_csv_data(lower_boundary=None, upper_boundary=None, auto_crop=True):
 
-    # get imported and not yet loaded data
-    data = db.get_imported_csv_data()
+    # number of imported and not yet loaded rows
+    total = db.count_imported_csv_data()
 
-    if upper_boundary != None and upper_boundary > 0 and len(data) > upper_boundary:
-        data = data[0:upper_boundary]
+    if upper_boundary != None and upper_boundary > 0 and total > upper_boundary:
+        total = upper_boundary
 
+    offset = 0
     if lower_boundary != None and lower_boundary > 0:
-        if len(data) > lower_boundary:
-            data = data[lower_boundary:]
+        if total > lower_boundary:
+            offset = lower_boundary
+            total = total - lower_boundary
         else:
             print("Lower boundary higher than number of elements left")
             exit()
 
+    # rows are streamed in chunks instead of loading the whole table
+    data = itertools.islice(db.iterate_imported_csv_data(offset), total)
+
     # index i serves as a counter
     i = 0
 
-    for item in data:
+    # products: found by a batched search or None (searched individually)
+    for item, products in with_batched_search(data):
 
         i += 1
 
@@ -135,8 +181,8 @@ def load_imported_csv_data(lower_boundary=None, upper_boundary=None, auto_crop=T
         if len(item) > 0:
 
             print("\n############################################################")
-            print("\n[ Load imported data... %d/%d ]" % (i, len(data)))
-            logger.info("[ ##### Load imported data... %d/%d ##### ]" % (i, len(data)))
+            print("\n[ Load imported data... %d/%d ]" % (i, total))
+            logger.info("[ ##### Load imported data... %d/%d ##### ]" % (i, total))
             if lower_boundary != None or upper_boundary != None:
                 print(f"\n[ Boundaries: {lower_boundary}:{upper_boundary} ]")
                 logger.info(f"\n[ Boundaries: {lower_boundary}:{upper_boundary} ]")
@@ -148,13 +194,16 @@ def load_imported_csv_data(lower_boundary=None, upper_boundary=None, auto_crop=T
                     kwargs[key] = item[key]
 
             # delay requests to ommit HTTP error code 429 due to frequent requests
-            time.sleep(config.requestDelay)
+            # (not needed if the products were found by a batched search)
+            if products == None:
+                time.sleep(config.requestDelay)
 
             # download and crop with geocropper module
             geocropper.download_and_crop(item["lat"], item["lon"], groupname = item["groupname"], \
                 date_from = item["dateFrom"], date_to = item["dateTo"], platform = item["platform"], \
                 width = item["width"], height = item["height"], tile_limit = item["tileLimit"], \
-                tile_start = item["tileStart"], description = item["description"], auto_crop=auto_crop, **kwargs)
+                tile_start = item["tileStart"], description = item["description"], auto_crop=auto_crop, \
+                products = products, **kwargs)
 
 
             # move database record to archive table
@@ -171,6 +220,55 @@ def load_imported_csv_data(lower_boundary=None, upper_boundary=None, auto_crop=T
     #     print("done.\n")
     
 
-    logger.info("[ ##### Load imported data... %d/%d ...done! ##### ]" % (i, len(data)))
+    logger.info("[ ##### Load imported data... %d/%d ...done! ##### ]" % (i, total))
     if lower_boundary != None or upper_boundary != None:
         logger.info(f"\n[ Boundaries: {lower_boundary}:{upper_boundary} ]")    
+
+
+# yields the rows together with the products found by batched searches (None if not searched)
+# the searches are planned for windows of batch_search_rows rows
+def with_batched_search(data):
+
+    while True:
+
+        window = list(itertools.islice(data, batch_search_rows))
+        if len(window) == 0:
+            return
+
+        # determine the countries of the window at once (results are cached for add_poi)
+        db.get_countries([item["lat"] for item in window], [item["lon"] for item in window])
+
+        products = search_batches(window) if config.batchSearch else {}
+
+        for item in window:
+            yield item, products.get(item["rowid"])
+
+
+# search the products of several rows with batched queries
+# returns the found products per rowid, rows without entry are searched individually
+def search_batches(items):
+
+    batches = searchPlanner.plan_searches([item for item in items if searchPlanner.is_batchable(item)])
+
+    if len(batches) == 0:
+        return {}
+
+    print(f"\n[ Batched search: {len(batches)} queries for {sum(len(batch.items) for batch in batches)} rows ]")
+
+    import geocropper.sentinelWrapper as sentinelWrapper
+    sentinel = sentinelWrapper.SentinelWrapper()
+
+    products = {}
+
+    for batch in batches:
+
+        # delay requests to ommit HTTP error code 429 due to frequent requests
+        time.sleep(config.requestDelay)
+
+        try:
+            products.update(searchPlanner.search_batch(batch, sentinel))
+        except Exception as e:
+            # rows of a failed batch are searched individually
+            logger.error(f"Batched search failed ({len(batch.items)} rows): {repr(e)}")
+
+    return products
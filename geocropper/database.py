@@ -1,13 +1,20 @@
 import sqlite3
-import numpy
 import geocropper.config as config
 
 import time
-import sys
 import os
-sys.path.append(os.path.join(os.path.realpath('.'), "lib"))
+import threading
+import weakref
+import atexit
+import contextlib
+import decimal
+import hashlib
+import math
+import random
+import re
+import sys
 
-from countries import countries
+import geocropper.countryIndex as countryIndex
 
 import logging
 
@@ -51,7 +58,10 @@ tables = {
         "description":              "TEXT",
         "tilesIdentified":          "TEXT",
         "poicreated":               "TEXT",
-        "cancelled":                "TEXT"
+        "cancelled":                "TEXT",
+        "latKey":                   "INTEGER",
+        "lonKey":                   "INTEGER",
+        "paramHash":                "TEXT"
     },
 
     # table Tiles
@@ -67,7 +77,15 @@ tables = {
         "downloadComplete":         "TEXT",
         "unzipped":                 "TEXT",
         "cancelled":                "TEXT",
-        "projection":               "TEXT"
+        "projection":               "TEXT",
+        "footprint":                "TEXT",
+        "cloudCover":               "REAL",
+        "productType":              "TEXT",
+        "checksum":                 "TEXT",
+        "checksumVerified":         "TEXT",
+        "checksumFailures":         "INTEGER",
+        "offline":                  "TEXT",
+        "onlineChecked":            "TEXT"
     },
 
     # table TilesForPOIs
@@ -146,13 +164,167 @@ tables = {
         "csvImported":              "TEXT",
         "cancelled":                "TEXT",
         "csvLoaded":                "TEXT"
-    }  
+    },
+
+    # table Jobs
+    # queue of outstanding work shared by all processes using the database
+    # kind: download (targetId: Tiles.rowid) or crop (targetId: PointOfInterests.rowid)
+    # state: pending, running (leased by leaseOwner until leaseExpires), done or dead (too many failed attempts)
+    "Jobs": {
+        "kind":                     "TEXT",
+        "targetId":                 "INTEGER",
+        "state":                    "TEXT",
+        "leaseOwner":               "TEXT",
+        "leaseExpires":             "TEXT",
+        "attempts":                 "INTEGER",
+        "lastError":                "TEXT",
+        "created":                  "TEXT",
+        "updated":                  "TEXT"
+    },
+
+    # table SearchCache
+    # responses of the search APIs (pickled) keyed by the hash of the normalized query (see searchCache)
+    # expires: NULL if the response does not expire
+    "SearchCache": {
+        "queryHash":                "TEXT",
+        "query":                    "TEXT",
+        "response":                 "BLOB",
+        "created":                  "TEXT",
+        "expires":                  "TEXT"
+    }
+
+}
+
+### DB indexes
+
+indexes = {
+
+    # lookups of tile-poi connections (get_tile_for_poi, get_tile_poi_connection_id, set_tile_cropped)
+    "idxTilesForPOIsPoiTile":       "TilesForPOIs (poiId, tileId)",
+
+    # joins from Tiles to TilesForPOIs (get_pois_for_tile, get_required_tiles)
+    "idxTilesForPOIsTile":          "TilesForPOIs (tileId)",
+
+    # partial index on outstanding crops (get_uncropped_pois_for_unpacked_tiles)
+    "idxTilesForPOIsOutstanding":   "TilesForPOIs (tileId, poiId) WHERE tileCropped IS NULL AND cancelled IS NULL",
+
+    # coordinate matching in get_pois_for_coordinates and the bulk cancel/reset of crops
+    "idxPointOfInterestsCoordinateKey": "PointOfInterests (latKey, lonKey)",
+
+    # one POI per parameter combination (get_poi, add_poi)
+    "idxPointOfInterestsParamHash": "PointOfInterests (paramHash)",
+
+    # job lookups by target (enqueue_jobs) and by state (claim_job)
+    "idxJobsKindTarget":            "Jobs (kind, targetId)",
+    "idxJobsKindState":             "Jobs (kind, state)",
+
+    # one cached response per query (get_search_cache_entry, set_search_cache_entry)
+    "idxSearchCacheQueryHash":      "SearchCache (queryHash)",
+
+    # tile lookups in get_tile
+    "idxTilesProductId":            "Tiles (productId)",
+    "idxTilesFolderName":           "Tiles (folderName)"
+
+}
+
+unique_indexes = ["idxPointOfInterestsParamHash", "idxSearchCacheQueryHash"]
+
+### DB virtual tables
+
+virtual_tables = {
+
+    # R*Tree of the bounding boxes of the tile footprints (id: Tiles.rowid)
+    # used to find tiles for a point and POIs for a tile (see get_tiles_for_point and get_waiting_pois_for_tile)
+    "TileFootprints":               "rtree(id, minLon, maxLon, minLat, maxLat)"
 
 }
 
+
+def check_rtree():
+    # the rtree module is optional in sqlite builds
+    try:
+        connection = sqlite3.connect(":memory:")
+        connection.execute("CREATE VIRTUAL TABLE test USING rtree(id, minX, maxX)")
+        connection.close()
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+rtree_available = check_rtree()
+
+# version of the schema definition above
+# a changed definition (e.g. new columns or indexes) triggers the schema synchronization
+# the coordinate keys depend on coordinateDecimalsForComparison and get recomputed if it changes
+# the parameter hashes of the POIs depend on optionalSentinelParameters and get recomputed as well
+schema_hash = hashlib.sha1(repr((tables, indexes, unique_indexes, virtual_tables, rtree_available,
+                                 config.coordinateDecimalsForComparison,
+                                 config.optionalSentinelParameters)).encode("utf-8")).hexdigest()
+
+schema_version_table = "CREATE TABLE IF NOT EXISTS SchemaVersion (schemaHash TEXT, updated TEXT)"
+
+# process which already synchronized the schema
+schema_synced_pid = None
+
 # Number of Sentinel-2 scene classes
 scene_classes = 12
 
+# optional fields of csv files besides the optional sentinel parameters
+csv_optional_fields = ["width", "height", "tileLimit", "tileStart", "description"]
+
+
+# number of rows fetched at once by the iterate methods
+fetch_chunk_size = 1000
+
+# max number of query durations per method kept for percentiles
+statistics_max_samples = 10000
+
+# max number of rows and characters of query results in debug log messages
+log_result_max_rows = 3
+log_result_max_length = 1000
+
+
+### Prepared statements
+# the SQL text of these statements never changes, so sqlite3 can reuse them from its statement cache
+
+get_poi_query = "SELECT rowid, * FROM PointOfInterests WHERE paramHash = ?"
+
+add_poi_query = "INSERT INTO PointOfInterests (groupname, lat, lon, latKey, lonKey, " \
+    + "".join(f"{item}, " for item in config.optionalSentinelParameters) \
+    + "country, dateFrom, dateTo, platform, width, height, tileLimit, tileStart, description, paramHash, poicreated) \
+    VALUES (?, ?, ?, ?, ?, " + "?, " * len(config.optionalSentinelParameters) \
+    + "?, ?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now', 'localtime'))"
+
+param_hash_columns_query = "SELECT rowid, groupname, lat, lon, dateFrom, dateTo, platform, width, height, \
+    description, tileLimit, tileStart" + "".join(f", {item}" for item in config.optionalSentinelParameters) \
+    + " FROM PointOfInterests ORDER BY rowid"
+
+# targets of outstanding jobs
+job_target_queries = {
+    "download": "SELECT rowid AS targetId FROM Tiles WHERE downloadComplete IS NULL AND cancelled IS NULL",
+    "crop":     "SELECT DISTINCT TilesForPOIs.poiId AS targetId FROM TilesForPOIs INNER JOIN Tiles ON TilesForPOIs.tileId = Tiles.rowid \
+                 WHERE Tiles.unzipped IS NOT NULL AND TilesForPOIs.tileCropped IS NULL AND TilesForPOIs.cancelled IS NULL"
+}
+
+# tile-poi connections of unpacked tiles which are neither cropped nor cancelled
+outstanding_crops_from = "FROM PointOfInterests INNER JOIN TilesForPOIs ON PointOfInterests.rowid = TilesForPOIs.poiId \
+    INNER JOIN Tiles ON TilesForPOIs.tileId = Tiles.rowid \
+    WHERE Tiles.unzipped IS NOT NULL AND TilesForPOIs.tileCropped IS NULL AND TilesForPOIs.cancelled IS NULL"
+
+# POIs matching the coordinate key ranges loaded by load_coordinate_keys
+coordinate_pois_query = "SELECT DISTINCT PointOfInterests.rowid FROM PointOfInterests INNER JOIN temp.CoordinateKeys \
+    ON PointOfInterests.latKey BETWEEN CoordinateKeys.latMin AND CoordinateKeys.latMax \
+    AND PointOfInterests.lonKey BETWEEN CoordinateKeys.lonMin AND CoordinateKeys.lonMax"
+
+scene_class_ratios_query = "UPDATE TilesForPOIs SET " \
+    + ", ".join(f"sceneClass{i} = COALESCE(?, sceneClass{i})" for i in range(scene_classes)) \
+    + " WHERE rowid = ?"
+
+import_csv_row_query = "INSERT INTO CSVInput (csvFileName, groupname, lat, lon, dateFrom, dateTo, platform, " \
+    + "".join(f"{item}, " for item in config.optionalSentinelParameters + csv_optional_fields) \
+    + "csvImported) VALUES (?, ?, ?, ?, ?, ?, ?, " \
+    + "?, " * len(config.optionalSentinelParameters + csv_optional_fields) \
+    + "datetime('now', 'localtime'))"
+
 
 class DatabaseLockedError(Exception):
     """Exception raised for errors while quering the database.
@@ -164,57 +336,464 @@ class DatabaseLockedError(Exception):
         super().__init__(self.message)
 
 
+### DB connections
+
+class ThreadConnection:
+    """Connection of one thread.
+
+    The object is only referenced by the thread-local data of its thread,
+    so the connection gets closed when the thread ends.
+    """
+
+    def __init__(self, connection):
+
+        self.connection = connection
+        self.pid = os.getpid()
+        self.close = weakref.finalize(self, close_connection, connection, self.pid)
+
+
+def close_connection(connection, pid):
+
+    # connections inherited by a forked process belong to the parent process
+    if pid == os.getpid():
+        try:
+            connection.close()
+            logger.debug("[database] DB connection closed (pid:%s)", pid)
+        except sqlite3.Error as e:
+            logger.warning(f"[database] DB connection could not be closed: {repr(e)}")
+
+
+class ConnectionManager:
+    """Provides one sqlite connection per process and thread.
+
+    All Database instances of a thread share the same connection.
+    A forked worker process opens its own connection, since sqlite connections must not be shared across processes.
+    The connection of a thread is closed when the thread ends.
+    """
+
+    def __init__(self):
+
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # connections of the running threads (released with the threads)
+        self.connections = weakref.WeakSet()
+
+
+    def get_connection(self):
+
+        thread_connection = getattr(self.local, "thread_connection", None)
+
+        if thread_connection == None or thread_connection.pid != os.getpid():
+            thread_connection = ThreadConnection(self.connect())
+            with self.lock:
+                self.connections.add(thread_connection)
+            self.local.thread_connection = thread_connection
+            self.local.transaction_depth = 0
+
+        return thread_connection.connection
+
+
+    def get_transaction_depth(self):
+
+        # number of nested transaction blocks of the current thread
+        self.get_connection()
+        return self.local.transaction_depth
+
+
+    def set_transaction_depth(self, depth):
+
+        self.get_connection()
+        self.local.transaction_depth = depth
+
+
+    def connect(self):
+
+        logger.debug("[database] start DB connection")
+
+        # open or create sqlite database file
+        # the connection is only used by its thread, but it may be closed by another thread (see ThreadConnection)
+        connection = sqlite3.connect(config.dbFile, timeout=config.databaseTimeout, check_same_thread=False)
+
+        # provide index-based and case-insensitive name-based access to columns
+        connection.row_factory = sqlite3.Row
+
+        # WAL journal mode lets readers continue while another process writes
+        # synchronous=NORMAL is safe in WAL mode and avoids an fsync per commit
+        try:
+            connection.execute(f"PRAGMA journal_mode = {config.databaseJournalMode}")
+        except sqlite3.OperationalError as e:
+            logger.warning(f"[database] Could not set journal mode {config.databaseJournalMode}: {repr(e)}")
+        connection.execute(f"PRAGMA synchronous = {config.databaseSynchronous}")
+        connection.execute(f"PRAGMA busy_timeout = {config.databaseTimeout * 1000}")
+
+        # used to compute the coordinate keys of existing POIs
+        connection.create_function("coordinate_key", 1, coordinate_key)
+
+        logger.info("[database] DB connected (pid:%s thread:%s)", os.getpid(), threading.get_ident())
+
+        return connection
+
+
+    def close_all(self):
+
+        with self.lock:
+            thread_connections = list(self.connections)
+        for thread_connection in thread_connections:
+            thread_connection.close()
+
+
+connection_manager = ConnectionManager()
+atexit.register(connection_manager.close_all)
+
+
+### Logging
+
+class ResultSummary:
+    """Lazy summary of a query result for log messages.
+
+    The result is only formatted if the log message is emitted,
+    large results are truncated to a few rows.
+    """
+
+    def __init__(self, result):
+        self.result = result
+
+    def __str__(self):
+
+        result = self.result
+
+        if isinstance(result, sqlite3.Row):
+            text = repr(dict(result))
+        elif isinstance(result, list):
+            rows = [dict(row) if isinstance(row, sqlite3.Row) else row for row in result[:log_result_max_rows]]
+            text = "%d rows: %r" % (len(result), rows)
+            if len(result) > log_result_max_rows:
+                text = text[:-1] + ", ...]"
+        else:
+            text = repr(result)
+
+        if len(text) > log_result_max_length:
+            text = text[:log_result_max_length] + "..."
+
+        return text
+
+
+def summarize(result):
+    return ResultSummary(result)
+
+
+### Coordinate keys
+
+def coordinate_key(value):
+    """Returns the coordinate truncated to coordinateDecimalsForComparison decimals as integer.
+
+    e.g. 48.1234567 => 4812345 (5 decimals)
+    Coordinates are matched by these keys, which corresponds to a comparison of the truncated decimals.
+    """
+    if value == None or (isinstance(value, str) and len(value.strip()) == 0):
+        return None
+    # floats are rounded to 15 significant digits first (like their text in sqlite),
+    # so binary representation errors like 48.00028999999999 do not affect the truncation
+    if isinstance(value, float):
+        value = format(value, ".15g")
+    try:
+        return int(decimal.Decimal(str(value).strip()).scaleb(config.coordinateDecimalsForComparison) \
+            .to_integral_value(rounding=decimal.ROUND_DOWN))
+    except (decimal.InvalidOperation, ValueError, OverflowError):
+        return None
+
+
+def coordinate_key_range(value):
+    """Returns the lowest and highest key of the coordinates starting with the given value.
+
+    e.g. 48.1 => (4810000, 4819999) (5 decimals)
+    Values with fewer decimals than coordinateDecimalsForComparison match all coordinates with these leading digits
+    (like a text prefix), values with more decimals match their key only.
+    """
+    key = coordinate_key(value)
+    if key == None:
+        return None, None
+    if isinstance(value, float):
+        value = format(value, ".15g")
+    number = decimal.Decimal(str(value).strip())
+    missing_decimals = config.coordinateDecimalsForComparison + min(0, number.as_tuple().exponent)
+    if missing_decimals <= 0:
+        return key, key
+    width = 10 ** missing_decimals - 1
+    # keys are truncated towards zero, so the range of negative coordinates lies below the key
+    if number.is_signed():
+        return key - width, key
+    return key, key + width
+
+
+### Footprints
+
+def footprint_bounds(footprint):
+    """Returns the bounding box (min_lon, max_lon, min_lat, max_lat) of a WKT footprint or None."""
+    if footprint == None:
+        return None
+    numbers = [float(number) for number in re.findall(r"-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?", footprint)]
+    if len(numbers) < 2:
+        return None
+    lons = numbers[0::2]
+    lats = numbers[1::2]
+    return (min(lons), max(lons), min(lats), max(lats))
+
+
+### POI parameter hash
+
+def normalize_int(value, default=None):
+    if value == None or (isinstance(value, str) and len(value.strip()) == 0):
+        return default
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def poi_param_hash(groupname, lat, lon, date_from, date_to, platform, width, height,
+                   description="", tile_limit=0, tile_start=1, **kwargs):
+    """Returns the hash of the normalized parameters of a POI request.
+
+    Requests with the same hash lead to the same POI: unset values get their defaults
+    (e.g. tile_limit 0 and tile_start 1), numbers are compared as numbers and other values as text.
+    Keyword arguments which are not optionalSentinelParameters are ignored.
+    """
+    canonical = [
+        str(groupname),
+        repr(float(lat)),
+        repr(float(lon)),
+        None if date_from == None else str(date_from),
+        None if date_to == None else str(date_to),
+        None if platform == None else str(platform),
+        normalize_int(width),
+        normalize_int(height),
+        "" if description == None else str(description),
+        normalize_int(tile_limit, 0),
+        normalize_int(tile_start, 1)
+    ]
+    for item in config.optionalSentinelParameters:
+        value = kwargs.get(item)
+        canonical.append(None if value == None or str(value) == "" else str(value))
+    return hashlib.sha1(repr(canonical).encode("utf-8")).hexdigest()
+
+
+def csv_row_param_hash(row):
+    """Returns the parameter hash of the POI requested by a csv row."""
+    kwargs = {key: row[key] for key in config.optionalSentinelParameters if key in row}
+    return poi_param_hash(row["groupname"], row["lat"], row["lon"], row["dateFrom"], row["dateTo"], row["platform"],
+                          row.get("width"), row.get("height"), row.get("description"), row.get("tileLimit"),
+                          row.get("tileStart"), **kwargs)
+
+
+### Query statistics
+
+class QueryStatistics:
+    """Collects call counts, latencies, retries and lock waits of queries per Database method.
+
+    The statistics are shared by all Database instances and threads of a process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.methods = {}
+
+    def reset(self):
+        with self.lock:
+            self.methods = {}
+
+    def record(self, method, duration, retries=0, lock_wait=0.0):
+
+        with self.lock:
+
+            entry = self.methods.get(method)
+            if entry == None:
+                entry = {"calls": 0, "total": 0.0, "max": 0.0, "retries": 0, "lockWaits": 0, "lockWaitTime": 0.0,
+                         "samples": []}
+                self.methods[method] = entry
+
+            entry["calls"] += 1
+            entry["total"] += duration
+            entry["max"] = max(entry["max"], duration)
+            entry["retries"] += retries
+            if lock_wait > 0:
+                entry["lockWaits"] += 1
+                entry["lockWaitTime"] += lock_wait
+
+            # reservoir sampling keeps the percentiles representative with limited memory
+            samples = entry["samples"]
+            if len(samples) < statistics_max_samples:
+                samples.append(duration)
+            else:
+                i = random.randrange(entry["calls"])
+                if i < statistics_max_samples:
+                    samples[i] = duration
+
+    def summary(self):
+
+        with self.lock:
+
+            result = {}
+
+            for method, entry in self.methods.items():
+                samples = sorted(entry["samples"])
+                result[method] = {
+                    "calls":        entry["calls"],
+                    "total":        entry["total"] * 1000,
+                    "mean":         entry["total"] / entry["calls"] * 1000,
+                    "p50":          percentile(samples, 50) * 1000,
+                    "p95":          percentile(samples, 95) * 1000,
+                    "p99":          percentile(samples, 99) * 1000,
+                    "max":          entry["max"] * 1000,
+                    "retries":      entry["retries"],
+                    "lockWaits":    entry["lockWaits"],
+                    "lockWaitTime": entry["lockWaitTime"] * 1000
+                }
+
+            return result
+
+
+def percentile(sorted_values, p):
+    # nearest-rank percentile
+    if len(sorted_values) == 0:
+        return 0.0
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def is_locked_error(e):
+    return isinstance(e, sqlite3.OperationalError) and ("locked" in str(e) or "busy" in str(e))
+
+
+def log_query_statistics():
+
+    summary = query_statistics.summary()
+
+    if len(summary) == 0:
+        return
+
+    lines = ["%-45s %8s %10s %8s %8s %8s %8s %8s %7s %10s" % ("method", "calls", "total ms", "mean", "p50", "p95",
+             "p99", "max", "retries", "lock waits")]
+    for method, entry in sorted(summary.items(), key=lambda item: item[1]["total"], reverse=True):
+        lines.append("%-45s %8d %10.1f %8.2f %8.2f %8.2f %8.2f %8.2f %7d %10d" % (method, entry["calls"], entry["total"],
+                     entry["mean"], entry["p50"], entry["p95"], entry["p99"], entry["max"], entry["retries"],
+                     entry["lockWaits"]))
+
+    text = "\n".join(lines)
+    print("\nDatabase query statistics (ms):\n" + text)
+    logger.info("[database] query statistics (ms):\n%s", text)
+
+
+query_statistics = QueryStatistics()
+
+# summary at the end of the run
+if config.databaseStatistics:
+    atexit.register(log_query_statistics)
+
+
 ### DB class
 
 class Database:
 
     def __init__(self):
 
+        # cursors are kept per thread, since every thread uses its own connection
+        self.local = threading.local()
+
         self.open_connection()
 
+        global schema_synced_pid
+
+        # the schema only needs to be synchronized once per process
+        if schema_synced_pid != os.getpid():
+            self.sync_schema()
+            schema_synced_pid = os.getpid()
+
+
+    def sync_schema(self):
+
         try:
 
-            logger.debug("[database] DB: start creating new tables")
+            # skip the schema check if the database matches the current schema definition
+            self.cursor.execute(schema_version_table)
+            if self.get_schema_hash() == schema_hash:
+                logger.debug("[database] schema version up to date")
+                return
 
-            # create new tables if not existing
-            for table_name, table_content in tables.items():
+            # synchronize within one transaction, so concurrent processes do not interfere
+            with self.transaction():
 
-                elements = ""
-                for column_name, data_type in table_content.items():
-                    if elements == "":
-                        elements = "%s %s" % (column_name, data_type)
-                    else:
-                        elements = "%s, %s %s" % (elements, column_name, data_type)
+                if self.get_schema_hash() == schema_hash:
+                    return
+
+                logger.debug("[database] DB: start creating new tables")
+
+                # create new tables if not existing
+                for table_name, table_content in tables.items():
+
+                    elements = ""
+                    for column_name, data_type in table_content.items():
+                        if elements == "":
+                            elements = "%s %s" % (column_name, data_type)
+                        else:
+                            elements = "%s, %s %s" % (elements, column_name, data_type)
+
+                    query = "CREATE TABLE IF NOT EXISTS " + table_name + " (" + elements + ")"
+                    logger.debug("[database] SQL query: %s", query)
+
+                    self.cursor.execute(query)
+
+                # spatial indexes (only if sqlite supports them)
+                if rtree_available:
+                    for table_name, table_content in virtual_tables.items():
+                        self.query(f"CREATE VIRTUAL TABLE IF NOT EXISTS {table_name} USING {table_content}")
+                else:
+                    logger.warning("[database] sqlite without rtree module: tiles are not resolved locally")
 
-                query = "CREATE TABLE IF NOT EXISTS " + table_name + " (" + elements + ")"
-                logger.debug(f"[database] SQL query: {query}")
+                logger.info("[database] tables created if non existing")
 
-                self.cursor.execute(query)
 
-            # save changes to database
-            self.connection.commit()
+                # check tables for missing columns (e.g. new columns in newer versions)
+                logger.debug("[database] start checking for missing columns in DB tables")
 
-            logger.info("[database] tables created if non existing")
+                for table_name, table_content in tables.items():
 
+                    # one query per table, the columns are compared in python
+                    existing_columns = [row["name"] for row in self.fetch_all_rows_query(f"PRAGMA table_info({table_name})")]
 
-            # check tables for missing columns (e.g. new columns in newer versions)
-            logger.debug("[database] start checking for missing columns in DB tables")
+                    for column_name, data_type in table_content.items():
 
-            for table_name, table_content in tables.items():
-                
-                for column_name, data_type in table_content.items():
-                
-                    result = self.fetch_first_row_query(f"SELECT COUNT(*) AS num FROM \
-                                                        pragma_table_info('{table_name}') \
-                                                        WHERE name='{column_name}'")
-                
-                    if result == None or result["num"] == 0:
+                        if not column_name in existing_columns:
 
-                        # column is missing and needs to be appended
-                        self.query(f"ALTER TABLE {table_name} ADD {column_name} {data_type};")
-                        logger.info(f"[database] db: column {column_name} added to table {table_name}")
+                            # column is missing and needs to be appended
+                            self.query(f"ALTER TABLE {table_name} ADD {column_name} {data_type};")
+                            logger.info("[database] db: column %s added to table %s", column_name, table_name)
 
-            logger.info("[database] columns checked in DB tables")
+                logger.info("[database] columns checked in DB tables")
+
+
+                # parameter hashes of the POIs (before the unique index is created)
+                self.update_param_hashes()
+
+
+                # create indexes if not existing (after column check, since indexes may use new columns)
+                logger.debug("[database] start creating indexes")
+
+                for index_name, index_content in indexes.items():
+                    unique = "UNIQUE " if index_name in unique_indexes else ""
+                    self.query(f"CREATE {unique}INDEX IF NOT EXISTS {index_name} ON {index_content}")
+
+                logger.info("[database] indexes created if non existing")
+
+
+                # integer keys of the coordinates for indexed matching (new columns or changed decimals)
+                self.query("UPDATE PointOfInterests SET latKey = coordinate_key(lat), lonKey = coordinate_key(lon)")
+
+                # store version of synchronized schema
+                self.query("DELETE FROM SchemaVersion")
+                self.query("INSERT INTO SchemaVersion (schemaHash, updated) VALUES (?, datetime('now', 'localtime'))",
+                           (schema_hash, ))
+
+                logger.info("[database] schema version updated: %s", schema_hash)
 
         except Exception as e:
 
@@ -223,27 +802,74 @@ class Database:
             raise SystemExit              
 
 
+    def update_param_hashes(self):
+
+        # all hashes are recomputed, since the normalization may have changed
+        # of POIs with the same parameters only the oldest one keeps its hash, the others are not found anymore
+        self.query("UPDATE PointOfInterests SET paramHash = NULL")
+
+        values = []
+        hashes = set()
+        duplicates = 0
+
+        for row in self.iterate_rows_query(param_hash_columns_query):
+            kwargs = {item: row[item] for item in config.optionalSentinelParameters}
+            try:
+                param_hash = poi_param_hash(row["groupname"], row["lat"], row["lon"], row["dateFrom"], row["dateTo"],
+                                            row["platform"], row["width"], row["height"], row["description"],
+                                            row["tileLimit"], row["tileStart"], **kwargs)
+            except (TypeError, ValueError):
+                logger.warning("[database] no parameter hash for POI %s: invalid coordinates", row["rowid"])
+                continue
+            if param_hash in hashes:
+                duplicates += 1
+                continue
+            hashes.add(param_hash)
+            values.append((param_hash, row["rowid"]))
+
+        self.query_many("UPDATE PointOfInterests SET paramHash = ? WHERE rowid = ?", values)
+
+        logger.info("[database] parameter hashes updated: %s POIs, %s duplicates", len(values), duplicates)
+
+    def get_schema_hash(self):
+        result = self.fetch_first_row_query("SELECT schemaHash FROM SchemaVersion")
+        if result == None:
+            return None
+        return result["schemaHash"]
+
+
     def __del__(self):
 
         self.close_connection()
 
 
-    def open_connection(self):
+    @property
+    def connection(self):
 
-        try:
+        # connection of the current process and thread
+        return connection_manager.get_connection()
+
+
+    @property
+    def cursor(self):
 
-            logger.debug("[database] start DB connection")
+        connection = self.connection
 
-            # open or create sqlite database file
-            self.connection = sqlite3.connect(config.dbFile, timeout=config.databaseTimeout)
+        # create sqlite cursor object to execute SQL commands
+        cursor = getattr(self.local, "cursor", None)
+        if cursor == None or cursor.connection != connection:
+            cursor = connection.cursor()
+            self.local.cursor = cursor
 
-            # provide index-based and case-insensitive name-based access to columns
-            self.connection.row_factory = sqlite3.Row
+        return cursor
 
-            # create sqlite cursor object to execute SQL commands
-            self.cursor = self.connection.cursor()
 
-            logger.info("[database] DB connected")
+    def open_connection(self):
+
+        try:
+
+            # connects to the database if this thread has no connection yet
+            self.cursor
 
         except Exception as e:
 
@@ -254,7 +880,96 @@ class Database:
 
     def close_connection(self):
 
-        self.connection.close()
+        # the connection itself is shared with other Database instances and closed at exit
+        cursor = getattr(self.local, "cursor", None)
+        if cursor != None:
+            try:
+                cursor.close()
+            except sqlite3.ProgrammingError:
+                # connection already closed at exit
+                pass
+            self.local.cursor = None
+
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Runs all queries within the with-block in one transaction.
+
+        Commits of single queries are deferred to the end of the block.
+        If an exception occurs within the block, all changes get rolled back.
+        Transactions can be nested, only the outermost block commits.
+        The transaction is shared by all Database instances of the current thread.
+        """
+
+        depth = connection_manager.get_transaction_depth()
+
+        if depth == 0:
+            # finish implicitly opened transaction and acquire write lock at once
+            if self.connection.in_transaction:
+                self.connection.commit()
+            start = time.perf_counter()
+            self.connection.execute("BEGIN IMMEDIATE")
+            # the duration of BEGIN IMMEDIATE is the time spent waiting for the write lock
+            self.record_query("BEGIN IMMEDIATE", None, start, method="transaction")
+
+        connection_manager.set_transaction_depth(depth + 1)
+
+        try:
+            yield self
+        except BaseException:
+            connection_manager.set_transaction_depth(depth)
+            if depth == 0:
+                self.connection.rollback()
+                logger.warning("[database] transaction rolled back")
+            raise
+        else:
+            connection_manager.set_transaction_depth(depth)
+            if depth == 0:
+                self.connection.commit()
+
+
+    def in_transaction(self):
+        return connection_manager.get_transaction_depth() > 0
+
+
+    @property
+    def row_count(self):
+
+        # number of rows changed by the last query or query_many of the current thread
+        return getattr(self.local, "row_count", -1)
+
+
+    ### STATISTICS ###
+
+    def record_query(self, query, values, start, retries=0, lock_wait=0.0, method=None):
+
+        duration = time.perf_counter() - start
+        slow_query = config.databaseSlowQueryMs > 0 and duration * 1000 >= config.databaseSlowQueryMs
+
+        if not config.databaseStatistics and not slow_query:
+            return
+
+        # name of the Database method (or function) which issued the query
+        if method == None:
+            method = sys._getframe(2).f_code.co_name
+
+        if config.databaseStatistics:
+            query_statistics.record(method, duration, retries, lock_wait)
+
+        if slow_query:
+            logger.warning("[database] slow query in %s (%.1f ms, retries: %d): [%s] [values: %s]",
+                           method, duration * 1000, retries, query, values)
+
+    def stats(self):
+        """Returns the query statistics of the current process per Database method.
+
+        Statistics are only collected if databaseStatistics is enabled in the config.
+        Times are given in milliseconds.
+        """
+        return query_statistics.summary()
+
+    def reset_stats(self):
+        query_statistics.reset()
 
 
     ### QUERIES ###
@@ -262,42 +977,63 @@ class Database:
     # query function used for inserts and updates
     def query(self, query, values=None):
 
+        # skip building debug messages for every query if debug logging is disabled
+        debug_logging = logger.isEnabledFor(logging.DEBUG)
+
         try:
 
             attempt = 0
             query_done = False
+            lock_wait = 0.0
+            start = time.perf_counter()
 
             while attempt < config.databaseRetryQueries and not query_done:
 
                 try:
 
                     attempt = attempt + 1
+                    attempt_start = time.perf_counter()
 
-                    logger.debug(f"[database] DB query: [{query}] [values: {values}]")
+                    if debug_logging:
+                        logger.debug("[database] DB query: [%s] [values: %s]", query, values)
                     
                     if values == None:
                         self.cursor.execute(query)
                     else:
                         self.cursor.execute(query, values)
+                    self.local.row_count = self.cursor.rowcount
                     
-                    # save changes
-                    self.connection.commit()
+                    # save changes (deferred to the end of an open transaction block)
+                    if not self.in_transaction():
+                        self.connection.commit()
                     new_id = self.cursor.lastrowid
                     
                     query_done = True
 
-                    logger.debug(f"[database] DB query: new_id: {new_id}")
+                    if debug_logging:
+                        logger.debug("[database] DB query: new_id: %s", new_id)
 
                 except Exception as e:
 
+                    # same rule as in query_many: no retries within an open transaction block
+                    # (the block gets rolled back as a whole by its owner)
+                    if self.in_transaction():
+                        raise
+                    self.connection.rollback()
                     logger.warning(f"[database] Could not query database. \
                         Attempt:{attempt} Error: {repr(e)}")
                     time.sleep(5)
 
+                    # time spent waiting for a locked database
+                    if is_locked_error(e):
+                        lock_wait += time.perf_counter() - attempt_start
+
             if not query_done:
 
                 raise DatabaseLockedError()
 
+            self.record_query(query, values, start, attempt - 1, lock_wait)
+
         except Exception as e:
 
             print(str(e))
@@ -306,21 +1042,93 @@ class Database:
 
         return new_id
 
+    # query function used for bulk inserts and updates (one transaction for all rows)
+    def query_many(self, query, values_list):
+
+        # skip building debug messages for every query if debug logging is disabled
+        debug_logging = logger.isEnabledFor(logging.DEBUG)
+
+        try:
+
+            attempt = 0
+            query_done = False
+            lock_wait = 0.0
+            start = time.perf_counter()
+
+            while attempt < config.databaseRetryQueries and not query_done:
+
+                try:
+
+                    attempt = attempt + 1
+                    attempt_start = time.perf_counter()
+
+                    if debug_logging:
+                        logger.debug("[database] DB query many: [%s] [rows: %s]", query, len(values_list))
+
+                    self.cursor.executemany(query, values_list)
+                    row_count = self.cursor.rowcount
+                    self.local.row_count = row_count
+
+                    # save changes (deferred to the end of an open transaction block)
+                    if not self.in_transaction():
+                        self.connection.commit()
+
+                    query_done = True
+
+                    if debug_logging:
+                        logger.debug("[database] DB query many: rows affected: %s", row_count)
+
+                except Exception as e:
+
+                    # discard partially executed rows before the next attempt
+                    # (an open transaction block gets rolled back as a whole by its owner)
+                    if self.in_transaction():
+                        raise
+                    self.connection.rollback()
+                    logger.warning(f"[database] Could not query database. \
+                        Attempt:{attempt} Error: {repr(e)}")
+                    time.sleep(5)
+
+                    # time spent waiting for a locked database
+                    if is_locked_error(e):
+                        lock_wait += time.perf_counter() - attempt_start
+
+            if not query_done:
+
+                raise DatabaseLockedError()
+
+            self.record_query(query, "%d rows" % len(values_list), start, attempt - 1, lock_wait)
+
+        except Exception as e:
+
+            print(str(e))
+            logger.critical(f"Error in query many [{query}]: {repr(e)}") 
+            raise SystemExit
+
+        return row_count
+
     # query function used for selects returning all rows of result
     def fetch_all_rows_query(self, query, values=None):
         
+        # skip building debug messages for every query if debug logging is disabled
+        debug_logging = logger.isEnabledFor(logging.DEBUG)
+
         try:
 
             attempt = 0
             query_done = False
+            lock_wait = 0.0
+            start = time.perf_counter()
 
             while attempt < config.databaseRetryQueries and not query_done:
 
                 try:
 
                     attempt = attempt + 1
+                    attempt_start = time.perf_counter()
 
-                    logger.debug(f"[database] DB query: [{query}] [values: {values}]")
+                    if debug_logging:
+                        logger.debug("[database] DB query: [%s] [values: %s]", query, values)
 
                     if values == None:
                         self.cursor.execute(query)
@@ -331,18 +1139,25 @@ class Database:
 
                     query_done = True
 
-                    logger.debug(f"[database] DB query: result: {result}")
+                    if debug_logging:
+                        logger.debug("[database] DB query: result: %s", summarize(result))
 
                 except Exception as e:
 
                     logger.warning(f"[database] Could not query database. \
                         Attempt:{attempt} Error: {repr(e)}")
-                    time.sleep(5)   
+                    time.sleep(5)
+
+                    # time spent waiting for a locked database
+                    if is_locked_error(e):
+                        lock_wait += time.perf_counter() - attempt_start
 
             if not query_done:
 
                 raise DatabaseLockedError()                                     
 
+            self.record_query(query, values, start, attempt - 1, lock_wait)
+
         except Exception as e:
 
             print(str(e))
@@ -351,21 +1166,90 @@ class Database:
 
         return result
 
+    # generator used for selects with large results: the rows are fetched in chunks, so memory stays flat
+    # a separate cursor is used, so other queries can run while iterating
+    def iterate_rows_query(self, query, values=None, chunk_size=fetch_chunk_size):
+
+        debug_logging = logger.isEnabledFor(logging.DEBUG)
+
+        cursor = self.connection.cursor()
+
+        try:
+
+            attempt = 0
+            query_done = False
+            lock_wait = 0.0
+            start = time.perf_counter()
+
+            while attempt < config.databaseRetryQueries and not query_done:
+
+                try:
+
+                    attempt = attempt + 1
+                    attempt_start = time.perf_counter()
+
+                    if debug_logging:
+                        logger.debug("[database] DB query iterate: [%s] [values: %s]", query, values)
+
+                    if values == None:
+                        cursor.execute(query)
+                    else:
+                        cursor.execute(query, values)
+
+                    query_done = True
+
+                except Exception as e:
+
+                    logger.warning(f"[database] Could not query database. \
+                        Attempt:{attempt} Error: {repr(e)}")
+                    time.sleep(5)
+
+                    # time spent waiting for a locked database
+                    if is_locked_error(e):
+                        lock_wait += time.perf_counter() - attempt_start
+
+            if not query_done:
+
+                raise DatabaseLockedError()
+
+            self.record_query(query, values, start, attempt - 1, lock_wait)
+
+        except Exception as e:
+
+            print(str(e))
+            logger.error(f"Error in query [{query}] [values: {values}]: {repr(e)}") 
+            raise SystemExit
+
+        try:
+            rows = cursor.fetchmany(chunk_size)
+            while len(rows) > 0:
+                yield from rows
+                rows = cursor.fetchmany(chunk_size)
+        finally:
+            cursor.close()
+
     # query function used for selects returning only first row of result
     def fetch_first_row_query(self, query, values=None):
         
+        # skip building debug messages for every query if debug logging is disabled
+        debug_logging = logger.isEnabledFor(logging.DEBUG)
+
         try:
 
             attempt = 0
             query_done = False
+            lock_wait = 0.0
+            start = time.perf_counter()
 
             while attempt < config.databaseRetryQueries and not query_done:
 
                 try:
 
                     attempt = attempt + 1
+                    attempt_start = time.perf_counter()
 
-                    logger.debug(f"[database] DB query: [{query}] [values: {values}]")
+                    if debug_logging:
+                        logger.debug("[database] DB query: [%s] [values: %s]", query, values)
 
                     if values == None:
                         self.cursor.execute(query)
@@ -376,18 +1260,25 @@ class Database:
 
                     query_done = True
 
-                    logger.debug(f"[database] DB query: result: {result}")
+                    if debug_logging:
+                        logger.debug("[database] DB query: result: %s", summarize(result))
 
                 except Exception as e:
 
                     logger.warning(f"[database] Could not query database. \
                         Attempt:{attempt} Error: {repr(e)}")
-                    time.sleep(5)    
+                    time.sleep(5)
+
+                    # time spent waiting for a locked database
+                    if is_locked_error(e):
+                        lock_wait += time.perf_counter() - attempt_start
                     
             if not query_done:
 
                 raise DatabaseLockedError()                                       
 
+            self.record_query(query, values, start, attempt - 1, lock_wait)
+
         except Exception as e:
 
             print(str(e))
@@ -400,127 +1291,238 @@ class Database:
     ### TILES ###
 
     def get_all_tiles(self):
-        logger.debug(f"[database] get_all_tiles")
+        logger.debug("[database] get_all_tiles")
         result = self.fetch_all_rows_query("SELECT rowid, * FROM Tiles")
-        logger.debug(f"[database] get_all_tiles: all tiles fetched.")
+        logger.debug("[database] get_all_tiles: all tiles fetched.")
         return result   
 
 
+    def iterate_all_tiles(self):
+        logger.debug("[database] iterate_all_tiles")
+        return self.iterate_rows_query("SELECT rowid, * FROM Tiles")
+
     def get_required_tiles(self):
-        logger.debug(f"[database] get_required_tiles")
+        logger.debug("[database] get_required_tiles")
         result = self.fetch_all_rows_query("SELECT Tiles.rowid, Tiles.* FROM Tiles \
             INNER JOIN TilesForPOIs ON Tiles.rowid = TilesForPOIs.tileId \
             WHERE TilesForPOIs.tileCropped IS NULL AND TilesForPOIs.cancelled IS NULL \
             GROUP BY Tiles.rowid")
-        logger.debug(f"[database] get_required_tiles: all required tiles fetched.")
+        logger.debug("[database] get_required_tiles: all required tiles fetched.")
         return result         
         
         
     def get_tile(self, product_id = None, folder_name = None):
 
-        logger.debug(f"[database] get tile for product_id: {product_id} folder_name: {folder_name}")
+        logger.debug("[database] get tile for product_id: %s folder_name: %s", product_id, folder_name)
 
         if not product_id == None and not folder_name == None:
-            qresult = self.fetch_first_row_query(f"SELECT rowid, * FROM Tiles WHERE \
-                                                 productId = '{product_id}' \
-                                                 AND folderName = '{folder_name}'")
+            qresult = self.fetch_first_row_query("SELECT rowid, * FROM Tiles WHERE \
+                                                 productId = ? AND folderName = ?",
+                                                 (product_id, folder_name))
         else:
             if not product_id == None:
-                qresult = self.fetch_first_row_query(f"SELECT rowid, * FROM Tiles WHERE \
-                                                     productId = '{product_id}'")
+                qresult = self.fetch_first_row_query("SELECT rowid, * FROM Tiles WHERE productId = ?",
+                                                     (product_id, ))
             if not folder_name == None:
-                qresult = self.fetch_first_row_query(f"SELECT rowid, * FROM Tiles WHERE \
-                                                     folderName = '{folder_name}'")            
+                qresult = self.fetch_first_row_query("SELECT rowid, * FROM Tiles WHERE folderName = ?",
+                                                     (folder_name, ))
 
-        logger.debug(f"[database] get tile result: {qresult}")
+        logger.debug("[database] get tile result: %s", summarize(qresult))
 
         return qresult
 
 
     def get_tile_by_rowid(self, row_id):
-        logger.debug(f"[database] get_tile_by_rowid: {row_id}")
-        result = self.fetch_first_row_query(f"SELECT rowid, * FROM tiles WHERE rowid = {row_id}")
-        logger.debug(f"[database] get_tile_by_rowid result: {repr(result)}")
+        logger.debug("[database] get_tile_by_rowid: %s", row_id)
+        result = self.fetch_first_row_query("SELECT rowid, * FROM tiles WHERE rowid = ?", (row_id, ))
+        logger.debug("[database] get_tile_by_rowid result: %s", summarize(result))
         return result
 
         
     def add_tile(self, platform, product_id, beginposition, endposition, folder_name = ""):
-        logger.debug(f"[database] add_tile: platform:{platform} product_id:{product_id} \
-                     beginposition:{beginposition} endposition:{endposition}")
+        logger.debug("[database] add_tile: platform:%s product_id:%s beginposition:%s endposition:%s",
+                     platform, product_id, beginposition, endposition)
         newId = self.query("INSERT INTO Tiles (platform, folderName, productId, \
             beginposition, endposition, firstDownloadRequest) \
             VALUES (?, ?, ?, ?, ?, datetime('now', 'localtime'))", 
             (platform, folder_name, product_id, beginposition, endposition))
-        logger.info(f"[database] new tile inserted into database: [{newId}] {platform} {product_id}")
+        logger.info("[database] new tile inserted into database: [%s] %s %s", newId, platform, product_id)
         return newId
 
+    def set_tile_footprint(self, tile_id, footprint, cloud_cover=None, product_type=None):
+        logger.debug("[database] set_tile_footprint %s", tile_id)
+        bounds = footprint_bounds(footprint)
+        with self.transaction():
+            self.query("UPDATE Tiles SET footprint = ?, cloudCover = ?, productType = ? WHERE rowid = ?",
+                       (footprint, cloud_cover, product_type, tile_id))
+            if rtree_available and bounds != None:
+                self.query("INSERT OR REPLACE INTO TileFootprints (id, minLon, maxLon, minLat, maxLat) \
+                    VALUES (?, ?, ?, ?, ?)", (tile_id, ) + bounds)
+        logger.info("[database] tile footprint stored: %s %s", tile_id, bounds)
+
+    def get_tiles_for_point(self, lat, lon, platform, date_from, date_to):
+        # tiles whose footprint bounding box contains the point and whose sensing date is within the date range
+        # dates in format %Y-%m-%d
+        logger.debug("[database] get_tiles_for_point %s %s %s %s %s", lat, lon, platform, date_from, date_to)
+        if not rtree_available:
+            return []
+        result = self.fetch_all_rows_query("SELECT Tiles.rowid, Tiles.* FROM TileFootprints \
+            INNER JOIN Tiles ON Tiles.rowid = TileFootprints.id \
+            WHERE TileFootprints.minLon <= ? AND TileFootprints.maxLon >= ? \
+            AND TileFootprints.minLat <= ? AND TileFootprints.maxLat >= ? \
+            AND Tiles.platform = ? AND Tiles.cancelled IS NULL \
+            AND date(Tiles.beginposition) BETWEEN date(?) AND date(?) \
+            ORDER BY Tiles.beginposition", (lon, lon, lat, lat, platform, date_from, date_to))
+        logger.debug("[database] get_tiles_for_point result: %s", summarize(result))
+        return result
+
+    def get_waiting_pois_for_tile(self, tile_id):
+        # POIs without tile limit whose point lies in the footprint bounding box of the tile
+        # and whose date range contains the sensing date of the tile, if not connected to the tile yet
+        # the coordinate keys of the bounding box let the query use the coordinate index
+        logger.debug("[database] get_waiting_pois_for_tile %s", tile_id)
+        if not rtree_available:
+            return []
+        result = self.fetch_all_rows_query("SELECT PointOfInterests.rowid, PointOfInterests.* FROM TileFootprints \
+            INNER JOIN Tiles ON Tiles.rowid = TileFootprints.id \
+            INNER JOIN PointOfInterests ON PointOfInterests.platform = Tiles.platform \
+            AND PointOfInterests.latKey BETWEEN coordinate_key(TileFootprints.minLat) \
+                AND coordinate_key(TileFootprints.maxLat) \
+            AND PointOfInterests.lat BETWEEN TileFootprints.minLat AND TileFootprints.maxLat \
+            AND PointOfInterests.lon BETWEEN TileFootprints.minLon AND TileFootprints.maxLon \
+            AND date(Tiles.beginposition) BETWEEN date(PointOfInterests.dateFrom) AND date(PointOfInterests.dateTo) \
+            WHERE TileFootprints.id = ? AND PointOfInterests.cancelled IS NULL \
+            AND (PointOfInterests.tileLimit IS NULL OR PointOfInterests.tileLimit = 0) \
+            AND NOT EXISTS (SELECT 1 FROM TilesForPOIs WHERE TilesForPOIs.poiId = PointOfInterests.rowid \
+                AND TilesForPOIs.tileId = Tiles.rowid)", (tile_id, ))
+        logger.debug("[database] get_waiting_pois_for_tile result: %s", summarize(result))
+        return result
+
     def get_requested_tiles(self):
         logger.debug("[database] get_requested_tiles")
         result = self.fetch_all_rows_query("SELECT rowid, * FROM Tiles WHERE \
             downloadComplete IS NULL AND cancelled IS NULL ")
-        logger.debug(f"[database] get_requested_tiles: {repr(result)}")
+        logger.debug("[database] get_requested_tiles: %s", summarize(result))
         return result
         
     def set_unpacked_for_tile(self, rowid):
-        logger.debug(f"[database] set_unpacked_for_tile {rowid}")
+        logger.debug("[database] set_unpacked_for_tile %s", rowid)
         self.query("UPDATE Tiles SET unzipped = datetime('now', 'localtime') \
-            WHERE rowid = %d" % rowid)
-        logger.debug(f"[database] tile updated in database (unzipped): {rowid}")
+            WHERE rowid = ?", (rowid, ))
+        logger.debug("[database] tile updated in database (unzipped): %s", rowid)
      
     def set_last_download_request_for_tile(self, rowid):
-        logger.debug(f"[database] set_last_download_request_for_tile {rowid}")
+        logger.debug("[database] set_last_download_request_for_tile %s", rowid)
         self.query("UPDATE Tiles SET lastDownloadRequest = datetime('now', 'localtime') \
-            WHERE rowid = %d" % rowid)
-        logger.debug(f"[database] tile updated in database (lastDownloadRequest): {rowid}")
+            WHERE rowid = ?", (rowid, ))
+        logger.debug("[database] tile updated in database (lastDownloadRequest): %s", rowid)
         
     def set_download_complete_for_tile(self, rowid):
-        logger.debug(f"[database] set_download_complete_for_tile {rowid}")
+        logger.debug("[database] set_download_complete_for_tile %s", rowid)
         self.query("UPDATE Tiles SET downloadComplete = datetime('now', 'localtime') \
-            WHERE rowid = %d" % rowid)
-        logger.info(f"[database] tile updated in database (downloadComplete): {rowid}")
+            WHERE rowid = ?", (rowid, ))
+        logger.info("[database] tile updated in database (downloadComplete): %s", rowid)
 
     def clear_download_complete_for_tile(self, rowid):
-        logger.debug(f"[database] clear_download_complete_for_tile {rowid}")
-        self.query("UPDATE Tiles SET downloadComplete = null WHERE rowid = %d" % rowid)
-        logger.info(f"[database] tile updated in database (downloadComplete cleared): {rowid}")        
+        logger.debug("[database] clear_download_complete_for_tile %s", rowid)
+        self.query("UPDATE Tiles SET downloadComplete = null WHERE rowid = ?", (rowid, ))
+        logger.info("[database] tile updated in database (downloadComplete cleared): %s", rowid)        
 
     def clear_last_download_request_for_tile(self, rowid):
-        logger.debug(f"[database] clear_last_download_request_for_tile {rowid}")
-        self.query("UPDATE Tiles SET lastDownloadRequest = NULL WHERE rowid = %d" % rowid)
-        logger.info(f"[database] tile updated in database \
-            (lastDownloadRequest cleared due to failed request): {rowid}")
+        logger.debug("[database] clear_last_download_request_for_tile %s", rowid)
+        self.query("UPDATE Tiles SET lastDownloadRequest = NULL WHERE rowid = ?", (rowid, ))
+        logger.info("[database] tile updated in database (lastDownloadRequest cleared due to failed request): %s",
+                    rowid)
 
     def clear_unpacked_for_tile(self, rowid):
-        logger.debug(f"[database] clear_unpacked_for_tile {rowid}")
-        self.query("UPDATE Tiles SET unzipped = NULL WHERE rowid = %d" % rowid)
-        logger.debug(f"[database] tile updated in database (unzipped cleared): {rowid}")
+        logger.debug("[database] clear_unpacked_for_tile %s", rowid)
+        self.query("UPDATE Tiles SET unzipped = NULL WHERE rowid = ?", (rowid, ))
+        logger.debug("[database] tile updated in database (unzipped cleared): %s", rowid)
+
+    def set_tile_checksum(self, rowid, checksum, verified=True):
+        # MD5 checksum of the downloaded archive, verified is False if there is no checksum to compare with
+        logger.debug("[database] set_tile_checksum %s", rowid)
+        if verified:
+            self.query("UPDATE Tiles SET checksum = ?, checksumVerified = datetime('now', 'localtime'), \
+                checksumFailures = 0 WHERE rowid = ?", (checksum, rowid))
+        else:
+            self.query("UPDATE Tiles SET checksum = ?, checksumVerified = NULL WHERE rowid = ?", (checksum, rowid))
+        logger.info("[database] tile updated in database (checksum %s, verified: %s): %s", checksum, verified, rowid)
+
+    def set_tile_checksum_failed(self, rowid, checksum):
+        # corrupt download: the tile gets downloaded again
+        logger.debug("[database] set_tile_checksum_failed %s", rowid)
+        with self.transaction():
+            self.query("UPDATE Tiles SET checksum = ?, checksumVerified = NULL, \
+                checksumFailures = IFNULL(checksumFailures, 0) + 1 WHERE rowid = ?", (checksum, rowid))
+            self.reset_tile_for_download(rowid)
+        logger.info("[database] tile updated in database (checksum mismatch %s): %s", checksum, rowid)
+
+    def reset_tile_for_download(self, rowid):
+        logger.debug("[database] reset_tile_for_download %s", rowid)
+        with self.transaction():
+            self.clear_download_complete_for_tile(rowid)
+            self.clear_unpacked_for_tile(rowid)
 
     def set_cancelled_tile(self, rowid):
-        logger.debug(f"[database] set_cancelled_tile {rowid}")
+        logger.debug("[database] set_cancelled_tile %s", rowid)
         self.query("UPDATE Tiles SET cancelled = datetime('now', 'localtime') \
-            WHERE rowid = %d" % rowid)
-        logger.info(f"[database] tile updated in database (cancelled): {rowid}")  
+            WHERE rowid = ?", (rowid, ))
+        logger.info("[database] tile updated in database (cancelled): %s", rowid)  
+
+    ### OFFLINE PRODUCTS (long term archive) ###
+
+    def get_retrieval_queue(self):
+        # Sentinel tiles which are not yet downloaded, tiles which were not checked for the longest time first
+        logger.debug("[database] get_retrieval_queue")
+        result = self.fetch_all_rows_query("SELECT rowid, * FROM Tiles WHERE downloadComplete IS NULL \
+            AND cancelled IS NULL AND platform LIKE 'Sentinel%' \
+            ORDER BY onlineChecked IS NOT NULL, onlineChecked, rowid")
+        logger.debug("[database] get_retrieval_queue result: %s", summarize(result))
+        return result
+
+    def set_tile_offline(self, rowid):
+        logger.debug("[database] set_tile_offline %s", rowid)
+        self.query("UPDATE Tiles SET offline = COALESCE(offline, datetime('now', 'localtime')), \
+            onlineChecked = datetime('now', 'localtime') WHERE rowid = ?", (rowid, ))
+        logger.debug("[database] tile updated in database (offline): %s", rowid)
+
+    def set_tile_online(self, rowid):
+        logger.debug("[database] set_tile_online %s", rowid)
+        self.query("UPDATE Tiles SET offline = NULL, onlineChecked = datetime('now', 'localtime') \
+            WHERE rowid = ?", (rowid, ))
+        logger.debug("[database] tile updated in database (online): %s", rowid)
+
+    def count_pending_retrievals(self):
+        # offline tiles requested within copernicusRepeatRequestAfterMin which are not yet downloaded
+        logger.debug("[database] count_pending_retrievals")
+        result = self.fetch_first_row_query("SELECT COUNT(*) AS num FROM Tiles WHERE offline IS NOT NULL \
+            AND downloadComplete IS NULL AND cancelled IS NULL \
+            AND lastDownloadRequest >= datetime('now', 'localtime', ?)", 
+            (f"-{config.copernicusRepeatRequestAfterMin} minutes", ))
+        logger.debug("[database] count_pending_retrievals result: %s", summarize(result))
+        return result["num"]
 
     def get_latest_download_request(self):
         logger.debug("[database] get_latest_download_request")
         result = self.fetch_first_row_query("SELECT MAX(lastDownloadRequest) as latest FROM Tiles \
             WHERE downloadComplete IS NULL")
-        logger.debug(f"[database] latest download request: {result}")
+        logger.debug("[database] latest download request: %s", summarize(result))
         if result == None:
             return None
         else:
             return result["latest"]
 
     def update_tile_projection(self, rowid, projection):
-        logger.debug(f"[database] update_tile_projection {rowid} {projection}")
-        self.query("UPDATE Tiles SET projection = '%s' WHERE rowid = %d" % (projection, rowid))
-        logger.debug(f"[database] projection updated for tile {rowid} [{projection}] ")
+        logger.debug("[database] update_tile_projection %s %s", rowid, projection)
+        self.query("UPDATE Tiles SET projection = ? WHERE rowid = ?", (projection, rowid))
+        logger.debug("[database] projection updated for tile %s [%s] ", rowid, projection)
 
     def get_tiles_without_projection_info(self):
-        logger.debug(f"[database] get_tiles_without_projection_info")
+        logger.debug("[database] get_tiles_without_projection_info")
         result = self.fetch_all_rows_query("SELECT rowid, * FROM Tiles WHERE \
             projection IS NULL AND downloadComplete IS NOT NULL")
-        logger.debug(f"[database] tiles without projection info: {result}")
+        logger.debug("[database] tiles without projection info: %s", summarize(result))
         return result
 
 
@@ -529,53 +1531,19 @@ class Database:
     def get_poi(self, groupname, lat, lon, date_from, date_to, platform, width, height, 
                 description = "", tile_limit = 0, tile_start = 1, **kwargs):
 
-        logger.debug(f"[database] get_poi {groupname}, {lat}, {lon}, {date_from}, {date_to}, \
-                     {platform}, {width}, {height}, {description}, {tile_limit}, {tile_start}, {repr(kwargs)}")
+        logger.debug("[database] get_poi %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %r", groupname, lat, lon, date_from,
+                     date_to, platform, width, height, description, tile_limit, tile_start, kwargs)
 
         # TODO: if not checked yet, lat and lon are mandatory for any import, so it is not checked here, 
         #       because in this case we want an error to be thrown
-        query = "SELECT rowid, * FROM PointOfInterests WHERE groupname = '" + str(groupname) \
-            + "' AND lat = " + str(lat) + " AND lon = " + str(lon) + " AND dateFrom = '" + str(date_from) + "'" \
-            + " AND dateTo = '" + date_to + "' AND platform = '" + platform + "' AND description = '" + str(description) + "'"
-
-        if not (width == None) and isinstance(width, int):
-            query = "%s AND width = %d" % (query, width)
-        else:
-            query = query + " AND width IS NULL"
-
-        if not (height == None) and isinstance(height, int):
-            query = "%s AND height = %d" % (query, height)
-        else:
-            query = query + " AND height IS NULL"
-
-        if not (tile_limit == None) and isinstance(tile_limit, int):
-            query = "%s AND tileLimit = %d" % (query, tile_limit)
-        else:
-            query = query + " AND tileLimit IS NULL"
-
-        if not (tile_start == None) and tile_start > 1:
-            query = query + " AND tileStart = " + str(tile_start)
-        else:
-            query = query + " AND tileStart IS NULL"
-
-        used_keys = []
-
-        for key, value in kwargs.items():
-            if key in config.optionalSentinelParameters:
-                query = "%s AND %s = '%s'" % (query, key, value)
-                used_keys.append(key)
-
-        # check for unused keys
+        # the hash covers all parameters including unused optional ones,
         # this is important to prevent fetching of different POIs with further arguments 
-        for item in config.optionalSentinelParameters:
-            if not ( item in used_keys ):
-                query = "%s AND %s IS NULL" % (query, item)
-
-        logger.debug(f"[database] get_poi query: {query}")
+        param_hash = poi_param_hash(groupname, lat, lon, date_from, date_to, platform, width, height,
+                                    description, tile_limit, tile_start, **kwargs)
 
-        qresult = self.fetch_first_row_query(query)
+        qresult = self.fetch_first_row_query(get_poi_query, (param_hash, ))
 
-        logger.debug(f"[database] get_poi result: {repr(qresult)}")
+        logger.debug("[database] get_poi result: %s", summarize(qresult))
 
         return qresult
         
@@ -587,234 +1555,512 @@ class Database:
         if tile_start == None:
             tile_start = 1
 
-        logger.debug(f"[database] add_poi {groupname}, {lat}, {lon}, {date_from}, {date_to}, \
-                     {platform}, {width}, {height}, {description}, {tile_limit}, {tile_start}, {repr(kwargs)}")
-
-        query = "INSERT INTO PointOfInterests (groupname, lat, lon"
-        for key, value in kwargs.items():
-            if key in config.optionalSentinelParameters:
-                query = query + ", " + key
-        query = query + ", country, dateFrom, dateTo, platform, width, height, tileLimit, tileStart, description, poicreated) "
-        query = query + " VALUES ('" + str(groupname) + "'," + str(lat) + ", " + str(lon)
-        for key, value in kwargs.items():
-            if key in config.optionalSentinelParameters:
-                query = query + ", '" + str(value) + "'"
-        query = query + ", '" + self.get_country(lat, lon) + "', '" + date_from + "', '" + date_to + "', '" \
-            + platform + "', " + str(width) + ", " + str(height) \
-            + ", " + str(tile_limit) + ", " + str(tile_start) + ", "
+        logger.debug("[database] add_poi %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %r", groupname, lat, lon, date_from,
+                     date_to, platform, width, height, description, tile_limit, tile_start, kwargs)
+
+        values = [str(groupname), lat, lon, coordinate_key(lat), coordinate_key(lon)]
+        for item in config.optionalSentinelParameters:
+            values.append(str(kwargs[item]) if item in kwargs else None)
+        values.extend([self.get_country(lat, lon), date_from, date_to, platform, width, height, tile_limit, tile_start])
         if isinstance(description, type(None)):
-            query = query + "''"
+            values.append("")
         else:
-            query = query + "'" + str(description) + "'"
-        query = query + ", datetime('now', 'localtime'))"
+            values.append(str(description))
 
-        logger.debug(f"[database] add_poi query: {query}")
+        param_hash = poi_param_hash(groupname, lat, lon, date_from, date_to, platform, width, height,
+                                    description, tile_limit, tile_start, **kwargs)
+        values.append(param_hash)
 
-        poi_id = self.query(query)
+        # a concurrent process may have added the same POI in the meantime
+        with self.transaction():
+            poi = self.fetch_first_row_query(get_poi_query, (param_hash, ))
+            if poi != None:
+                logger.info("[database] PointOfInterest already in database: %s [lat:%s lon:%s]", poi["rowid"], lat, lon)
+                return poi["rowid"]
+            poi_id = self.query(add_poi_query, values)
 
-        logger.info(f"[database] new PointOfInterest inserted into database: {poi_id} [lat:{lat} lon:{lon}]")  
+        logger.info("[database] new PointOfInterest inserted into database: %s [lat:%s lon:%s]", poi_id, lat, lon)  
 
         return poi_id
         
     def get_country(self, lat, lon):
-        logger.debug(f"[database] get_country lat:{lat} lon:{lon}")
+        logger.debug("[database] get_country lat:%s lon:%s", lat, lon)
         country = None
         try:
-            cc = countries.CountryChecker(config.worldBordersShapeFile)
-            country = cc.getCountry(countries.Point(lat, lon))
+            country = countryIndex.get_country(lat, lon)
         except Exception as e:
             logger.error(f"Error in get_country: {repr(e)}")
-        logger.debug(f"[database] country for lat:{lat} lon:{lon}: {country}")
+        logger.debug("[database] country for lat:%s lon:%s: %s", lat, lon, country)
         if country == None:
             return "None"
         else:
-            return country.iso
+            return country
+
+    def get_countries(self, lats, lons):
+        logger.debug("[database] get_countries count:%s", len(lats))
+        countries = [None] * len(lats)
+        try:
+            countries = countryIndex.get_countries(lats, lons)
+        except Exception as e:
+            logger.error(f"Error in get_countries: {repr(e)}")
+        return ["None" if country == None else country for country in countries]
         
     def get_poi_from_id(self, poi_id):
-        logger.debug(f"[database] get_poi_from_id {poi_id}")
-        result = self.fetch_first_row_query("SELECT rowid, * FROM PointOfInterests WHERE rowid = %d" % poi_id)
-        logger.debug(f"[database] get_poi result: {repr(result)}")
+        logger.debug("[database] get_poi_from_id %s", poi_id)
+        result = self.fetch_first_row_query("SELECT rowid, * FROM PointOfInterests WHERE rowid = ?", (poi_id, ))
+        logger.debug("[database] get_poi result: %s", summarize(result))
         return result
 
     def get_pois_for_coordinates(self, lat, lon):
-        logger.debug(f"[database] get_pois_for_coordinates lat:{lat} lon:{lon}")
-        result = self.fetch_all_rows_query(f"SELECT rowid, * FROM PointOfInterests WHERE lat LIKE '{str(lat)}%' \
-            AND lon LIKE '{str(lon)}%'")
-        logger.debug(f"[database] get_pois_for_coordinates result rows: {len(result)}")
+        logger.debug("[database] get_pois_for_coordinates lat:%s lon:%s", lat, lon)
+        result = self.fetch_all_rows_query("SELECT rowid, * FROM PointOfInterests \
+            WHERE latKey BETWEEN ? AND ? AND lonKey BETWEEN ? AND ?",
+            coordinate_key_range(lat) + coordinate_key_range(lon))
+        logger.debug("[database] get_pois_for_coordinates result rows: %s", len(result))
         return result 
+
+    def load_coordinate_keys(self, coordinates):
+        # loads (lat, lon) pairs as key ranges into a temporary table for joins (connection specific)
+        self.query("CREATE TEMP TABLE IF NOT EXISTS CoordinateKeys \
+            (latMin INTEGER, latMax INTEGER, lonMin INTEGER, lonMax INTEGER)")
+        self.query("DELETE FROM temp.CoordinateKeys")
+        self.query_many("INSERT INTO temp.CoordinateKeys (latMin, latMax, lonMin, lonMax) VALUES (?, ?, ?, ?)",
+                        [coordinate_key_range(lat) + coordinate_key_range(lon) for lat, lon in coordinates])
+
+    def update_tiles_for_coordinates(self, coordinates, update_query):
+        # runs the update for the tile-poi connections of all POIs matching the (lat, lon) pairs
+        # returns the number of matching POIs
+        with self.transaction():
+            self.load_coordinate_keys(coordinates)
+            poi_count = self.fetch_first_row_query(f"SELECT COUNT(*) AS num FROM ({coordinate_pois_query})")["num"]
+            self.query(f"{update_query} WHERE poiId IN ({coordinate_pois_query})")
+            self.query("DELETE FROM temp.CoordinateKeys")
+        return poi_count
+
+    def set_cancelled_tiles_for_coordinates(self, coordinates):
+        logger.debug("[database] set_cancelled_tiles_for_coordinates count:%s", len(coordinates))
+        poi_count = self.update_tiles_for_coordinates(coordinates,
+                                                      "UPDATE TilesForPOIs SET cancelled = datetime('now', 'localtime')")
+        logger.info("[database] tile-poi: crops cancelled for %s POIs", poi_count)
+        return poi_count
+
+    def reset_cancelled_tiles_for_coordinates(self, coordinates):
+        logger.debug("[database] reset_cancelled_tiles_for_coordinates count:%s", len(coordinates))
+        poi_count = self.update_tiles_for_coordinates(coordinates, "UPDATE TilesForPOIs SET cancelled = NULL")
+        logger.info("[database] tile-poi: cancelled crops reseted for %s POIs", poi_count)
+        return poi_count
         
     def set_tiles_identified_for_poi(self, poi_id):
-        logger.debug(f"[database] set_tiles_identified_for_poi {poi_id}")
-        self.query("UPDATE PointOfInterests SET tilesIdentified = datetime('now', 'localtime') WHERE rowid = %d" % poi_id)
-        logger.info(f"[database] PointOfInterest updated in database (tilesIdentified): {poi_id}")
+        logger.debug("[database] set_tiles_identified_for_poi %s", poi_id)
+        self.query("UPDATE PointOfInterests SET tilesIdentified = datetime('now', 'localtime') WHERE rowid = ?", (poi_id, ))
+        logger.info("[database] PointOfInterest updated in database (tilesIdentified): %s", poi_id)
 
     def set_cancelled_poi(self, rowid):
-        logger.debug(f"[database] set_cancelled_poi {poi_id}")
-        self.query("UPDATE PointOfInterests SET cancelled = datetime('now', 'localtime') WHERE rowid = %d" % rowid)
+        logger.debug("[database] set_cancelled_poi %s", rowid)
+        self.query("UPDATE PointOfInterests SET cancelled = datetime('now', 'localtime') WHERE rowid = ?", (rowid, ))
         logger.info("[database] PointOfInterest updated in database (cancelled)")        
         
 
     ### TILE-POI-CONNECTION ###
         
     def get_tile_for_poi(self, poi_id, tile_id):
-        logger.debug(f"[database] get_tile_for_poi poi:{poi_id} tile:{tile_id}")
+        logger.debug("[database] get_tile_for_poi poi:%s tile:%s", poi_id, tile_id)
         result = self.fetch_first_row_query("SELECT Tiles.rowid, Tiles.*, TilesForPOIs.tileCropped FROM Tiles \
             INNER JOIN TilesForPOIs ON Tiles.rowid = TilesForPOIs.tileId \
-            WHERE TilesForPOIs.poiId = %d AND TilesForPOIs.tileId = %d" % (poi_id, tile_id))
-        logger.debug(f"[database] get_tile_for_poi result: {repr(result)}")
+            WHERE TilesForPOIs.poiId = ? AND TilesForPOIs.tileId = ?", (poi_id, tile_id))
+        logger.debug("[database] get_tile_for_poi result: %s", summarize(result))
         return result
         
     def get_tiles_for_poi(self, poi_id):
-        logger.debug(f"[database] get_tiles_for_poi poi:{poi_id}")
+        logger.debug("[database] get_tiles_for_poi poi:%s", poi_id)
         result = self.fetch_all_rows_query("SELECT Tiles.rowid, Tiles.*, TilesForPOIs.tileCropped FROM Tiles \
             INNER JOIN TilesForPOIs ON Tiles.rowid = TilesForPOIs.tileId \
-            WHERE TilesForPOIs.poiId = %d" % poi_id)
-        logger.debug(f"[database] get_tiles_for_poi result: {repr(result)}")
+            WHERE TilesForPOIs.poiId = ?", (poi_id, ))
+        logger.debug("[database] get_tiles_for_poi result: %s", summarize(result))
         return result
 
     def get_pois_for_tile(self, tile_id):
-        logger.debug(f"[database] get_pois_for_tile tile:{tile_id}")
+        logger.debug("[database] get_pois_for_tile tile:%s", tile_id)
         result = self.fetch_all_rows_query("SELECT PointOfInterests.rowid, PointOfInterests.*, TilesForPOIs.tileCropped, \
                                             TilesForPOIs.cancelled FROM PointOfInterests INNER JOIN TilesForPOIs \
                                             ON PointOfInterests.rowid = TilesForPOIs.poiId \
-                                            WHERE TilesForPOIs.tileId = %d" % tile_id)
-        logger.debug(f"[database] get_pois_for_tile result: {repr(result)}")
+                                            WHERE TilesForPOIs.tileId = ?", (tile_id, ))
+        logger.debug("[database] get_pois_for_tile result: %s", summarize(result))
         return result
 
     def get_uncropped_pois_for_unpacked_tiles(self):
         logger.debug("[database] get_uncropped_pois_for_unpacked_tiles")
         result = self.fetch_all_rows_query("SELECT PointOfInterests.rowid, PointOfInterests.*, TilesForPOIs.tileCropped, \
-                                            TilesForPOIs.cancelled FROM PointOfInterests INNER JOIN TilesForPOIs \
-                                            ON PointOfInterests.rowid = TilesForPOIs.poiId \
-                                            INNER JOIN Tiles ON TilesForPOIs.tileId = Tiles.rowid \
-                                            WHERE Tiles.unzipped IS NOT NULL AND TilesForPOIs.tileCropped IS NULL \
-                                            AND TilesForPOIs.cancelled IS NULL")
-        logger.debug(f"[database] get_uncropped_pois_for_unpacked_tiles result: {repr(result)}")
+                                            TilesForPOIs.cancelled " + outstanding_crops_from)
+        logger.debug("[database] get_uncropped_pois_for_unpacked_tiles result: %s", summarize(result))
         return result        
 
     def get_tile_poi_connection_id(self, poi_id, tile_id):
-        logger.debug(f"[database] get_tile_poi_connection_id poi:{poi_id} tile:{tile_id}")
-        data = self.fetch_first_row_query("SELECT rowid FROM TilesForPOIs WHERE poiId = %d AND tileId = %d" % (poi_id, tile_id))
-        logger.debug(f"[database] get_tile_poi_connection_id id:{data['rowid']} dataset:{repr(data)}")
+        logger.debug("[database] get_tile_poi_connection_id poi:%s tile:%s", poi_id, tile_id)
+        data = self.fetch_first_row_query("SELECT rowid FROM TilesForPOIs WHERE poiId = ? AND tileId = ?", (poi_id, tile_id))
+        logger.debug("[database] get_tile_poi_connection_id result: %s", summarize(data))
         if data == None:
             return 0
         else:
             return data["rowid"]  
 
     def get_tile_poi_connection(self, connection_id):
-        logger.debug(f"[database] get_tile_poi_connection {connection_id}")
-        result = self.fetch_first_row_query("SELECT rowid, * FROM TilesForPOIs WHERE rowid = %d" % connection_id)
-        logger.debug(f"[database] get_tile_poi_connection result: {repr(result)}")
+        logger.debug("[database] get_tile_poi_connection %s", connection_id)
+        result = self.fetch_first_row_query("SELECT rowid, * FROM TilesForPOIs WHERE rowid = ?", (connection_id, ))
+        logger.debug("[database] get_tile_poi_connection result: %s", summarize(result))
         return result         
 
     def get_tile_poi_connections(self):
-        logger.debug(f"[database] get_tile_poi_connections")
+        logger.debug("[database] get_tile_poi_connections")
         result = self.fetch_all_rows_query("SELECT rowid, * FROM TilesForPOIs")
-        logger.debug(f"[database] get_tile_poi_connections result rows: {len(result)}")
+        logger.debug("[database] get_tile_poi_connections result rows: %s", len(result))
         return result         
         
     def add_tile_for_poi(self, poi_id, tile_id):
-        logger.debug(f"[database] add_tile_for_poi poi:{poi_id} tile:{tile_id}")
-        newId = self.query("INSERT INTO TilesForPOIs (poiId, tileId) VALUES ( %d, %d)" % (poi_id, tile_id))
-        logger.info(f"[database] new tile-poi connection inserted into database poi:{poi_id} tile:{tile_id}")
+        logger.debug("[database] add_tile_for_poi poi:%s tile:%s", poi_id, tile_id)
+        newId = self.query("INSERT INTO TilesForPOIs (poiId, tileId) VALUES (?, ?)", (poi_id, tile_id))
+        logger.info("[database] new tile-poi connection inserted into database poi:%s tile:%s", poi_id, tile_id)
         return newId
 
     def set_tile_cropped(self, poi_id, tile_id, path):
-        logger.debug(f"[database] set_tile_cropped poi:{poi_id}, tile:{tile_id}, path:{path}")
-        self.query("UPDATE TilesForPOIs SET tileCropped = datetime('now', 'localtime'), path = '%s' WHERE poiId = %d \
-                    AND tileId = %d" % (path, poi_id, tile_id))
-        logger.info("[database] tile-poi updated in database (tileCropped): poiId:%d tileId:%d" % (poi_id, tile_id))
+        logger.debug("[database] set_tile_cropped poi:%s, tile:%s, path:%s", poi_id, tile_id, path)
+        self.query("UPDATE TilesForPOIs SET tileCropped = datetime('now', 'localtime'), path = ? WHERE poiId = ? \
+                    AND tileId = ?", (str(path), poi_id, tile_id))
+        logger.info("[database] tile-poi updated in database (tileCropped): poiId:%s tileId:%s", poi_id, tile_id)
+
+    def set_tiles_cropped(self, crops):
+        # crops: list of (poi_id, tile_id, path)
+        logger.debug("[database] set_tiles_cropped count:%s", len(crops))
+        if len(crops) > 0:
+            self.query_many("UPDATE TilesForPOIs SET tileCropped = datetime('now', 'localtime'), path = ? \
+                             WHERE poiId = ? AND tileId = ?", [(str(path), poi_id, tile_id) for poi_id, tile_id, path in crops])
+            logger.info("[database] tile-poi updated in database (tileCropped): count:%s", len(crops))
 
     def set_cancelled_tile_for_poi(self, poi_id, tile_id=None):
-        logger.debug(f"[database] set_cancelled_tile_for_poi poi:{poi_id}, tile:{tile_id}")
+        logger.debug("[database] set_cancelled_tile_for_poi poi:%s, tile:%s", poi_id, tile_id)
         if isinstance(tile_id, type(None)):
-            self.query("UPDATE TilesForPOIs SET cancelled = datetime('now', 'localtime') WHERE poiId = %d" % poi_id)
+            self.query("UPDATE TilesForPOIs SET cancelled = datetime('now', 'localtime') WHERE poiId = ?", (poi_id, ))
         else:
-            self.query("UPDATE TilesForPOIs SET cancelled = datetime('now', 'localtime') WHERE poiId = %d AND tileId = %d" % (poi_id, tile_id))
-        logger.info("[database] tile-poi updated in database (cancelled): poiId:%d tileId:%d" % (poi_id, tile_id))          
+            self.query("UPDATE TilesForPOIs SET cancelled = datetime('now', 'localtime') WHERE poiId = ? AND tileId = ?", (poi_id, tile_id))
+        logger.info("[database] tile-poi updated in database (cancelled): poiId:%s tileId:%s", poi_id, tile_id)          
+
+    def set_cancelled_tiles_for_poi_list(self, tile_pois):
+        # tile_pois: list of (poi_id, tile_id)
+        logger.debug("[database] set_cancelled_tiles_for_poi_list count:%s", len(tile_pois))
+        if len(tile_pois) > 0:
+            self.query_many("UPDATE TilesForPOIs SET cancelled = datetime('now', 'localtime') \
+                             WHERE poiId = ? AND tileId = ?", [(poi_id, tile_id) for poi_id, tile_id in tile_pois])
+            logger.info("[database] tile-poi updated in database (cancelled): count:%s", len(tile_pois))
 
     def set_cancelled_tiles_for_pois(self):
-        logger.debug(f"[database] set_cancelled_tiles_for_pois")
+        logger.debug("[database] set_cancelled_tiles_for_pois")
         self.query("UPDATE TilesForPOIs SET cancelled = datetime('now', 'localtime')")
         logger.info("[database] tile-poi: cancelled all crops")        
 
     def reset_cancelled_tile_for_poi(self, poi_id, tile_id=None):
-        logger.debug(f"[database] reset_cancelled_tile_for_poi")
+        logger.debug("[database] reset_cancelled_tile_for_poi")
         if isinstance(tile_id, type(None)):
-            self.query("UPDATE TilesForPOIs SET cancelled = NULL WHERE poiId = %d" % poi_id)
+            self.query("UPDATE TilesForPOIs SET cancelled = NULL WHERE poiId = ?", (poi_id, ))
         else:
-            self.query("UPDATE TilesForPOIs SET cancelled = NULL WHERE poiId = %d AND tileId = %d" % (poi_id, tile_id))
+            self.query("UPDATE TilesForPOIs SET cancelled = NULL WHERE poiId = ? AND tileId = ?", (poi_id, tile_id))
         logger.info("[database] tile-poi: cancelled crop reseted")
 
     def reset_cancelled_tiles_for_pois(self):
-        logger.debug(f"[database] reset_cancelled_tiles_for_pois")
+        logger.debug("[database] reset_cancelled_tiles_for_pois")
         self.query("UPDATE TilesForPOIs SET cancelled = NULL WHERE cancelled IS NOT NULL")
         logger.info("[database] tile-poi: cancelled crops reseted")
 
     def set_scence_class_ratios_for_crop(self, connection_id, ratios):
-        logger.debug(f"[database] set_scence_class_ratios_for_crop connection_id:{connection_id}, ratios:{ratios}")
+        logger.debug("[database] set_scence_class_ratios_for_crop connection_id:%s, ratios:%s", connection_id, ratios)
         if isinstance(ratios, dict) and len(ratios) > 0:
-            query = "UPDATE TilesForPOIs "
-            first = True
+            # scene classes not provided keep their current value (NULL parameter in COALESCE)
+            values = [None] * scene_classes
             for key in ratios:
                 if int(key) >= scene_classes:
                     logger.warning(f"[database] Higher scene class provided than expected! max:{scene_classes-1} provided:{key}")
                     logger.warning(f"[database] Scene class information could not be stored! connection_id:{connection_id}")
                 else:
-                    if first:
-                        query = query + "SET "
-                        first = False
-                    else:
-                        query = query + ", "
-                    # numpy.format_float_positional returns a float without scientific notation
-                    query = query + f"sceneClass{key}={numpy.format_float_positional(ratios[key])} "
-            query = query + f"WHERE rowid = {connection_id}"
-            self.query(query)
-        logger.info(f"[database] tile-poi updated in database (scene ratios): connection_id:{connection_id}, ratios:{ratios}")
+                    values[int(key)] = float(ratios[key])
+            values.append(connection_id)
+            self.query(scene_class_ratios_query, values)
+        logger.info("[database] tile-poi updated in database (scene ratios): connection_id:%s, ratios:%s", connection_id, ratios)
         
 
     ### CSV ###
 
     def import_csv_row(self, file_name, row):
-        logger.debug(f"[database] import_csv_row {file_name} {row}")
+        logger.debug("[database] import_csv_row %s %s", file_name, row)
         if not row == None:
-            optional_fields = ["width", "height", "tileLimit", "tileStart", "description"]
-            num_fields = ["width", "height", "tileLimit", "tileStart"]
-            keys = "csvFileName, groupname, lat, lon, dateFrom, dateTo, platform"
-            values = "'%s', '%s', %s, %s, '%s', '%s', '%s'" % (file_name, row["groupname"], 
-                row["lat"], row["lon"], row["dateFrom"], row["dateTo"], row["platform"])
-            for key, value in row.items():
-                if key in config.optionalSentinelParameters or key in optional_fields:
-                    if len(str(value)) > 0:
-                        keys = "%s, %s" % (keys, key)
-                        if key in num_fields:
-                            values = "%s, %s" % (values, value)
-                        else:
-                            values = "%s, '%s'" % (values, value)
-            keys = keys + ", csvImported"
-            values = values + ", datetime('now', 'localtime')"
-            query = "INSERT INTO CSVInput (%s) VALUES (%s)" % (keys, values)
-            logger.debug(f"[database] import_csv_row query: {query}")
-            csv_import_row_id = self.query(query)
-            logger.info(f"[database] csv row imported file:{file_name} row:{row} db row_id:{csv_import_row_id}")
+            csv_import_row_id = self.query(import_csv_row_query, self.get_csv_row_values(file_name, row))
+            logger.info("[database] csv row imported file:%s row:%s db row_id:%s", file_name, row, csv_import_row_id)
             return csv_import_row_id
 
+    def import_csv_rows(self, file_name, rows):
+        logger.debug("[database] import_csv_rows %s", file_name)
+        # rows requesting the same POI are imported only once
+        values_list = []
+        hashes = set()
+        duplicates = 0
+        for row in rows:
+            if row == None:
+                continue
+            try:
+                param_hash = csv_row_param_hash(row)
+            except (TypeError, ValueError):
+                # invalid coordinates: imported as before, the error shows up when loading the row
+                param_hash = None
+            if param_hash != None and param_hash in hashes:
+                duplicates += 1
+                continue
+            hashes.add(param_hash)
+            values_list.append(self.get_csv_row_values(file_name, row))
+        row_count = self.query_many(import_csv_row_query, values_list)
+        logger.info("[database] csv rows imported file:%s rows:%s duplicates skipped:%s", file_name, row_count, duplicates)
+        return row_count
+
+    def get_csv_row_values(self, file_name, row):
+        values = [file_name, row["groupname"], row["lat"], row["lon"], row["dateFrom"], row["dateTo"], row["platform"]]
+        # empty optional fields are stored as NULL
+        # numeric fields get converted by the INTEGER affinity of their columns
+        for key in config.optionalSentinelParameters + csv_optional_fields:
+            value = row.get(key)
+            values.append(value if value != None and len(str(value)) > 0 else None)
+        return values
+
     def get_imported_csv_data(self):
         logger.debug("[database] get_imported_csv_data")
         result = self.fetch_all_rows_query("SELECT rowid, * FROM CSVInput")
-        logger.debug(f"[database] get_imported_csv_data result: {repr(result)}")
+        logger.debug("[database] get_imported_csv_data result: %s", summarize(result))
         return result
 
+    def count_imported_csv_data(self):
+        logger.debug("[database] count_imported_csv_data")
+        return self.fetch_first_row_query("SELECT COUNT(*) AS num FROM CSVInput")["num"]
+
+    def iterate_imported_csv_data(self, offset=0, chunk_size=fetch_chunk_size):
+        # keyset pagination by rowid: every chunk is a separate query,
+        # so the rows can be moved to the archive while iterating
+        logger.debug("[database] iterate_imported_csv_data offset:%s", offset)
+        rows = self.fetch_all_rows_query("SELECT rowid, * FROM CSVInput ORDER BY rowid LIMIT ? OFFSET ?",
+                                         (chunk_size, offset))
+        while len(rows) > 0:
+            yield from rows
+            rows = self.fetch_all_rows_query("SELECT rowid, * FROM CSVInput WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                                             (rows[-1]["rowid"], chunk_size))
+
     def move_csv_item_to_archive(self, rowid):
-        logger.debug(f"[database] move_csv_item_to_archive rowid:{rowid}")
-        new_id = self.query("INSERT INTO CSVLoaded SELECT *, datetime('now', 'localtime') \
-                             as csvLoaded FROM CSVInput WHERE CSVInput.rowid = %d" % rowid)
-        self.query("DELETE FROM CSVInput WHERE rowid = %d" % rowid)
-        logger.debug(f"[database] move_csv_item_to_archive dataset moved [new_id:{new_id}]")
+        logger.debug("[database] move_csv_item_to_archive rowid:%s", rowid)
+        # copy and delete in one transaction, so an item is never lost or duplicated
+        with self.transaction():
+            new_id = self.query("INSERT INTO CSVLoaded SELECT *, datetime('now', 'localtime') \
+                                 as csvLoaded FROM CSVInput WHERE CSVInput.rowid = ?", (rowid, ))
+            self.query("DELETE FROM CSVInput WHERE rowid = ?", (rowid, ))
+        logger.debug("[database] move_csv_item_to_archive dataset moved [new_id:%s]", new_id)
         return new_id
 
     def set_cancelled_import(self, rowid):
-        logger.debug(f"[database] set_cancelled_import {rowid}")
-        self.query("UPDATE CSVInput SET cancelled = datetime('now', 'localtime') WHERE rowid = %d" % rowid)
-        logger.info("[database] import updated in database (cancelled)")
-        self.move_csv_item_to_archive(rowid)
+        logger.debug("[database] set_cancelled_import %s", rowid)
+        with self.transaction():
+            self.query("UPDATE CSVInput SET cancelled = datetime('now', 'localtime') WHERE rowid = ?", (rowid, ))
+            logger.info("[database] import updated in database (cancelled)")
+            self.move_csv_item_to_archive(rowid)
+
+
+    ### STATUS ###
+
+    def count_outstanding_crops(self):
+        logger.debug("[database] count_outstanding_crops")
+        result = self.fetch_first_row_query(f"SELECT COUNT(*) AS num {outstanding_crops_from}")
+        return result["num"]
+
+    def get_outstanding_crops_per_group(self):
+        logger.debug("[database] get_outstanding_crops_per_group")
+        result = self.fetch_all_rows_query(f"SELECT PointOfInterests.groupname, PointOfInterests.platform, \
+            COUNT(*) AS num {outstanding_crops_from} \
+            GROUP BY PointOfInterests.groupname, PointOfInterests.platform \
+            ORDER BY PointOfInterests.groupname, PointOfInterests.platform")
+        logger.debug("[database] get_outstanding_crops_per_group result: %s", summarize(result))
+        return result
+
+    def get_tile_state_counts(self):
+        # not downloaded tiles: offline (waiting for the retrieval from the long term archive),
+        # online (found online by the last check), requested (online state not checked yet)
+        # downloaded: archive downloaded, unpacked: tile folder unpacked
+        logger.debug("[database] get_tile_state_counts")
+        result = self.fetch_all_rows_query("SELECT platform, \
+            CASE WHEN cancelled IS NOT NULL THEN 'cancelled' \
+                 WHEN unzipped IS NOT NULL THEN 'unpacked' \
+                 WHEN downloadComplete IS NOT NULL THEN 'downloaded' \
+                 WHEN offline IS NOT NULL THEN 'offline' \
+                 WHEN onlineChecked IS NOT NULL THEN 'online' \
+                 ELSE 'requested' END AS state, \
+            COUNT(*) AS num FROM Tiles GROUP BY platform, state ORDER BY platform, state")
+        logger.debug("[database] get_tile_state_counts result: %s", summarize(result))
+        return result
+
+    def get_crops_per_day(self, days=None):
+        logger.debug("[database] get_crops_per_day %s", days)
+        result = self.fetch_all_rows_query("SELECT date(tileCropped) AS day, COUNT(*) AS num FROM TilesForPOIs \
+            WHERE tileCropped IS NOT NULL AND (? IS NULL OR tileCropped >= date('now', 'localtime', ?)) \
+            GROUP BY day ORDER BY day", (days, None if days == None else f"-{int(days)} days"))
+        logger.debug("[database] get_crops_per_day result: %s", summarize(result))
+        return result
+
+    def get_job_state_counts(self):
+        logger.debug("[database] get_job_state_counts")
+        result = self.fetch_all_rows_query("SELECT kind, state, COUNT(*) AS num FROM Jobs GROUP BY kind, state \
+            ORDER BY kind, state")
+        logger.debug("[database] get_job_state_counts result: %s", summarize(result))
+        return result
+
+
+    ### JOBS ###
+
+    def enqueue_jobs(self, kind):
+        """Creates pending jobs for all outstanding targets of a kind (download or crop).
+
+        Finished jobs get reopened if their target is outstanding again.
+        Running, pending and dead jobs are left untouched.
+        Returns the number of new or reopened jobs.
+        """
+        logger.debug("[database] enqueue_jobs %s", kind)
+        target_query = job_target_queries[kind]
+        with self.transaction():
+            self.query(f"UPDATE Jobs SET state = 'pending', attempts = 0, lastError = NULL, \
+                updated = datetime('now', 'localtime') WHERE kind = ? AND state = 'done' AND targetId IN ({target_query})",
+                (kind, ))
+            reopened = self.row_count
+            self.query(f"INSERT INTO Jobs (kind, targetId, state, attempts, created, updated) \
+                SELECT ?, targets.targetId, 'pending', 0, datetime('now', 'localtime'), datetime('now', 'localtime') \
+                FROM ({target_query}) AS targets \
+                WHERE NOT EXISTS (SELECT 1 FROM Jobs WHERE Jobs.kind = ? AND Jobs.targetId = targets.targetId)",
+                (kind, kind))
+            created = self.row_count
+        logger.info("[database] jobs enqueued: kind:%s new:%s reopened:%s", kind, created, reopened)
+        return created + reopened
+
+    def claim_job(self, kind, owner):
+        """Leases the next pending job of a kind to owner and returns it (None if there is no pending job).
+
+        Jobs with expired leases are released first (or moved to dead state after jobMaxAttempts attempts).
+        The claim runs in one BEGIN IMMEDIATE transaction, so a job is never leased to two processes.
+        """
+        logger.debug("[database] claim_job %s %s", kind, owner)
+        with self.transaction():
+            self.query("UPDATE Jobs SET state = CASE WHEN attempts >= ? THEN 'dead' ELSE 'pending' END, \
+                leaseOwner = NULL, leaseExpires = NULL, lastError = 'lease expired (owner: ' || leaseOwner || ')', \
+                updated = datetime('now', 'localtime') \
+                WHERE kind = ? AND state = 'running' AND leaseExpires < datetime('now', 'localtime')",
+                (config.jobMaxAttempts, kind))
+            job = self.fetch_first_row_query("SELECT rowid FROM Jobs WHERE kind = ? AND state = 'pending' \
+                ORDER BY rowid LIMIT 1", (kind, ))
+            if job == None:
+                return None
+            self.query("UPDATE Jobs SET state = 'running', leaseOwner = ?, attempts = attempts + 1, \
+                leaseExpires = datetime('now', 'localtime', ?), updated = datetime('now', 'localtime') WHERE rowid = ?",
+                (owner, f"+{config.jobLeaseMinutes} minutes", job["rowid"]))
+            job = self.fetch_first_row_query("SELECT rowid, * FROM Jobs WHERE rowid = ?", (job["rowid"], ))
+        logger.info("[database] job claimed: id:%s kind:%s target:%s attempt:%s owner:%s", job["rowid"], kind,
+                    job["targetId"], job["attempts"], owner)
+        return job
+
+    def renew_job_lease(self, job_id, owner):
+        # returns False if the lease expired and the job was released or leased to another owner
+        logger.debug("[database] renew_job_lease %s %s", job_id, owner)
+        self.query("UPDATE Jobs SET leaseExpires = datetime('now', 'localtime', ?), updated = datetime('now', 'localtime') \
+            WHERE rowid = ? AND state = 'running' AND leaseOwner = ?", (f"+{config.jobLeaseMinutes} minutes", job_id, owner))
+        renewed = self.row_count > 0
+        if not renewed:
+            logger.warning(f"[database] lease of job {job_id} lost by {owner}")
+        return renewed
+
+    @contextlib.contextmanager
+    def job_lease(self, job):
+        """Renews the lease of a claimed job in a thread while the with-block runs.
+
+        The lease gets renewed three times per jobLeaseMinutes, so long downloads and crops
+        are not leased to another worker.
+        """
+
+        stopped = threading.Event()
+
+        def renew():
+            while not stopped.wait(config.jobLeaseMinutes * 20):
+                if not self.renew_job_lease(job['rowid'], job['leaseOwner']):
+                    break
+
+        thread = threading.Thread(target=renew, name=f"lease {job['rowid']}", daemon=True)
+        thread.start()
+        try:
+            yield job
+        finally:
+            stopped.set()
+            thread.join()
+
+    def complete_job(self, job_id, owner):
+        # only failures and expired leases count towards jobMaxAttempts, so the attempts start again at 0
+        # the job is only updated if owner still holds the lease
+        logger.debug("[database] complete_job %s %s", job_id, owner)
+        self.query("UPDATE Jobs SET state = 'done', attempts = 0, lastError = NULL, leaseOwner = NULL, \
+            leaseExpires = NULL, updated = datetime('now', 'localtime') WHERE rowid = ? AND leaseOwner = ?",
+            (job_id, owner))
+        if self.row_count == 0:
+            logger.warning(f"[database] job {job_id} not completed: lease lost by {owner}")
+        else:
+            logger.info("[database] job done: %s", job_id)
+
+    def fail_job(self, job_id, owner, error):
+        # failed jobs are retried until jobMaxAttempts is reached, afterwards they are moved to dead state
+        # the job is only updated if owner still holds the lease
+        logger.debug("[database] fail_job %s %s", job_id, owner)
+        self.query("UPDATE Jobs SET state = CASE WHEN attempts >= ? THEN 'dead' ELSE 'pending' END, \
+            leaseOwner = NULL, leaseExpires = NULL, lastError = ?, updated = datetime('now', 'localtime') \
+            WHERE rowid = ? AND leaseOwner = ?", (config.jobMaxAttempts, str(error), job_id, owner))
+        if self.row_count == 0:
+            logger.warning(f"[database] job {job_id} failed, but lease lost by {owner}: {error}")
+        else:
+            logger.warning(f"[database] job failed: {job_id} error: {error}")
+
+    def get_dead_jobs(self, kind=None):
+        logger.debug("[database] get_dead_jobs %s", kind)
+        result = self.fetch_all_rows_query("SELECT rowid, * FROM Jobs WHERE state = 'dead' AND (? IS NULL OR kind = ?)",
+                                           (kind, kind))
+        logger.debug("[database] get_dead_jobs result: %s", summarize(result))
+        return result
+
+    def reset_dead_jobs(self, kind=None):
+        logger.debug("[database] reset_dead_jobs %s", kind)
+        self.query("UPDATE Jobs SET state = 'pending', attempts = 0, updated = datetime('now', 'localtime') \
+            WHERE state = 'dead' AND (? IS NULL OR kind = ?)", (kind, kind))
+        row_count = self.row_count
+        logger.info("[database] dead jobs reseted: %s", row_count)
+        return row_count
+
+
+    ### SEARCH CACHE ###
+
+    def get_search_cache_entry(self, query_hash):
+        logger.debug("[database] get_search_cache_entry %s", query_hash)
+        result = self.fetch_first_row_query("SELECT rowid, * FROM SearchCache WHERE queryHash = ? \
+            AND (expires IS NULL OR expires > datetime('now', 'localtime'))", (query_hash, ))
+        logger.debug("[database] get_search_cache_entry found: %s", result != None)
+        return result
+
+    def set_search_cache_entry(self, query_hash, query, response, expiry_hours=None):
+        # expiry_hours None: the entry does not expire
+        logger.debug("[database] set_search_cache_entry %s %s", query_hash, query)
+        expires = None if expiry_hours == None else f"+{int(expiry_hours)} hours"
+        self.query("INSERT OR REPLACE INTO SearchCache (queryHash, query, response, created, expires) \
+            VALUES (?, ?, ?, datetime('now', 'localtime'), datetime('now', 'localtime', ?))", 
+            (query_hash, query, response, expires))
+        logger.info("[database] search response cached: %s", query)
+
+    def clear_search_cache(self, expired_only=False):
+        logger.debug("[database] clear_search_cache expired_only:%s", expired_only)
+        if expired_only:
+            self.query("DELETE FROM SearchCache WHERE expires <= datetime('now', 'localtime')")
+        else:
+            self.query("DELETE FROM SearchCache")
+        row_count = self.row_count
+        logger.info("[database] cached search responses removed: %s", row_count)
+        return row_count
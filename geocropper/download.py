@@ -1,18 +1,36 @@
 import pathlib
+import threading
+import time
 
 import geocropper.config as config
 import geocropper.utils as utils
 import geocropper.database as database
-import geocropper.sentinelWrapper as sentinelWrapper
-import geocropper.landsatWrapper as landsatWrapper
 import geocropper.asfWrapper as asfWrapper
+import geocropper.downloadCheck as downloadCheck
+import geocropper.searchCache as searchCache
+import geocropper.streamUnpack as streamUnpack
 
 import logging
 
+# the API wrappers (sentinelsat, landsatxplore) are imported only where they are needed,
+# since loading them slows down the import of the package
+
 # get logger object
 logger = logging.getLogger('root')
 db = database.Database()
 
+# max number of concurrent downloads per data provider (downloads run in threads, see downloadManager)
+provider_slots = {
+    "copernicus": threading.BoundedSemaphore(config.copernicusMaxDownloads),
+    "asf": threading.BoundedSemaphore(config.asfMaxDownloads),
+    "usgs": threading.BoundedSemaphore(config.usgsMaxDownloads)
+}
+
+# offline retrieval requests are sent one after another,
+# so the copernicusRequestDelay between two requests holds for concurrent downloads as well
+offline_request_lock = threading.Lock()
+
+
 def search_satellite_products(lat, lon, date_from, date_to, platform, tile_limit=0, tile_start=1, **kwargs):
     """Search for satellite products
 
@@ -83,13 +101,19 @@ def search_satellite_products(lat, lon, date_from, date_to, platform, tile_limit
 
     if platform.lower().startswith("sentinel"):
         
-        sentinel = sentinelWrapper.SentinelWrapper()
+        def search():
+            import geocropper.sentinelWrapper as sentinelWrapper
+            sentinel = sentinelWrapper.SentinelWrapper()
+            if int(tile_limit) > 0:
+                return sentinel.get_sentinel_products(lat, lon, date_from, date_to, platform, 
+                    limit=tile_limit, **kwargs)
+            else:   
+                return sentinel.get_sentinel_products(lat, lon, date_from, date_to, platform, **kwargs)
 
-        if int(tile_limit) > 0:
-            products = sentinel.get_sentinel_products(lat, lon, date_from, date_to, platform, 
-                limit=tile_limit, **kwargs)
-        else:   
-            products = sentinel.get_sentinel_products(lat, lon, date_from, date_to, platform, **kwargs)
+        # identical queries are answered from the search cache
+        query = {"function": "get_sentinel_products", "lat": lat, "lon": lon, "date_from": date_from, 
+                 "date_to": date_to, "platform": platform, "limit": int(tile_limit), **kwargs}
+        products = searchCache.cached_search(query, search)
 
         if len(products) > 0:
             if tile_start > 1:
@@ -105,8 +129,6 @@ def search_satellite_products(lat, lon, date_from, date_to, platform, tile_limit
 
     if platform.lower().startswith("landsat"):
 
-        landsat = landsatWrapper.LandsatWrapper()
-
         date_from = utils.convert_date(date_from, "%Y-%m-%d")
         date_to = utils.convert_date(date_to, "%Y-%m-%d")
 
@@ -116,8 +138,16 @@ def search_satellite_products(lat, lon, date_from, date_to, platform, tile_limit
             if key == "cloudcoverpercentage":
                 max_cloud_coverage = value      
     
-        products = landsat.get_landsat_products(lat, lon, date_from, date_to, platform, 
-            max_cloud_coverage, tile_limit)
+        def search():
+            import geocropper.landsatWrapper as landsatWrapper
+            landsat = landsatWrapper.LandsatWrapper()
+            return landsat.get_landsat_products(lat, lon, date_from, date_to, platform, 
+                max_cloud_coverage, tile_limit)
+
+        query = {"function": "get_landsat_products", "lat": lat, "lon": lon, "date_from": date_from, 
+                 "date_to": date_to, "platform": platform, "max_cloud_coverage": max_cloud_coverage, 
+                 "limit": tile_limit}
+        products = searchCache.cached_search(query, search)
 
         if len(products) > 0:
             for i, (key, item) in enumerate(products.items()):
@@ -153,12 +183,14 @@ def save_product_key(platform, key, meta_data=None):
         if platform.lower().startswith("sentinel"):
 
             # load sentinel wrapper and fetch meta data
+            import geocropper.sentinelWrapper as sentinelWrapper
             sentinel = sentinelWrapper.SentinelWrapper()
             meta_data = sentinel.get_product_data(key)
 
         if platform.lower().startswith("landsat"):
 
             # load landsat wrapper and fetch meta data
+            import geocropper.landsatWrapper as landsatWrapper
             landsat = landsatWrapper.LandsatWrapper()
             meta_data = landsat.get_product_data(platform, key)
 
@@ -175,7 +207,7 @@ def save_product_key(platform, key, meta_data=None):
             
             if platform.lower().startswith("sentinel"):
                 beginposition = meta_data["beginposition"]
-                endposition = meta_data["beginposition"]
+                endposition = meta_data["endposition"]
                 # folder name after unzip is < SENTINEL TILE TITLE >.SAFE
                 folder_name = meta_data["title"] + ".SAFE"          
             
@@ -195,10 +227,36 @@ def save_product_key(platform, key, meta_data=None):
         else:
             tile_id = tile["rowid"]     
 
+        # footprint and meta data are stored for the local resolution of POIs (see find_local_tiles)
+        if platform.lower().startswith("sentinel") and meta_data.get("footprint") != None \
+                and (tile == None or tile["footprint"] == None):
+            db.set_tile_footprint(tile_id, meta_data["footprint"], meta_data.get("cloudcoverpercentage"), 
+                                  meta_data.get("producttype"))
+
         return tile_id
 
 
-def download_product(tile_id=None, tile=None):
+def transfer(provider, tile, archive_name, progress, function, *args):
+    """Runs the download function of a provider within the concurrency limit of the provider.
+
+    If progress is set, it gets called with the tile, the provider, the size of the archive in bytes 
+    and the duration of the transfer in seconds.
+    """
+
+    with provider_slots[provider]:
+        start = time.perf_counter()
+        result = function(*args)
+        duration = time.perf_counter() - start
+
+    if progress != None:
+        archive_path = config.bigTilesDir / archive_name
+        size = archive_path.stat().st_size if archive_path.is_file() else 0
+        progress(tile, provider, size, duration)
+
+    return result
+
+
+def download_product(tile_id=None, tile=None, progress=None):
     """Downloads Sentinel or Landsat product
 
     Parameters
@@ -207,6 +265,8 @@ def download_product(tile_id=None, tile=None):
         Row id of the tile record in the internal database.
     tile : list, optional
         Record of the tile in the internal database.
+    progress : function, optional
+        Called after the transfer of the product (see transfer).
     """
 
     if tile_id == None and tile == None:
@@ -219,6 +279,7 @@ def download_product(tile_id=None, tile=None):
 
         if tile['platform'].lower().startswith("sentinel"):
 
+            import geocropper.sentinelWrapper as sentinelWrapper
             sentinel = sentinelWrapper.SentinelWrapper()
 
             # check if tile ready for download
@@ -228,14 +289,27 @@ def download_product(tile_id=None, tile=None):
                 # sentinel wrapper has a resume function for incomplete downloads
                 logger.info("Download started.")
                 db.set_last_download_request_for_tile(tile['rowid'])
-                download_complete = sentinel.download_sentinel_product(tile['productId'])
 
-                if download_complete and check_for_existing_big_tile(tile):
+                # the archive gets extracted (if streamingUnpack is set) and verified while downloading
+                # (the watcher gets the data read by the extractor, so the archive is read once)
+                watcher = downloadCheck.ChecksumWatcher(tile['folderName'][:-5] + ".zip")
+                with streamUnpack.StreamExtractor(tile, tile['folderName'][:-5] + ".zip", watcher) as extractor, \
+                     watcher:
+
+                    download_complete = transfer("copernicus", tile, tile['folderName'][:-5] + ".zip", progress,
+                                                 sentinel.download_sentinel_product, tile['productId'])
+
+                    verified = not download_complete or \
+                        verify_download(tile, tile['folderName'][:-5] + ".zip", watcher, sentinel)
 
-                    # download complete timestamp gets set in check_for_existing_big_tile
-                    utils.unpack_big_tile(file_name=(tile['folderName'][:-5] + ".zip"), tile=tile)
-                    utils.save_tile_projection(tile=tile)
-                    return True
+                    if download_complete and verified and check_for_existing_big_tile(tile):
+
+                        # download complete timestamp gets set in check_for_existing_big_tile
+                        complete_download(tile, tile['folderName'][:-5] + ".zip", extractor)
+                        return True
+
+                if not verified:
+                    return retry_download(tile, progress)
 
             else:
 
@@ -245,54 +319,239 @@ def download_product(tile_id=None, tile=None):
 
                     # try ASF as alternative source
                     granule = tile['folderName'][:-5]
-                    download_complete = asf.download_S1_tile(granule + ".zip", config.bigTilesDir)
 
-                    if download_complete and check_for_existing_big_tile(tile):
+                    # the archives of ASF are checked by the checksums of their members
+                    # (checked by the extractor if the archive is extracted while downloading)
+                    watcher = downloadCheck.ChecksumWatcher(granule + ".zip", check_archive=True)
+                    with streamUnpack.StreamExtractor(tile, granule + ".zip", watcher) as extractor, watcher:
 
-                        # download complete timestamp gets set in check_for_existing_big_tile
-                        utils.unpack_big_tile(file_name=(tile['folderName'][:-5] + ".zip"), tile=tile)
-                        utils.save_tile_projection(tile=tile)
-                        return True
+                        download_complete = transfer("asf", tile, granule + ".zip", progress,
+                                                     asf.download_S1_tile, granule + ".zip", config.bigTilesDir)
+
+                        verified = not download_complete or verify_download(tile, granule + ".zip", watcher)
+
+                        if download_complete and verified and check_for_existing_big_tile(tile):
+
+                            # download complete timestamp gets set in check_for_existing_big_tile
+                            complete_download(tile, tile['folderName'][:-5] + ".zip", extractor)
+                            return True
+
+                    if not verified:
+                        return retry_download(tile, progress)
 
                 # send download request to ESA server
-                if sentinel.request_offline_tile(last_tile_download_request=tile['lastDownloadRequest'], product_id=tile['productId']):
-                    
-                    # update download request date for existing tile in database
-                    db.set_last_download_request_for_tile(tile['rowid'])
+                request_retrieval(tile, sentinel)
 
         if tile['platform'].lower().startswith("landsat"):
 
+            import geocropper.landsatWrapper as landsatWrapper
             landsat = landsatWrapper.LandsatWrapper()
 
             logger.info("Download started.")
             db.set_last_download_request_for_tile(tile['rowid'])
 
-            landsat.download_landsat_product(tile["productId"])
+            # truncated or corrupt tar.gz files are detected by the checksum of the gzip stream
+            with downloadCheck.ChecksumWatcher(tile['folderName'] + ".tar.gz", check_archive=True) as watcher:
+
+                transfer("usgs", tile, tile['folderName'] + ".tar.gz", progress,
+                         landsat.download_landsat_product, tile["productId"])
+
+                verified = verify_download(tile, tile['folderName'] + ".tar.gz", watcher)
+
+            if not verified:
+                return retry_download(tile, progress)
 
             if check_for_existing_big_tile(tile):
 
                 # download complete timestamp gets set in check_for_existing_big_tile
-                utils.unpack_big_tile(file_name=(tile['folderName'] + ".tar.gz"), tile=tile)
-                utils.save_tile_projection(tile=tile)
+                complete_download(tile, tile['folderName'] + ".tar.gz")
                 return True            
 
 
-def check_for_existing_big_tile_archive(tile):
+def request_retrieval(tile, sentinel):
+    """Requests the retrieval of an offline Sentinel product from the long term archive (LTA).
 
-    if tile['platform'].lower().startswith("sentinel"):
+    The requests are sent one after another, copernicusRequestDelay and copernicusRepeatRequestAfterMin are checked
+    by the Sentinel wrapper. At most ltaMaxPendingRequests requested products wait for retrieval at the same time.
+    Returns True if the request was sent.
+    """
 
-        if pathlib.Path(config.bigTilesDir / (tile['folderName'][:-5] + ".zip") ).is_file():
-            return True
-        else:
+    with offline_request_lock:
+
+        db.set_tile_offline(tile['rowid'])
+
+        if config.ltaMaxPendingRequests > 0 and db.count_pending_retrievals() >= config.ltaMaxPendingRequests:
+            logger.info(f"Retrieval of {tile['folderName']} not requested (max number of pending requests reached).")
             return False
 
-    if tile['platform'].lower().startswith("landsat"):
+        if sentinel.request_offline_tile(last_tile_download_request=tile['lastDownloadRequest'], product_id=tile['productId']):
 
-        if pathlib.Path(config.bigTilesDir / (tile['folderName'] + ".tar.gz") ).is_file():
+            # update download request date for existing tile in database
+            db.set_last_download_request_for_tile(tile['rowid'])
+            logger.info(f"Retrieval of {tile['folderName']} requested.")
             return True
+
+    return False
+
+
+def verify_download(tile, archive_name, watcher, sentinel=None):
+    """Verifies a downloaded archive and stores the result in the database.
+
+    The MD5 checksum of the archive is compared with the checksum of the OData of the product (if sentinel is set),
+    otherwise the internal checksums of the archive are used (if checked by the watcher).
+    Corrupt archives get removed. Returns False for corrupt archives.
+    """
+
+    archive_path = config.bigTilesDir / archive_name
+
+    if not config.verifyDownloads or not archive_path.is_file():
+        return True
+
+    checksum = watcher.get_md5()
+
+    if sentinel != None:
+        expected_checksum = sentinel.get_product_md5(tile['productId'])
+        valid = checksum.lower() == expected_checksum.lower() if expected_checksum != None else None
+    else:
+        valid = watcher.is_archive_valid()
+
+    if valid == None:
+        logger.info(f"No checksum available for {archive_name} (MD5: {checksum}).")
+        db.set_tile_checksum(tile['rowid'], checksum, verified=False)
+        return True
+
+    if valid:
+        logger.info(f"Download of {archive_name} verified (MD5: {checksum}).")
+        db.set_tile_checksum(tile['rowid'], checksum)
+        return True
+
+    logger.error(f"Download of {archive_name} is corrupt (MD5: {checksum}).")
+    print(f"Download of {archive_name} is corrupt. The archive gets removed.")
+    archive_path.unlink()
+    db.set_tile_checksum_failed(tile['rowid'], checksum)
+
+    return False
+
+
+def retry_download(tile, progress=None):
+    # corrupt downloads are repeated up to downloadVerifyAttempts times
+    tile = db.get_tile_by_rowid(tile['rowid'])
+
+    if tile['checksumFailures'] < config.downloadVerifyAttempts:
+        print(f"Download of {tile['folderName']} is repeated (attempt {tile['checksumFailures'] + 1}).")
+        return download_product(tile=tile, progress=progress)
+
+    logger.error(f"Download of {tile['folderName']} failed {tile['checksumFailures']} times (corrupt archives).")
+    print(f"Download of {tile['folderName']} failed {tile['checksumFailures']} times (corrupt archives).")
+    return False
+
+
+def complete_download(tile, file_name, extractor=None):
+    # unpacks a downloaded product and connects it to all waiting POIs it covers
+    # if archives are kept packed, the tiles are cropped directly from the archives (see utils.get_big_tile_path)
+    if config.keepArchivesPacked:
+        db.set_unpacked_for_tile(tile['rowid'])
+    elif extractor != None and extractor.install():
+        # the archive was extracted while downloading (see streamUnpack)
+        pathlib.Path(config.bigTilesDir / file_name).unlink()
+        db.set_unpacked_for_tile(tile['rowid'])
+    else:
+        utils.unpack_big_tile(file_name=file_name, tile=tile)
+    utils.save_tile_projection(tile=db.get_tile_by_rowid(tile['rowid']))
+    link_waiting_pois(tile)
+
+
+def tile_matches(tile, lat, lon, **kwargs):
+    """Checks if the footprint of the tile contains the point and the stored meta data matches the parameters.
+
+    Parameters which are not stored for tiles (e.g. polarisationmode) cannot be checked,
+    so tiles never match requests using them.
+    """
+
+    from shapely import wkt
+    from shapely.geometry import Point
+
+    if tile["footprint"] == None or not wkt.loads(tile["footprint"]).intersects(Point(float(lon), float(lat))):
+        return False
+
+    for key, value in kwargs.items():
+        if value == None or not key in config.optionalSentinelParameters:
+            continue
+        if key == "cloudcoverpercentage":
+            if tile["cloudCover"] == None or float(tile["cloudCover"]) > float(value):
+                return False
+        elif key == "producttype":
+            if tile["productType"] != value:
+                return False
         else:
             return False
 
+    return True
+
+
+def find_local_tiles(lat, lon, date_from, date_to, platform, **kwargs):
+    """Returns the known tiles (internal database) matching the search parameters, ordered by sensing time.
+
+    Only tiles found by previous searches are returned, so the result may be incomplete.
+    """
+
+    if not config.localTileSearch:
+        return []
+
+    tiles = db.get_tiles_for_point(lat, lon, platform, utils.convert_date(date_from, "%Y-%m-%d"), 
+                                   utils.convert_date(date_to, "%Y-%m-%d"))
+
+    return [tile for tile in tiles if tile_matches(tile, lat, lon, **kwargs)]
+
+
+def link_waiting_pois(tile):
+    """Connects a tile to all POIs it covers which are not yet connected to it.
+
+    POIs with a tile limit are left out, since the tile could exceed their limit.
+    """
+
+    if not config.localTileSearch:
+        return 0
+
+    tile = db.get_tile_by_rowid(tile["rowid"])
+    counter = 0
+
+    for poi in db.get_waiting_pois_for_tile(tile["rowid"]):
+        kwargs = {key: poi[key] for key in config.optionalSentinelParameters}
+        if tile_matches(tile, poi["lat"], poi["lon"], **kwargs):
+            db.add_tile_for_poi(poi["rowid"], tile["rowid"])
+            counter += 1
+
+    if counter > 0:
+        logger.info(f"Tile {tile['folderName']} connected to {counter} waiting POIs.")
+
+    return counter
+
+
+def get_big_tile_archive_path(tile):
+
+    if tile['platform'].lower().startswith("sentinel"):
+        return pathlib.Path(config.bigTilesDir / (tile['folderName'][:-5] + ".zip"))
+
+    if tile['platform'].lower().startswith("landsat"):
+        return pathlib.Path(config.bigTilesDir / (tile['folderName'] + ".tar.gz"))
+
+
+def check_for_existing_big_tile_archive(tile):
+
+    archive_path = get_big_tile_archive_path(tile)
+
+    if archive_path != None and archive_path.is_file():
+        return True
+    else:
+        return False
+
+
+def check_for_existing_packed_big_tile(tile):
+    # archive which is used without unpacking (keepArchivesPacked)
+    return config.keepArchivesPacked and check_for_existing_big_tile_archive(tile)
+
+
 def check_for_existing_big_tile_folder(tile):
 
     if tile['platform'].lower().startswith("sentinel"):
@@ -330,8 +589,7 @@ def check_for_existing_big_tile(tile):
 
             if tile['downloadComplete'] != None:
             
-                db.clear_download_complete_for_tile(tile['rowid'])
-                db.clear_unpacked_for_tile(tile['rowid'])
+                db.reset_tile_for_download(tile['rowid'])
 
             return False
 
@@ -341,7 +599,8 @@ def check_for_existing_big_tile(tile):
 
                 db.set_download_complete_for_tile(tile['rowid'])
 
-            if tile['unzipped'] == None and check_for_existing_big_tile_folder(tile):
+            if tile['unzipped'] == None and (check_for_existing_big_tile_folder(tile) or \
+                                             check_for_existing_packed_big_tile(tile)):
 
                 db.set_unpacked_for_tile(tile['rowid'])
 
@@ -351,7 +610,7 @@ def check_for_existing_big_tile(tile):
 
         # TODO: check if existing tar file is complete => needs to be deleted and re-downloaded
 
-        if not check_for_existing_big_tile_folder(tile):
+        if not check_for_existing_big_tile_folder(tile) and not check_for_existing_packed_big_tile(tile):
 
             if tile['downloadComplete'] != None:
             
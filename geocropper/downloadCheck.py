@@ -0,0 +1,178 @@
+import hashlib
+import threading
+import zlib
+
+import geocropper.config as config
+import geocropper.streamUnpack as streamUnpack
+
+import logging
+
+# get logger object
+logger = logging.getLogger('root')
+
+
+# downloaded archives are verified while they are written:
+# a watcher follows the growing file on disk (see streamUnpack.GrowingFile) and computes the MD5 checksum,
+# which is compared with the checksum of the Copernicus OData after the download
+# if the archive is extracted while downloading, the watcher gets the data from the reader of the extractor
+# (see streamUnpack.StreamExtractor), so the archive is read only once
+# archives without a published checksum are checked by their internal checksums instead
+# (CRC-32 of the zip members or of the gzip stream of Landsat tar.gz files)
+
+
+class GzipCheck:
+    """Decompresses a gzip stream to check its CRC-32 and length (the decompressed data is not kept)."""
+
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.started = False
+        self.error = None
+
+    def update(self, data):
+
+        if self.error != None:
+            return
+
+        try:
+            while len(data) > 0:
+
+                if self.decompressor.eof:
+                    # next gzip member (zeros behind the last member are ignored)
+                    data = data.lstrip(b"\x00")
+                    if len(data) == 0:
+                        break
+                    self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+                self.started = True
+
+                # the output is limited, so only a small part of the decompressed data is in memory
+                self.decompressor.decompress(data, streamUnpack.chunk_size)
+                while len(self.decompressor.unconsumed_tail) > 0:
+                    self.decompressor.decompress(self.decompressor.unconsumed_tail, streamUnpack.chunk_size)
+
+                data = self.decompressor.unused_data if self.decompressor.eof else b""
+
+        except zlib.error as e:
+            self.error = e
+
+    def is_valid(self):
+        # the last gzip member has to be complete
+        return self.error == None and self.started and self.decompressor.eof
+
+
+class ChecksumWatcher:
+    """Computes the MD5 checksum of an archive in a thread while the archive is being downloaded.
+
+    Used as context manager around the download (only active if verifyDownloads is set).
+    If check_archive is set, the internal checksums of the archive are checked as well
+    (zip members or gzip stream).
+    If the archive could not be followed completely (e.g. it was replaced during the download),
+    it is read again after the download.
+    If a StreamExtractor follows the archive, the watcher uses its data instead of reading the archive itself.
+    """
+
+    def __init__(self, archive_name, check_archive=False):
+
+        self.archive_name = archive_name
+        self.archive_path = config.bigTilesDir / archive_name
+        self.check_archive = check_archive
+        self.finished = threading.Event()
+        self.thread = None
+        self.extractor = None
+        self.reset()
+
+    def reset(self):
+
+        self.md5 = hashlib.md5()
+        self.size = 0
+        self.complete = False
+        self.archive_valid = None
+        self.gzip_check = GzipCheck() if self.check_archive and self.archive_name.endswith(".tar.gz") else None
+
+    def __enter__(self):
+
+        if config.verifyDownloads and self.extractor == None:
+            self.thread = threading.Thread(target=self.run, name=f"checksum {self.archive_name}", daemon=True)
+            self.thread.start()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def stop(self):
+        # the download is finished (or failed): the watcher (or extractor) reads the rest of the file and stops
+        self.finished.set()
+        if self.thread != None:
+            self.thread.join()
+            self.thread = None
+        if self.extractor != None:
+            self.extractor.stop()
+
+    def follow_extractor(self, extractor):
+        # called by the extractor before it starts reading (the watcher does not start its own thread)
+        self.extractor = extractor
+
+    def update(self, data):
+
+        self.md5.update(data)
+        self.size += len(data)
+        if self.gzip_check != None:
+            self.gzip_check.update(data)
+
+    def run(self):
+
+        reader = streamUnpack.GrowingFile([self.archive_path.with_name(self.archive_name + ".incomplete"),
+                                           self.archive_path], self.finished, on_data=self.update)
+        try:
+            if reader.open():
+                self.follow(reader)
+        finally:
+            reader.close()
+
+    def follow(self, reader, zip_valid=None):
+        # reads the archive to its end (the data reaches the watcher by the on_data hook of the reader)
+        # zip_valid: result of a zip check done with the same reader (e.g. by the extractor)
+
+        try:
+            if self.check_archive and self.archive_name.endswith(".zip"):
+                if zip_valid == None:
+                    try:
+                        streamUnpack.read_zip(reader)
+                        zip_valid = True
+                    except streamUnpack.StreamingError as e:
+                        logger.warning(f"[downloadCheck] {self.archive_name}: {repr(e)}")
+                        zip_valid = False
+                self.archive_valid = zip_valid
+
+            # rest of the file (e.g. central directory of zip archives)
+            while len(reader.read(streamUnpack.chunk_size)) > 0:
+                pass
+
+            if self.gzip_check != None:
+                self.archive_valid = self.gzip_check.is_valid()
+                if self.gzip_check.error != None:
+                    logger.warning(f"[downloadCheck] {self.archive_name}: {repr(self.gzip_check.error)}")
+
+            self.complete = True
+
+        except Exception as e:
+            logger.warning(f"[downloadCheck] {self.archive_name} could not be followed while downloading: {repr(e)}")
+
+    def finish(self):
+        # results of the download, the archive is read again if it was not followed completely
+        self.stop()
+        if not self.complete or self.size != self.archive_path.stat().st_size:
+            logger.info(f"[downloadCheck] {self.archive_name} is read again for verification")
+            self.reset()
+            self.run()
+
+    def get_md5(self):
+        """Returns the MD5 checksum (hex) of the downloaded archive."""
+        self.finish()
+        return self.md5.hexdigest()
+
+    def is_archive_valid(self):
+        """Returns the result of the check of the internal checksums or None if the archive was not checked."""
+        self.finish()
+        return self.archive_valid
@@ -0,0 +1,164 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import geocropper.config as config
+import geocropper.database as database
+import geocropper.download as download
+
+import logging
+
+# get logger object
+logger = logging.getLogger('root')
+db = database.Database()
+
+# thread pools of the process by number of workers, shared by all download managers
+# (the worker threads and their database connections are reused for all downloads)
+executors = {}
+executors_lock = threading.Lock()
+
+
+def get_executor(workers):
+
+    with executors_lock:
+        key = (os.getpid(), workers)
+        if key not in executors:
+            executors[key] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="download")
+        return executors[key]
+
+
+class DownloadManager:
+    """Downloads several products at the same time with a bounded pool of worker threads.
+
+    The number of concurrent downloads per data provider (Copernicus, ASF, USGS) is limited
+    by the provider slots in the download module, so the workers beyond these limits
+    handle products of the other providers or wait.
+    The progress is printed per product together with the throughput.
+    """
+
+    def __init__(self, workers=None):
+
+        self.workers = config.downloadWorkers if workers == None else workers
+        self.lock = threading.Lock()
+        self.reset()
+
+
+    def reset(self):
+
+        with self.lock:
+            self.total = 0
+            self.finished = 0
+            self.transferred_bytes = 0
+            self.transfer_time = 0.0
+            self.start = time.perf_counter()
+
+
+    def download_tiles(self, tiles):
+        """Downloads the tiles (records of the internal database) and returns the results of download_product."""
+
+        tiles = [tile for tile in tiles if tile != None]
+
+        self.reset()
+        self.total = len(tiles)
+
+        results = list(get_executor(max(1, self.workers)).map(self.download_tile, tiles))
+
+        self.print_summary()
+
+        return results
+
+
+    def download_jobs(self, owner):
+        """Downloads the tiles of the download jobs until the job queue is empty.
+
+        Every worker claims its own jobs, so the jobs are leased only when a worker is free.
+        """
+
+        self.reset()
+        self.total = sum(row["num"] for row in db.get_job_state_counts() \
+                         if row["kind"] == "download" and row["state"] == "pending")
+
+        executor = get_executor(max(1, self.workers))
+        workers = [executor.submit(self.process_jobs, f"{owner}:{i}") for i in range(max(1, self.workers))]
+        for worker in workers:
+            worker.result()
+
+        self.print_summary()
+
+
+    def process_jobs(self, owner):
+
+        job = db.claim_job("download", owner)
+
+        while job != None:
+
+            tile = db.get_tile_by_rowid(job['targetId'])
+
+            try:
+                # the lease gets renewed while the tile is downloaded
+                with db.job_lease(job):
+                    self.download_tile(tile)
+            except Exception as e:
+                logger.error(f"Job {job['rowid']} ({job['kind']} {job['targetId']}) failed: {repr(e)}")
+                print(f"Job failed: {repr(e)}")
+                db.fail_job(job['rowid'], owner, repr(e))
+            else:
+                db.complete_job(job['rowid'], owner)
+
+            job = db.claim_job("download", owner)
+
+
+    def download_tile(self, tile):
+
+        logger.info(f"[downloadManager] start download of tile {tile['folderName']} ({tile['platform']})")
+
+        start = time.perf_counter()
+        try:
+            result = download.download_product(tile=tile, progress=self.transfer_finished)
+        finally:
+            with self.lock:
+                self.finished += 1
+                finished = self.finished
+                # retried jobs count again
+                self.total = max(self.total, finished)
+
+        if result:
+            status = "downloaded"
+        elif download.check_for_existing_big_tile_folder(tile) or download.check_for_existing_big_tile_archive(tile):
+            status = "already downloaded"
+        else:
+            status = "not downloaded (offline products get requested for retrieval)"
+
+        print(f"[{finished}/{self.total}] {tile['folderName']}: {status} ({time.perf_counter() - start:.0f} s)")
+        logger.info(f"[downloadManager] [{finished}/{self.total}] {tile['folderName']}: {status}")
+
+        return result
+
+
+    def transfer_finished(self, tile, provider, size, duration):
+
+        with self.lock:
+            self.transferred_bytes += size
+            self.transfer_time += duration
+
+        print(f"Transfer of {tile['folderName']} from {provider}: {size / 1024 ** 2:.1f} MB in {duration:.0f} s " \
+              + f"({throughput(size, duration):.2f} MB/s)")
+        logger.info(f"[downloadManager] transfer {tile['folderName']} from {provider}: {size} bytes in {duration:.1f} s")
+
+
+    def print_summary(self):
+
+        elapsed = time.perf_counter() - self.start
+
+        print(f"\nDownloads finished: {self.finished} products, {self.transferred_bytes / 1024 ** 2:.1f} MB " \
+              + f"in {elapsed:.0f} s ({throughput(self.transferred_bytes, elapsed):.2f} MB/s)")
+        logger.info(f"[downloadManager] {self.finished} products, {self.transferred_bytes} bytes in {elapsed:.1f} s " \
+                    + f"(transfer time of all workers: {self.transfer_time:.1f} s)")
+
+
+def throughput(size, duration):
+    # MB per second
+    if duration <= 0:
+        return 0.0
+    return size / 1024 ** 2 / duration
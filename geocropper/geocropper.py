@@ -1,6 +1,7 @@
 import geocropper.log as log
 from tqdm import tqdm
 import os
+import socket
 import subprocess
 import pathlib
 import shutil
@@ -18,13 +19,11 @@ from PIL import Image
 
 from geocropper.database import Database
 import geocropper.config as config
-import geocropper.sentinelWrapper as sentinelWrapper
-import geocropper.landsatWrapper as landsatWrapper
-import geocropper.asfWrapper as asfWrapper
 import geocropper.csvImport as csvImport
 import geocropper.utils as utils
 import geocropper.download as download
-import geocropper.visualSelection as visualSelection
+import geocropper.downloadManager as downloadManager
+import geocropper.searchCache as searchCache
 
 from osgeo import gdal
 # gdal library distributed by conda destroys PATH environment variable
@@ -36,7 +35,7 @@ logger = log.setup_custom_logger('main')
 db = Database()
 
 
-def import_all_csvs(delimiter=',', quotechar='"', auto_load=True):
+def import_all_csvs(delimiter=',', quotechar='"', auto_load=True, chunk_size=None):
     """Import of all CSVs
 
     Place your CSV files in the inputCSV directory defined in the config file.
@@ -53,9 +52,13 @@ def import_all_csvs(delimiter=',', quotechar='"', auto_load=True):
         Loads (download and crop) data automatically if true, 
         otherwise data gets only imported into internal database.
         Default is true.
+    chunk_size : int, optional
+        Parses the CSV files with pandas in chunks of the given number of rows.
+        Default is None (CSV files are parsed row by row).
+        In both cases all rows of a CSV file get imported within one transaction.
 
     """
-    csvImport.import_all_csvs(delimiter, quotechar, auto_load)
+    csvImport.import_all_csvs(delimiter, quotechar, auto_load, chunk_size)
 
 
 def show_satellite_data(lat, lon, date_from, date_to, platform, 
@@ -173,7 +176,7 @@ def show_satellite_data(lat, lon, date_from, date_to, platform,
 
 
 def download_satellite_data(lat, lon, date_from, date_to, platform, 
-    no_product_download=False, poi_id=0, tile_limit=0, tile_start=1, **kwargs):
+    no_product_download=False, poi_id=0, tile_limit=0, tile_start=1, products=None, **kwargs):
     """Download Sentinel tiles to directory specified in the config file.
 
     Parameters
@@ -206,9 +209,17 @@ def download_satellite_data(lat, lon, date_from, date_to, platform,
     tile_limit : int, optional
         Maximum number of tiles to be downloaded.
         Default is no limit.
+        With a tile limit (and tile_start 1) tiles known from previous searches are used without a search,
+        if there are enough of them (localTileSearch). These tiles are the earliest known tiles,
+        which may differ from the tiles of a search (the order of the search results is not defined).
     tile_start : int, optional
         A tile_start parameter greater than 1 omits the first found tiles.
         Default is 1.
+        Requests with tile_start greater than 1 are always searched,
+        since the known tiles cannot reproduce the positions of the search results.
+    products : dict, optional
+        Products already found for the request (e.g. by a batched search of the search planner).
+        If set, the search is skipped.
     cloudcoverpercentage : int, optional
         Parameter for Sentinel-2 products.
         Value between 0 and 100 for maximum cloud cover percentage.
@@ -296,10 +307,23 @@ def download_satellite_data(lat, lon, date_from, date_to, platform,
             logger.info("%s: %s" % (key, str(value)))      
     
     
+    # known tiles are used without a search, if they are enough for the tile limit
+    # the known tiles may be incomplete, so only "any tile_limit matching tiles" can be answered locally:
+    # without tile limit all tiles are required and with tile_start > 1 the skipped tiles depend on the search,
+    # so only a search can answer these requests
+
+    if products == None and tile_limit > 0 and tile_start == 1:
+        local_tiles = download.find_local_tiles(lat, lon, date_from, date_to, platform, **kwargs)
+        if len(local_tiles) >= tile_limit:
+            print("Tiles found in local database.")
+            logger.info("Tiles found in local database.")
+            products = {tile["productId"]: dict(tile) for tile in local_tiles[:tile_limit]}
+
     # search for sentinel data
     
-    products = download.search_satellite_products(lat, lon, date_from, date_to, platform, 
-        tile_limit=tile_limit, tile_start=tile_start, **kwargs)
+    if products == None:
+        products = download.search_satellite_products(lat, lon, date_from, date_to, platform, 
+            tile_limit=tile_limit, tile_start=tile_start, **kwargs)
 
     if products != None and len(products) > 0:
 
@@ -335,10 +359,9 @@ def download_satellite_data(lat, lon, date_from, date_to, platform,
             print("Download")
             print("-----------------\n")
 
-            for i, (key, item) in enumerate(products.items()):
-
-                tile = db.get_tile(product_id = key)
-                download.download_product(tile=tile)
+            # products are downloaded concurrently
+            manager = downloadManager.DownloadManager()
+            manager.download_tiles([db.get_tile(product_id = key) for key in products])
 
     else:
 
@@ -348,7 +371,7 @@ def download_satellite_data(lat, lon, date_from, date_to, platform,
 
 
 def download_and_crop(lat, lon, groupname, date_from, date_to, platform, width, height, 
-                      description = "", tile_limit = 0, tile_start=1, auto_crop=True, **kwargs):
+                      description = "", tile_limit = 0, tile_start=1, auto_crop=True, products=None, **kwargs):
     """Download and crop/clip Sentinel or Landsat tiles to directories specified in the config file.
 
     Parameters
@@ -383,6 +406,9 @@ def download_and_crop(lat, lon, groupname, date_from, date_to, platform, width,
     auto_crop: boolean, optional
         Crops tile immediately, if true. Otherwise an outstanding crop will be added to the database only.
         Default is true.
+    products : dict, optional
+        Products already found for the request (e.g. by a batched search of the search planner).
+        If set, the search is skipped.
     cloudcoverpercentage : int, optional
         Value between 0 and 100 for maximum cloud cover percentage.
     producttype : str, optional
@@ -443,10 +469,8 @@ def download_and_crop(lat, lon, groupname, date_from, date_to, platform, width,
 
     # search and download tiles
 
-    products = None
-
     products = download_satellite_data(lat, lon, date_from, date_to, platform, 
-        poi_id=poi_id, tile_limit=tile_limit, tile_start=tile_start, **kwargs)
+        poi_id=poi_id, tile_limit=tile_limit, tile_start=tile_start, products=products, **kwargs)
 
     # if tiles found, crop them
 
@@ -462,50 +486,157 @@ def download_and_crop(lat, lon, groupname, date_from, date_to, platform, width,
 
 
 def download_and_crop_outstanding():
+    """Downloads requested tiles and crops outstanding points.
+
+    The work is distributed by the job queue in the database,
+    so any number of processes can run this function at the same time.
+    """
 
     print("\nStart requested downloads:")
     print("--------------------------------")
 
-    tiles = db.get_requested_tiles()
+    db.enqueue_jobs("download")
 
-    if not tiles == None:
+    # the workers of the download manager claim the download jobs concurrently
+    manager = downloadManager.DownloadManager()
+    manager.download_jobs(get_job_owner())
 
-        for tile in tiles:
+    # crop outstanding points                    
 
-            print(f"\nPlatform: {tile['platform']}")
-            print(f"Tile: {tile['folderName']}")
-            print(f"Product ID: {tile['productId']}")            
-            print(f"First download request: {utils.convert_date(tile['firstDownloadRequest'], new_format='%Y-%m-%d %H:%M:%S')}")
-            if tile['lastDownloadRequest'] == None:
-                print(f"Last download request: None\n")
-            else:
-                print(f"Last download request: {utils.convert_date(tile['lastDownloadRequest'], new_format='%Y-%m-%d %H:%M:%S')}\n")
+    crop_outstanding()
 
-            download.download_product(tile=tile)
 
-    # crop outstanding points                    
+def retrieve_offline_products(hours=None):
+    """Downloads requested Sentinel tiles as soon as they are online and requests the retrieval of offline tiles.
 
-    pois = db.get_uncropped_pois_for_unpacked_tiles()
+    Offline products are retrieved from the long term archive (LTA) of Copernicus.
+    The number of requests is limited by ltaMaxPendingRequests, copernicusRequestDelay
+    and copernicusRepeatRequestAfterMin. Outstanding points get cropped after the downloads.
 
-    if not pois == None:
+    Parameters
+    ----------
+    hours : float, optional
+        The tiles are checked every ltaPollMinutes until all tiles are downloaded or the hours have passed.
+        Default is None (the tiles are checked once).
 
-        print("\nCrop outstanding points:")
-        print("------------------------------")
+    """
 
-        for poi in pois:
+    print("\nRetrieve offline products:")
+    print("--------------------------------")
 
-            if poi['tileCropped'] == None and poi['cancelled'] == None:
+    import geocropper.ltaScheduler as ltaScheduler
+
+    scheduler = ltaScheduler.LtaScheduler()
+    if scheduler.run(hours) > 0:
+        crop_outstanding()
+
+
+def get_job_owner():
+    # identifies the process leasing jobs
+    return f"{socket.gethostname()}:{os.getpid()}"
 
-                print(f"Crop outstanding point: lat:{poi['lat']} lon:{poi['lon']} \
-                        groupname:{poi['groupname']} width:{poi['width']} height:{poi['height']}")
-                utils.crop_tiles(poi['rowid'])
-    
-        print("\nCropped all outstanding points!")
+
+def run_job(job, function, *args, **kwargs):
+    # runs the function for a claimed job and updates the job state
+    # failed jobs are retried by the next claim until jobMaxAttempts is reached
+    # the lease of the job gets renewed while the function runs
+    try:
+        with db.job_lease(job):
+            function(*args, **kwargs)
+    except Exception as e:
+        logger.error(f"Job {job['rowid']} ({job['kind']} {job['targetId']}) failed: {repr(e)}")
+        print(f"Job failed: {repr(e)}")
+        db.fail_job(job['rowid'], job['leaseOwner'], repr(e))
+    else:
+        db.complete_job(job['rowid'], job['leaseOwner'])
+
+
+def reset_dead_jobs(kind=None):
+    """Resets jobs which failed too often (dead state), so they get processed again.
+
+    Parameters
+    ----------
+    kind : str, optional
+        'download' or 'crop', default are all jobs.
+
+    """
+    counter = db.reset_dead_jobs(kind)
+    print(f"{counter} dead jobs reseted.")
+
+
+def clear_search_cache(expired_only=False):
+    """Removes cached search responses, so the next searches query the APIs again.
+
+    Parameters
+    ----------
+    expired_only : boolean, optional
+        If true, only expired responses are removed.
+        Default is false (all responses).
+
+    """
+    counter = searchCache.clear(expired_only)
+    print(f"{counter} cached search responses removed.")
 
 
 def get_number_of_outstanding_crops():
-    pois = db.get_uncropped_pois_for_unpacked_tiles()
-    return(len(pois))
+    return db.count_outstanding_crops()
+
+
+def status(days=7, print_status=True):
+    """Summary of outstanding crops, tiles, crops per day and jobs.
+
+    All numbers are aggregated in the database, so the function is cheap enough for frequent polling.
+
+    Parameters
+    ----------
+    days : int, optional
+        Number of days for the cropped images per day.
+        Default is 7, None returns all days.
+    print_status : boolean, optional
+        Prints the summary.
+        Default is True.
+
+    Returns
+    -------
+    dict
+        outstandingCrops: number of outstanding crops
+        outstandingCropsPerGroup: list of (groupname, platform, number)
+        tiles: list of (platform, state, number), states: requested, offline, online, downloaded, unpacked, cancelled
+        cropsPerDay: list of (day, number)
+        jobs: list of (kind, state, number)
+
+    """
+
+    result = {
+        "outstandingCrops":         db.count_outstanding_crops(),
+        "outstandingCropsPerGroup": [tuple(row) for row in db.get_outstanding_crops_per_group()],
+        "tiles":                    [tuple(row) for row in db.get_tile_state_counts()],
+        "cropsPerDay":              [tuple(row) for row in db.get_crops_per_day(days)],
+        "jobs":                     [tuple(row) for row in db.get_job_state_counts()]
+    }
+
+    if print_status:
+
+        print("\nStatus:")
+        print("-------")
+
+        print(f"\nOutstanding crops: {result['outstandingCrops']}")
+        for groupname, platform, number in result["outstandingCropsPerGroup"]:
+            print(f"  {groupname} ({platform}): {number}")
+
+        print("\nTiles:")
+        for platform, state, number in result["tiles"]:
+            print(f"  {platform} {state}: {number}")
+
+        print("\nCrops per day:")
+        for day, number in result["cropsPerDay"]:
+            print(f"  {day}: {number}")
+
+        print("\nJobs:")
+        for kind, state, number in result["jobs"]:
+            print(f"  {kind} {state}: {number}")
+
+    return result
 
 
 def reset_cancelled_crops():
@@ -526,22 +657,12 @@ def cancel_individual_crops(csv_file):
 
     if csv_file.exists():
 
-        counter = 0
-
         col_list = ["lon", "lat"]
         data = pandas.read_csv(csv_file, usecols=col_list, dtype=str)
-        
-        for i in range(len(data)):
 
-            lon = str(data["lon"][i])
-            lat = str(data["lat"][i]) 
-            lon, lat = utils.reduce_coordinate_digits(lon, lat)
-
-            pois = db.get_pois_for_coordinates(lat, lon)
-            for poi in pois:
-                poi_id = poi["rowid"]                   
-                db.set_cancelled_tile_for_poi(poi_id)
-                counter = counter + 1
+        # coordinates are matched by their truncated decimals (see coordinateDecimalsForComparison)
+        # all crops get updated with one statement
+        counter = db.set_cancelled_tiles_for_coordinates(list(zip(data["lat"], data["lon"])))
 
         print(f"{counter} individual crops cancelled.")
 
@@ -557,22 +678,12 @@ def reset_individual_cancelled_crops(csv_file):
 
     if csv_file.exists():
 
-        counter = 0
-
         col_list = ["lon", "lat"]
         data = pandas.read_csv(csv_file, usecols=col_list, dtype=str)
-        
-        for i in range(len(data)):
 
-            lon = str(data["lon"][i])
-            lat = str(data["lat"][i]) 
-            lon, lat = utils.reduce_coordinate_digits(lon, lat)
-
-            pois = db.get_pois_for_coordinates(lat, lon)
-            for poi in pois:
-                poi_id = poi["rowid"]              
-                db.reset_cancelled_tile_for_poi(poi_id)
-                counter = counter + 1
+        # coordinates are matched by their truncated decimals (see coordinateDecimalsForComparison)
+        # all crops get updated with one statement
+        counter = db.reset_cancelled_tiles_for_coordinates(list(zip(data["lat"], data["lon"])))
 
         print(f"{counter} individual crops reseted.")
 
@@ -581,55 +692,59 @@ def reset_individual_cancelled_crops(csv_file):
     
 
 def crop_outstanding(lower_boundary=None, upper_boundary=None):
-    """Crops outstanding images. To easily run multiple processes boundaries can be set.
+    """Crops outstanding images.
+
+    The outstanding points are distributed by the job queue in the database,
+    so any number of processes can run this function at the same time.
+    Boundaries are not needed anymore to split the work, if set
+    the process crops at most upper_boundary - lower_boundary points.
     """
 
     logger.info(f"Start of crop outstanding images lower_boundary:{lower_boundary} upper_boundary:{upper_boundary}")
 
     print("\nCropping outstanding images:")
     print("----------------------------\n")
-    print(f"lower_boundary: {lower_boundary}")
-    print(f"upper_boundary: {upper_boundary}\n")
 
-    # get uncropped locations
-    pois = db.get_uncropped_pois_for_unpacked_tiles()
+    max_jobs = None
+    if upper_boundary != None and upper_boundary > 0:
+        max_jobs = upper_boundary - (lower_boundary if lower_boundary != None else 0)
+        print(f"max number of points: {max_jobs}\n")
 
-    if upper_boundary != None and upper_boundary > 0 and len(pois) > upper_boundary:
-        pois = pois[0:upper_boundary]
-
-    if lower_boundary != None and lower_boundary > 0:
-        if len(pois) > lower_boundary:
-            pois = pois[lower_boundary:]
-        else:
-            print("Lower boundary higher than number of elements left")
-            logger.warning("Lower boundary higher than number of uncropped elements left")
-            exit()
+    db.enqueue_jobs("crop")
 
     # index i serves as a counter
     i = 0    
 
-    for poi in pois:
+    while max_jobs == None or i < max_jobs:
+
+        job = db.claim_job("crop", get_job_owner())
+
+        if job == None:
+            break
 
         i += 1
 
-        print("\n############################################################")
-        print("\n[ Crop outstanding pois... %d/%d ]" % (i, len(pois)))
-        logger.info("[ ##### Crop outstanding pois... %d/%d ##### ]" % (i, len(pois)))
-        if lower_boundary != None or upper_boundary != None:
-            print(f"\n[ Boundaries: {lower_boundary}:{upper_boundary} ]")
-            logger.info(f"\n[ Boundaries: {lower_boundary}:{upper_boundary} ]")
+        poi = db.get_poi_from_id(job['targetId'])
 
-        if poi['tileCropped'] == None and poi['cancelled'] == None:
+        print("\n############################################################")
+        print("\n[ Crop outstanding pois... %d ]" % i)
+        logger.info("[ ##### Crop outstanding pois... %d (job %s) ##### ]" % (i, job['rowid']))
 
-            print(f"Crop outstanding point: lat:{poi['lat']} lon:{poi['lon']} \
-                    groupname:{poi['groupname']} width:{poi['width']} height:{poi['height']}")
-            utils.crop_tiles(poi['rowid'])
+        print(f"Crop outstanding point: lat:{poi['lat']} lon:{poi['lon']} \
+                groupname:{poi['groupname']} width:{poi['width']} height:{poi['height']}")
+        run_job(job, utils.crop_tiles, poi['rowid'])
 
-    print(f"\nCropped all outstanding points! (lower_boundary:{lower_boundary} upper_boundary:{upper_boundary})")            
+    print(f"\nCropped all outstanding points! ({i} points)")            
 
 
-def unpack_big_tiles():
+def unpack_big_tiles(workers=1):
     """Unpacks all big tile archives in big tile directory
+
+    Parameters
+    ----------
+    workers : int, optional
+        Number of worker processes, each process unpacks one archive at a time.
+        Default is 1 (the archives are unpacked one after another).
     """
 
     logger.info("start of unpacking tile zip/tar files")
@@ -637,22 +752,21 @@ def unpack_big_tiles():
     print("\nUnpack big tiles:")
     print("-----------------\n")
 
-    # determine number of zip files        
-    files_num_zip = len([f for f in os.listdir(config.bigTilesDir) 
-         if f.endswith('.zip') and os.path.isfile(os.path.join(config.bigTilesDir, f))])
+    # packed files (the directory is listed once)
+    file_names = [f for f in os.listdir(config.bigTilesDir) 
+         if (f.endswith('.zip') or f.endswith('.tar.gz')) and os.path.isfile(os.path.join(config.bigTilesDir, f))]
 
-    # determine number of tar files
-    files_num_tar = len([f for f in os.listdir(config.bigTilesDir) 
-         if f.endswith('.tar.gz') and os.path.isfile(os.path.join(config.bigTilesDir, f))])
-
-    # calculate number of total packed files
-    files_num = files_num_zip + files_num_tar
+    print(f"{len(file_names)} packed files found.\n")
 
     # start unpacking
 
-    for item in os.listdir(config.bigTilesDir):
+    if workers > 1 and len(file_names) > 1:
+
+        utils.unpack_big_tiles_in_processes(file_names, min(workers, len(file_names)))
+
+    else:
 
-        if item.endswith(".zip") or item.endswith(".tar.gz"):
+        for item in file_names:
             utils.unpack_big_tile(item)
 
     logger.info("tile zip/tar files extracted")        
@@ -788,6 +902,8 @@ def filter_and_move_crops(crops_path, output_path, lower_boundaries=None, upper_
 
 
 def visual_selection(path, gap=config.previewBorder, image_start=1):
+    # opencv is only loaded for the visual selection
+    import geocropper.visualSelection as visualSelection
     visualSelection.start_visual_selection(path, gap, image_start)
 
 
@@ -0,0 +1,103 @@
+import time
+
+import geocropper.config as config
+import geocropper.database as database
+import geocropper.download as download
+import geocropper.downloadManager as downloadManager
+
+import logging
+
+# get logger object
+logger = logging.getLogger('root')
+db = database.Database()
+
+
+# offline Sentinel products have to be retrieved from the long term archive (LTA) before they can be downloaded
+# the scheduler keeps track of all requested tiles which are not yet downloaded (see Database.get_retrieval_queue):
+# it checks in batches which products are online, downloads them and requests the retrieval of the offline products
+
+
+class LtaScheduler:
+    """Requests offline products and downloads them as soon as they are online.
+
+    Retrieval requests respect copernicusRequestDelay, copernicusRepeatRequestAfterMin
+    and ltaMaxPendingRequests (see download.request_retrieval).
+    """
+
+    def __init__(self, sentinel=None, manager=None):
+
+        if sentinel == None:
+            import geocropper.sentinelWrapper as sentinelWrapper
+            sentinel = sentinelWrapper.SentinelWrapper()
+
+        self.sentinel = sentinel
+        self.manager = downloadManager.DownloadManager() if manager == None else manager
+
+
+    def run(self, hours=None):
+        """Runs the scheduler every ltaPollMinutes until all tiles are downloaded or the hours have passed.
+
+        Without hours the tiles are checked once (e.g. for runs by cron).
+        Returns the number of downloaded tiles.
+        """
+
+        start = time.time()
+        downloaded = 0
+
+        while True:
+
+            result = self.run_once()
+            downloaded += result["downloaded"]
+
+            if hours == None or result["waiting"] == 0:
+                break
+
+            if time.time() - start + 60 * config.ltaPollMinutes > hours * 3600:
+                break
+
+            print(f"Next check in {config.ltaPollMinutes} minutes.")
+            time.sleep(60 * config.ltaPollMinutes)
+
+        return downloaded
+
+
+    def run_once(self):
+        """Checks all tiles of the retrieval queue once.
+
+        Returns a dictionary with the number of downloaded tiles, sent requests and tiles which are still waiting.
+        """
+
+        tiles = db.get_retrieval_queue()
+
+        online = []
+        offline = []
+
+        # online states in batches
+        for i in range(0, len(tiles), config.ltaOnlineCheckBatch):
+
+            batch = tiles[i:i + config.ltaOnlineCheckBatch]
+            states = self.sentinel.get_online_states([tile['productId'] for tile in batch])
+
+            for tile in batch:
+                if states.get(tile['productId']) == True:
+                    db.set_tile_online(tile['rowid'])
+                    online.append(tile)
+                elif states.get(tile['productId']) == False:
+                    offline.append(tile)
+
+        # requests first, so the retrieval starts while the online tiles are downloaded
+        requested = 0
+        for tile in offline:
+            if download.request_retrieval(tile, self.sentinel):
+                requested += 1
+
+        downloaded = 0
+        if len(online) > 0:
+            downloaded = len([result for result in self.manager.download_tiles(online) if result])
+
+        print(f"Offline products: {len(tiles)} tiles checked, {len(online)} online, {len(offline)} offline, " \
+              + f"{requested} retrievals requested, {downloaded} tiles downloaded.")
+        logger.info(f"[ltaScheduler] checked: {len(tiles)} online: {len(online)} offline: {len(offline)} " \
+                    + f"requested: {requested} downloaded: {downloaded}")
+
+        return {"downloaded": downloaded, "requested": requested, "waiting": len(tiles) - downloaded}
@@ -0,0 +1,96 @@
+import datetime
+import hashlib
+import json
+import pickle
+
+import geocropper.config as config
+import geocropper.database as database
+import geocropper.utils as utils
+
+import logging
+
+# get logger object
+logger = logging.getLogger('root')
+db = database.Database()
+
+
+# search responses of the Copernicus and USGS APIs are stored in the database, keyed by the normalized query
+# responses expire after searchCacheHours, responses for date ranges which ended
+# more than searchCachePermanentAfterDays ago do not expire (no new products are expected for them)
+
+
+def normalize_query(query):
+    """Returns the query (dictionary of search parameters) as canonical JSON text.
+
+    Dates are converted to %Y%m%d, coordinates to floats, unset parameters are left out
+    and all other values are compared as text.
+    """
+
+    normalized = {}
+
+    for key, value in query.items():
+        if value == None or (isinstance(value, str) and len(value) == 0):
+            continue
+        if key in ["date_from", "date_to"]:
+            value = utils.convert_date(str(value), "%Y%m%d")
+        elif key in ["lat", "lon"]:
+            value = repr(float(value))
+        else:
+            value = str(value)
+        normalized[key] = value
+
+    return json.dumps(normalized, sort_keys=True)
+
+
+def get_query_hash(query_text):
+    return hashlib.sha1(query_text.encode("utf-8")).hexdigest()
+
+
+def get_expiry_hours(query):
+    # hours until the response expires, None if it does not expire
+    if config.searchCachePermanentAfterDays > 0 and query.get("date_to") != None:
+        date_to = datetime.datetime.strptime(utils.convert_date(str(query["date_to"]), "%Y%m%d"), "%Y%m%d")
+        if (datetime.datetime.now() - date_to).days > config.searchCachePermanentAfterDays:
+            return None
+    return config.searchCacheHours
+
+
+def cached_search(query, search_function):
+    """Returns the cached response for the query or calls the search function and caches its response.
+
+    Parameters
+    ----------
+    query : dict
+        Search parameters, including the name of the API function (e.g. 'function', 'platform', 'date_to').
+    search_function : function
+        Called without arguments if there is no valid cached response.
+        A response of None (failed search) is not cached.
+    """
+
+    if config.searchCacheHours <= 0:
+        return search_function()
+
+    query_text = normalize_query(query)
+    query_hash = get_query_hash(query_text)
+
+    entry = db.get_search_cache_entry(query_hash)
+
+    if entry != None:
+        try:
+            response = pickle.loads(entry["response"])
+            logger.info(f"[searchCache] cached response used: {query_text}")
+            return response
+        except Exception as e:
+            logger.warning(f"[searchCache] cached response could not be loaded: {repr(e)}")
+
+    response = search_function()
+
+    if response != None:
+        db.set_search_cache_entry(query_hash, query_text, pickle.dumps(response), get_expiry_hours(query))
+
+    return response
+
+
+def clear(expired_only=False):
+    """Removes the cached search responses (all or only the expired ones) and returns their number."""
+    return db.clear_search_cache(expired_only)
@@ -0,0 +1,151 @@
+import collections
+import math
+
+import geocropper.config as config
+import geocropper.utils as utils
+import geocropper.searchCache as searchCache
+
+import logging
+
+# get logger object
+logger = logging.getLogger('root')
+
+
+# the planner groups POIs (imported csv rows) with the same query parameters,
+# so one catalogue query with the bounding box of the points replaces one query per point
+# the found products are assigned back to the points by their footprints
+
+
+class SearchBatch:
+    """POIs with the same query parameters, searched with one query.
+
+    All points of a batch lie in one grid cell of searchMaxBboxDegrees,
+    so the bounding box of the query stays small.
+    """
+
+    def __init__(self, platform, date_from, date_to, kwargs, items):
+        self.platform = platform
+        self.date_from = date_from
+        self.date_to = date_to
+        self.kwargs = kwargs
+        self.items = items
+
+    def footprint(self):
+        """Returns the bounding box of the points as WKT polygon."""
+
+        # a small margin avoids a degenerated polygon for a single point or points on a line
+        margin = 0.0001
+        min_lat = min(float(item["lat"]) for item in self.items) - margin
+        max_lat = max(float(item["lat"]) for item in self.items) + margin
+        min_lon = min(float(item["lon"]) for item in self.items) - margin
+        max_lon = max(float(item["lon"]) for item in self.items) + margin
+
+        return f"POLYGON(({min_lon} {min_lat}, {max_lon} {min_lat}, {max_lon} {max_lat}, " \
+            + f"{min_lon} {max_lat}, {min_lon} {min_lat}))"
+
+
+def is_batchable(item):
+    # batched searches are supported by the Copernicus API only
+    return item["platform"] != None and item["platform"].lower().startswith("sentinel")
+
+
+def get_query_kwargs(item):
+    # optional query parameters of an imported csv row
+    return {key: item[key] for key in config.optionalSentinelParameters if key in item.keys() and item[key] != None}
+
+
+def plan_searches(items):
+    """Groups the items (imported csv rows) by query parameters and location.
+
+    Returns a list of SearchBatch objects.
+    The batches are split by grid cells of searchMaxBboxDegrees and by searchMaxPoisPerQuery.
+    Rows with invalid coordinates or dates are left out.
+    """
+
+    groups = collections.OrderedDict()
+
+    for item in items:
+
+        kwargs = get_query_kwargs(item)
+        try:
+            cell = (math.floor(float(item["lat"]) / config.searchMaxBboxDegrees),
+                    math.floor(float(item["lon"]) / config.searchMaxBboxDegrees))
+            key = (item["platform"], utils.convert_date(item["dateFrom"], "%Y%m%d"),
+                   utils.convert_date(item["dateTo"], "%Y%m%d"), tuple(sorted(kwargs.items())), cell)
+        except (TypeError, ValueError, OverflowError) as e:
+            # invalid rows are not batched, the error shows up in the individual search
+            logger.warning(f"[searchPlanner] row {item['rowid']} not batched: {repr(e)}")
+            continue
+
+        groups.setdefault(key, []).append(item)
+
+    batches = []
+
+    for (platform, date_from, date_to, kwargs, cell), group in groups.items():
+        for i in range(0, len(group), config.searchMaxPoisPerQuery):
+            batches.append(SearchBatch(platform, date_from, date_to, dict(kwargs),
+                                       group[i:i + config.searchMaxPoisPerQuery]))
+
+    logger.info(f"[searchPlanner] {len(batches)} queries planned for {sum(len(group) for group in groups.values())} POIs")
+
+    return batches
+
+
+def search_batch(batch, sentinel=None):
+    """Searches the products of a batch with one query.
+
+    Returns a dictionary with the rowid of every item as key and the products found for the item as value.
+    """
+
+    footprint = batch.footprint()
+
+    def search():
+        api = sentinel
+        if api == None:
+            import geocropper.sentinelWrapper as sentinelWrapper
+            api = sentinelWrapper.SentinelWrapper()
+        return api.get_sentinel_products_for_footprint(footprint, batch.date_from, batch.date_to,
+                                                       batch.platform, **batch.kwargs)
+
+    query = {"function": "get_sentinel_products_for_footprint", "footprint": footprint, "date_from": batch.date_from,
+             "date_to": batch.date_to, "platform": batch.platform, **batch.kwargs}
+    products = searchCache.cached_search(query, search)
+
+    return assign_products(batch.items, products)
+
+
+def assign_products(items, products):
+    """Assigns the products to the items whose point lies within the footprint of the product.
+
+    The order of the products is kept, so tileLimit and tileStart select the same products
+    as a query for the single point.
+    """
+
+    from shapely import wkt
+    from shapely.geometry import Point
+    from shapely.prepared import prep
+
+    footprints = []
+    for key, product in products.items():
+        if product.get("footprint") == None:
+            logger.warning(f"[searchPlanner] product without footprint: {key}")
+            continue
+        footprints.append((key, prep(wkt.loads(product["footprint"]))))
+
+    assigned = {}
+
+    for item in items:
+
+        point = Point(float(item["lon"]), float(item["lat"]))
+        keys = [key for key, footprint in footprints if footprint.intersects(point)]
+
+        tile_limit = item["tileLimit"] if "tileLimit" in item.keys() and item["tileLimit"] != None else 0
+        tile_start = item["tileStart"] if "tileStart" in item.keys() and item["tileStart"] != None else 1
+        if int(tile_limit) > 0:
+            keys = keys[:int(tile_limit)]
+        if int(tile_start) > 1:
+            keys = keys[int(tile_start) - 1:]
+
+        assigned[item["rowid"]] = collections.OrderedDict((key, products[key]) for key in keys)
+
+    return assigned
@@ -27,11 +27,17 @@ class SentinelWrapper:
 
     def get_sentinel_products(self, lat, lon, date_from, date_to, platform, **kwargs):
         
-        logger.info("start sentinel query")
-
         # convert geolocation coordinates to wkt format
         footprint = geojson_to_wkt(Point((lon, lat)))
+
+        return self.get_sentinel_products_for_footprint(footprint, date_from, date_to, platform, **kwargs)
+
+
+    # search query for any footprint (wkt), e.g. the bounding box of several points
+    def get_sentinel_products_for_footprint(self, footprint, date_from, date_to, platform, **kwargs):
         
+        logger.info("start sentinel query")
+
         # prepare parameter for cloud coverage
         if "cloudcoverpercentage" in kwargs:
             kwargs["cloudcoverpercentage"] = (0, kwargs["cloudcoverpercentage"])
@@ -80,12 +86,12 @@ class SentinelWrapper:
         for attempt in range(1, config.serverFailureRequestRepeats + 1):
             try:           
                 logger.info("start downloading sentinel product")
-                product_info = self.api.download(product_id, config.bigTilesDir)
+                # if downloads are verified, the checksum is computed while downloading (see downloadCheck)
+                product_info = self.api.download(product_id, config.bigTilesDir, checksum=not config.verifyDownloads)
                 if not product_info["Online"]:
                     logger.info("archived download triggered")
                     return False
                 else:
-                    # TODO: Download should be checked
                     logger.info("download complete")
                     return True
             except SentinelAPIError as e:
@@ -99,6 +105,13 @@ class SentinelWrapper:
                     logger.info("Last attempt to connect to Sentinel server failed. Aborting.")  
 
 
+    def get_product_md5(self, product_id):
+        # MD5 checksum of the product archive published in the OData of the product
+        product_info = self.get_product_data(product_id)
+        if product_info != None:
+            return product_info.get("md5")
+
+
     def get_product_data(self, product_id):
         for attempt in range(1, config.serverFailureRequestRepeats + 1):
             try:        
@@ -129,6 +142,23 @@ class SentinelWrapper:
                     logger.info("Last attempt to connect to Sentinel server failed. Aborting.") 
 
 
+    def get_online_states(self, product_ids):
+        """Returns a dictionary with the product IDs as keys and True (online) or False (offline) as values.
+
+        The products are checked with one OData query, if the query fails they are checked one after another.
+        """
+        filter_query = " or ".join(f"Id eq '{product_id}'" for product_id in product_ids)
+        try:
+            response = self.api.session.get(self.api.api_url + "odata/v1/Products", 
+                params={"$filter": filter_query, "$select": "Id,Online", "$format": "json", "$top": len(product_ids)},
+                timeout=getattr(self.api, "timeout", None))
+            response.raise_for_status()
+            return {item["Id"]: item["Online"] in [True, "true"] for item in response.json()["d"]["results"]}
+        except Exception as e:
+            logger.warning(f"batched online check failed: {repr(e)}")
+            return {product_id: self.ready_for_download(product_id) for product_id in product_ids}
+
+
     def request_offline_tile(self, last_tile_download_request, product_id):
 
         # check if last request not within request delay
@@ -0,0 +1,359 @@
+import os
+import shutil
+import struct
+import threading
+import zipfile
+import zlib
+
+import geocropper.config as config
+import geocropper.utils as utils
+
+import logging
+
+# get logger object
+logger = logging.getLogger('root')
+
+
+# zip archives of Sentinel products are extracted while they are downloaded:
+# the extractor follows the growing file on disk (the API wrappers write the archive themselves)
+# and extracts every member as soon as its data has arrived, using the local headers of the zip format
+# the extracted members are moved to the big tiles folder after the download is complete,
+# so the archive does not have to be read again
+# a checksum watcher (see downloadCheck.ChecksumWatcher) gets the data read by the extractor
+
+# seconds to wait for new data of the growing file
+poll_interval = 1.0
+
+# size of the chunks read from the archive
+chunk_size = 1024 * 1024
+
+local_header = struct.Struct("<HHHHHIIIHH")
+
+local_header_signature = b"PK\x03\x04"
+data_descriptor_signature = b"PK\x07\x08"
+# signatures of the records following the last member (central directory, zip64 end of central directory, ...)
+end_signatures = [b"PK\x01\x02", b"PK\x05\x05", b"PK\x05\x06", b"PK\x06\x06", b"PK\x06\x07", b"PK\x06\x08"]
+
+
+class StreamingError(Exception):
+    pass
+
+
+class GrowingFile:
+    """Read-only file object for an archive which is still being downloaded.
+
+    Reads wait for new data until the download is finished.
+    The archive may be written under one of several names (e.g. with the ending .incomplete).
+    The file is read from its beginning, so downloads continued from an existing file are read completely.
+    """
+
+    def __init__(self, paths, finished, on_data=None):
+        self.paths = paths
+        self.finished = finished
+        # called with all data read from the file (e.g. to compute a checksum)
+        self.on_data = on_data
+        self.file = None
+        self.buffer = b""
+
+    def open(self):
+
+        while self.file == None:
+            # the download may rename the file, so the check after the end of the download is done once more
+            done = self.finished.is_set()
+            for path in self.paths:
+                try:
+                    # unbuffered, so new data gets read after reaching the current end of the file
+                    self.file = open(path, "rb", buffering=0)
+                    return True
+                except FileNotFoundError:
+                    pass
+            if done:
+                return False
+            self.finished.wait(poll_interval)
+
+        return True
+
+    def close(self):
+        if self.file != None:
+            self.file.close()
+
+    def unread(self, data):
+        # data read ahead (e.g. behind the end of a deflate stream)
+        self.buffer = data + self.buffer
+
+    def read(self, size):
+        # returns up to size bytes, an empty result only at the end of the finished download
+        if len(self.buffer) > 0:
+            data = self.buffer[:size]
+            self.buffer = self.buffer[size:]
+            return data
+
+        while True:
+            done = self.finished.is_set()
+            data = self.file.read(size)
+            if len(data) > 0 and self.on_data != None:
+                self.on_data(data)
+            if len(data) > 0 or done:
+                return data
+            self.finished.wait(poll_interval)
+
+    def read_exactly(self, size):
+        chunks = []
+        while size > 0:
+            data = self.read(size)
+            if len(data) == 0:
+                raise StreamingError("unexpected end of archive")
+            chunks.append(data)
+            size -= len(data)
+        return b"".join(chunks)
+
+
+class StreamExtractor:
+    """Extracts a zip archive in a thread while the archive is being downloaded.
+
+    Used as context manager around the download (only active if streamingUnpack is set).
+    The members are extracted to a staging folder, install moves them to the big tiles folder.
+    If the archive cannot be extracted while downloading (e.g. unsupported format or failed download),
+    nothing gets installed and the archive is unpacked as usual after the download.
+    If a checksum watcher is given, it gets all data of the archive read by the extractor.
+    """
+
+    def __init__(self, tile, archive_name, watcher=None):
+
+        self.tile = tile
+        self.watcher = watcher
+        self.archive_name = archive_name
+        self.archive_path = config.bigTilesDir / archive_name
+        self.staging_dir = config.bigTilesDir / ".streaming" / archive_name
+        self.finished = threading.Event()
+        self.thread = None
+        self.complete = False
+        self.members = 0
+
+    def __enter__(self):
+
+        if config.streamingUnpack and not config.keepArchivesPacked and self.archive_name.endswith(".zip"):
+            shutil.rmtree(self.staging_dir, ignore_errors=True)
+            self.staging_dir.mkdir(parents=True)
+            if self.watcher != None and config.verifyDownloads:
+                self.watcher.follow_extractor(self)
+            else:
+                self.watcher = None
+            self.thread = threading.Thread(target=self.run, name=f"unpack {self.archive_name}", daemon=True)
+            self.thread.start()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.stop()
+        # remaining staging folder of an incomplete or failed download
+        if self.thread != None:
+            shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+    def stop(self):
+        # the download is finished (or failed): the extractor reads the rest of the file and stops
+        self.finished.set()
+        if self.thread != None:
+            self.thread.join()
+
+    def run(self):
+
+        reader = GrowingFile([self.archive_path.with_name(self.archive_name + ".incomplete"), self.archive_path],
+                             self.finished, on_data=None if self.watcher == None else self.watcher.update)
+        try:
+            if reader.open():
+
+                # result of the checksums of the members for the watcher (None: not checked completely)
+                zip_valid = None
+                try:
+                    self.extract(reader)
+                    self.complete = True
+                    zip_valid = True
+                    logger.info(f"[streamUnpack] {self.members} members of {self.archive_name} extracted while downloading")
+                except Exception as e:
+                    logger.warning(f"[streamUnpack] {self.archive_name} not extracted while downloading " \
+                                   + f"(unpacked after the download): {repr(e)}")
+                    if isinstance(e, StreamingError):
+                        zip_valid = False
+
+                # the watcher reads the rest of the archive with the same reader,
+                # otherwise it reads the archive again after the download
+                if self.watcher != None and zip_valid != None:
+                    self.watcher.follow(reader, zip_valid)
+        except Exception as e:
+            logger.warning(f"[streamUnpack] {self.archive_name} could not be followed while downloading: {repr(e)}")
+        finally:
+            reader.close()
+
+    def extract(self, reader):
+        self.patterns = utils.get_unpack_patterns(self.tile)
+        self.members = read_zip(reader, self.open_output)
+
+    def open_output(self, name):
+        # file for the data of the member, None for members which are not extracted
+
+        # path of the member within the staging folder, unsafe paths are not extracted
+        parts = name.split("/")
+        if name.startswith("/") or ".." in parts or ":" in parts[0]:
+            logger.warning(f"[streamUnpack] member {name} of {self.archive_name} skipped")
+            return None
+
+        if not utils.is_required_member(name, self.patterns):
+            return None
+
+        target = self.staging_dir.joinpath(*[part for part in parts if part != ""])
+
+        if name.endswith("/"):
+            target.mkdir(parents=True, exist_ok=True)
+            return None
+
+        target.parent.mkdir(parents=True, exist_ok=True)
+        return open(target, "wb")
+
+    def install(self):
+        """Moves the extracted members to the big tiles folder and returns True,
+        if the archive was extracted completely while downloading.
+        """
+
+        self.stop()
+
+        if not self.complete:
+            return False
+
+        entries = list(self.staging_dir.iterdir())
+
+        # a folder of a previous unpack gets completed by the usual unpack
+        if any((config.bigTilesDir / entry.name).exists() for entry in entries):
+            logger.info(f"[streamUnpack] {self.archive_name}: target folder already exists")
+            return False
+
+        for entry in entries:
+            os.replace(entry, config.bigTilesDir / entry.name)
+
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+        return True
+
+
+def read_zip(reader, open_output=None):
+    """Reads the members of a zip archive from the reader and checks their checksums and sizes.
+
+    open_output gets called with the name of every member and returns a file for the data or None.
+    Returns the number of members written to files.
+    """
+
+    members = 0
+
+    while True:
+
+        signature = reader.read_exactly(4)
+
+        if signature in end_signatures:
+            return members
+        if signature != local_header_signature:
+            raise StreamingError(f"unexpected record {signature!r}")
+
+        version, flags, method, mod_time, mod_date, crc, compressed_size, size, name_length, extra_length = \
+            local_header.unpack(reader.read_exactly(local_header.size))
+        name = reader.read_exactly(name_length).decode("utf-8" if flags & 0x800 else "cp437")
+        extra = reader.read_exactly(extra_length)
+
+        if flags & 0x1:
+            raise StreamingError(f"encrypted member {name}")
+        if method not in [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED]:
+            raise StreamingError(f"unsupported compression method {method} of member {name}")
+
+        # the data descriptor of zip64 members contains 8 byte sizes
+        zip64_sizes = get_zip64_sizes(extra)
+        is_zip64 = zip64_sizes != None
+        if compressed_size == 0xFFFFFFFF or size == 0xFFFFFFFF:
+            if not is_zip64:
+                raise StreamingError(f"zip64 extra field of member {name} missing")
+            # the extra field contains the sizes which are set to 0xFFFFFFFF in the header (in this order)
+            if size == 0xFFFFFFFF:
+                size = zip64_sizes.pop(0)
+            if compressed_size == 0xFFFFFFFF:
+                compressed_size = zip64_sizes.pop(0)
+
+        # sizes and checksum follow the data if bit 3 is set
+        has_data_descriptor = flags & 0x8
+        if has_data_descriptor and method == zipfile.ZIP_STORED:
+            raise StreamingError(f"stored member {name} without size")
+
+        output = open_output(name) if open_output != None else None
+
+        try:
+            data_crc, data_size = copy_member(reader, method, compressed_size, has_data_descriptor, output)
+        finally:
+            if output != None:
+                output.close()
+
+        if has_data_descriptor:
+            crc, compressed_size, size = read_data_descriptor(reader, is_zip64)
+
+        if data_crc != crc or data_size != size:
+            raise StreamingError(f"checksum or size of member {name} does not match")
+
+        if output != None:
+            members += 1
+
+
+def copy_member(reader, method, compressed_size, has_data_descriptor, output=None):
+    # writes the (decompressed) data of a member to output and returns its crc and size
+
+    crc = 0
+    size = 0
+    decompressor = zlib.decompressobj(-15) if method == zipfile.ZIP_DEFLATED else None
+    remaining = compressed_size
+
+    while (has_data_descriptor and not decompressor.eof) or (not has_data_descriptor and remaining > 0):
+
+        data = reader.read(chunk_size if has_data_descriptor else min(chunk_size, remaining))
+        if len(data) == 0:
+            raise StreamingError("unexpected end of archive")
+        remaining -= len(data)
+
+        if decompressor != None:
+            data = decompressor.decompress(data)
+            if decompressor.eof and len(decompressor.unused_data) > 0:
+                reader.unread(decompressor.unused_data)
+
+        crc = zlib.crc32(data, crc)
+        size += len(data)
+        if output != None:
+            output.write(data)
+
+    if decompressor != None:
+        data = decompressor.flush()
+        crc = zlib.crc32(data, crc)
+        size += len(data)
+        if output != None:
+            output.write(data)
+
+    return crc, size
+
+
+def get_zip64_sizes(extra):
+    # values of the zip64 extra field of a local header, None if there is no zip64 extra field
+    position = 0
+    while position + 4 <= len(extra):
+        header_id, data_size = struct.unpack("<HH", extra[position:position + 4])
+        if header_id == 0x0001:
+            data = extra[position + 4:position + 4 + data_size]
+            return [struct.unpack("<Q", data[i:i + 8])[0] for i in range(0, len(data) - 7, 8)]
+        position += 4 + data_size
+    return None
+
+
+def read_data_descriptor(reader, is_zip64):
+    # returns crc, compressed size and size of the data descriptor (the signature is optional)
+    data = reader.read_exactly(4)
+    if data == data_descriptor_signature:
+        data = reader.read_exactly(4)
+    crc = struct.unpack("<I", data)[0]
+    if is_zip64:
+        compressed_size, size = struct.unpack("<QQ", reader.read_exactly(16))
+    else:
+        compressed_size, size = struct.unpack("<II", reader.read_exactly(8))
+    return crc, compressed_size, size
@@ -1,7 +1,6 @@
 import numpy
 from PIL import Image, ImageDraw, ImageFont
 import math
-import matplotlib.pyplot as pyplot
 import os
 import stat
 import pathlib
@@ -15,31 +14,21 @@ from shapely.geometry import Point
 from shapely.geometry import Polygon
 from shapely.geometry import shape
 from shapely.ops import transform as shapely_transform
-from rtree import index
-import fiona
 from dateutil.parser import *
 from functools import partial
 import zipfile
 import tarfile
+import fnmatch
 from tqdm import tqdm
 import subprocess
 import sys
 from datetime import datetime
 from distutils.dir_util import copy_tree
-from skimage import transform
-from sklearn import preprocessing
-try:
-    import otbApplication
-except ImportError:
-    pass
-from tifffile import imsave
 
 
 import geocropper.config as config
 import geocropper.download as download
 from geocropper.database import Database
-import geocropper.sentinelWrapper as sentinelWrapper
-import geocropper.asfWrapper as asfWrapper
 
 import logging
 
@@ -409,6 +398,10 @@ def concat_images(image_path_list, output_file, gap=3, bcolor=(0, 0, 0), paths_t
 
     """
 
+    # heavy modules are only loaded when needed
+    import matplotlib.pyplot as pyplot
+    from skimage import transform
+
     # determine needed raster size
     if config.previewFormat == "1:1":
         raster_size_x = math.ceil(math.sqrt(len(image_path_list)))
@@ -1078,66 +1071,278 @@ def get_latlon_corner_coordinates(lat, lon, width, height):
               ])
 
 
+def get_product_type(tile):
+    # product type stored for the tile or derived from the folder name (e.g. S2A_MSIL2A_... => S2MSI2A)
+    if "productType" in tile.keys() and tile["productType"] != None:
+        return tile["productType"]
+    parts = tile["folderName"].split("_")
+    if tile["folderName"].startswith("S2") and len(parts) > 1 and parts[1].startswith("MSIL"):
+        return "S2MSI" + parts[1][4:]
+    if tile["folderName"].startswith("S1") and len(parts) > 2:
+        return parts[2][:3]
+    return None
+
+
+def get_unpack_patterns(tile):
+    """Returns the patterns of the archive members to extract for the tile or None for all members.
+
+    The patterns are configured per product type or platform in the section [Unpack Filter].
+    """
+    for key in [get_product_type(tile), tile["platform"]]:
+        if key != None and key.lower() in config.unpackFilter:
+            return config.unpackFilter[key.lower()]
+    return None
+
+
+def is_required_member(name, patterns):
+    if patterns == None:
+        return True
+    name = name.lower()
+    return any(fnmatch.fnmatchcase(name, pattern.lower()) for pattern in patterns)
+
+
+def is_extracted(path, size):
+    # member already extracted by a previous (maybe interrupted) unpack
+    return path.is_file() and path.stat().st_size == size
+
+
+def get_big_tile_path(tile):
+    """Returns the path of the product folder of the tile.
+
+    If the tile is kept packed (keepArchivesPacked), the path points into the archive
+    using the virtual file systems of GDAL (/vsizip/ and /vsitar/).
+    Virtual paths have to be accessed with list_dir, is_dir, find_files and path_exists.
+    """
+
+    folder = config.bigTilesDir / tile["folderName"]
+
+    if folder.is_dir() or not download.check_for_existing_packed_big_tile(tile):
+        return folder
+
+    archive = download.get_big_tile_archive_path(tile).resolve().as_posix()
+
+    # the curly brackets mark the end of the archive path (and keep the double slash of the prefix)
+    if tile["platform"].lower().startswith("sentinel"):
+        return pathlib.PurePosixPath("/vsizip/{" + archive + "}") / tile["folderName"]
+
+    # there is no root dir in tar packages of Landsat
+    return pathlib.PurePosixPath("/vsitar/{" + archive + "}")
+
+
+def is_virtual_path(path):
+    return str(path).startswith("/vsi")
+
+
+def list_dir(path):
+    if is_virtual_path(path):
+        return gdal.ReadDir(str(path)) or []
+    return os.listdir(path)
+
+
+def is_dir(path):
+    if is_virtual_path(path):
+        stat_result = gdal.VSIStatL(str(path))
+        return stat_result != None and stat.S_ISDIR(stat_result.mode)
+    return os.path.isdir(path)
+
+
+def path_exists(path):
+    if is_virtual_path(path):
+        return gdal.VSIStatL(str(path)) != None
+    return path.exists()
+
+
+def find_files(path, pattern, recursive=False):
+    # glob within a folder or an archive
+    if not is_virtual_path(path):
+        return sorted(path.rglob(pattern) if recursive else path.glob(pattern))
+    names = (gdal.ReadDirRecursive(str(path)) if recursive else gdal.ReadDir(str(path))) or []
+    return sorted(path / name.rstrip("/") for name in names if fnmatch.fnmatch(name.rstrip("/").split("/")[-1], pattern))
+
+
+def get_tile_for_archive(file_name):
+
+    # TODO: dirty... (is maybe first entry of zip_ref)
+    # get tile by folder name
+    if file_name.endswith(".zip"):
+        return db.get_tile(folder_name = file_name[:-4] + ".SAFE")
+
+    if file_name.endswith(".tar.gz"):
+        return db.get_tile(folder_name = file_name[:-7])
+
+
+def extract_big_tile(file_name, patterns=None, folder_name=None, progress=None):
+    """Extracts the required members of a big tile archive which are not yet extracted and removes the archive.
+
+    The database is not accessed, so the function can run in worker processes (see unpack_big_tiles_in_processes).
+    If progress is set, it gets called with the number of members to extract and the number of extracted members,
+    otherwise a progress bar is shown.
+    """
+
+    # get path of the packed file
+    file_path = config.bigTilesDir / file_name
+
+    # unpack zip file if zip
+    if file_name.endswith(".zip"):
+
+        # unzip
+        with zipfile.ZipFile(file=file_path) as zip_ref:
+
+            # only required members which are not yet extracted
+            members = [member for member in zip_ref.infolist() if is_required_member(member.filename, patterns) \
+                       and not is_extracted(config.bigTilesDir / member.filename, member.file_size)]
+
+            extract_members(zip_ref, members, config.bigTilesDir, progress)
+
+    # unpack tar file if tar
+    if file_name.endswith(".tar.gz"):
+
+        # create target directory, since there is no root dir in tar package
+        target_dir = config.bigTilesDir / (file_name[:-7] if folder_name == None else folder_name)
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+
+        # untar
+        with tarfile.open(name=file_path, mode="r:gz") as tar_ref:
+
+            # only required members which are not yet extracted
+            members = [member for member in tar_ref.getmembers() if is_required_member(member.name, patterns) \
+                       and not (member.isfile() and is_extracted(target_dir / member.name, member.size))]
+
+            extract_members(tar_ref, members, target_dir, progress)
+
+    # remove packed file
+    os.remove(file_path)
+
+
+def extract_members(archive, members, target_dir, progress=None):
+
+    if progress == None:
+        # show progress bar based on number of files in archive
+        members = tqdm(iterable=members, total=len(members))
+    else:
+        progress(len(members), 0)
+
+    for i, member in enumerate(members, 1):
+        archive.extract(member=member, path=target_dir)
+        if progress != None:
+            progress(len(members), i)
+
+
 def unpack_big_tile(file_name, tile=None):
 
     if file_name.endswith(".zip") or file_name.endswith(".tar.gz"):
-    
-        # get path of the packed file
-        file_path = config.bigTilesDir / file_name
 
-        # unpack zip file if zip
-        if file_name.endswith(".zip"):
+        if tile == None:
+            tile = get_tile_for_archive(file_name)
 
-            if tile == None:
+        print("Unpack file: " + file_name)
 
-                # TODO: dirty... (is maybe first entry of zip_ref)
-                # get tile by folder name
-                new_folder_name = file_name[:-4] + ".SAFE"
-                tile = db.get_tile(folder_name = new_folder_name)              
+        if tile == None:
+            logger.warning(f"Tile of archive {file_name} not found in database.")
+            extract_big_tile(file_name)
+            return
+
+        extract_big_tile(file_name, get_unpack_patterns(tile), tile["folderName"])
+
+        # set unpacked date in database
+        db.set_unpacked_for_tile(tile["rowid"])
 
-            # unzip
-            with zipfile.ZipFile(file=file_path) as zip_ref:
-                
-                # show progress bar based on number of files in archive
-                print("Unpack file: " + file_name)
-                for file in tqdm(iterable=zip_ref.namelist(), total=len(zip_ref.namelist())):
-                    zip_ref.extract(member=file, path=config.bigTilesDir)
 
-            zip_ref.close()
+class ProgressQueue:
+    # progress function of the worker processes, which sends the progress of an archive to the main process
 
+    def __init__(self, queue, file_name):
+        self.queue = queue
+        self.file_name = file_name
 
-        # unpack tar file if tar
-        if file_name.endswith(".tar.gz"):
+    def __call__(self, total, done):
+        self.queue.put((self.file_name, total, done))
 
+
+def unpack_big_tiles_in_processes(file_names, workers):
+    """Unpacks the archives with a pool of worker processes, one archive per process.
+
+    The workers only extract the archives, the database is updated by the main process.
+    The progress of all archives is shown in one progress bar (extracted members).
+    Returns the number of unpacked archives.
+    """
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+    tiles = {file_name: get_tile_for_archive(file_name) for file_name in file_names}
+    totals = {}
+    done = {}
+    counter = 0
+
+    def show_progress(queue, progress_bar):
+        while not queue.empty():
+            file_name, total, extracted = queue.get()
+            totals[file_name] = total
+            done[file_name] = extracted
+        progress_bar.total = sum(totals.values())
+        progress_bar.update(sum(done.values()) - progress_bar.n)
+
+    with multiprocessing.Manager() as manager, \
+         ProcessPoolExecutor(max_workers=workers) as executor, \
+         tqdm(total=0, desc=f"Unpacking {len(file_names)} archives", unit="files") as progress_bar:
+
+        queue = manager.Queue()
+
+        futures = {}
+        for file_name, tile in tiles.items():
             if tile == None:
+                logger.warning(f"Tile of archive {file_name} not found in database.")
+            patterns = get_unpack_patterns(tile) if tile != None else None
+            folder_name = tile["folderName"] if tile != None else None
+            futures[executor.submit(extract_big_tile, file_name, patterns, folder_name, 
+                                    ProgressQueue(queue, file_name))] = file_name
 
-                # get tile by folder name
-                tile = db.get_tile(folder_name = file_name[:-7])
+        pending = set(futures)
 
-            # create target directory, since there is no root dir in tar package
-            target_dir = config.bigTilesDir / tile["folderName"]
-            if not os.path.isdir(target_dir):
-                os.makedirs(target_dir)                    
+        while len(pending) > 0:
 
-            # untar
-            with tarfile.open(name=file_path, mode="r:gz") as tar_ref:
+            finished, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            show_progress(queue, progress_bar)
 
-                # show progress bar based on number of files in archive
-                print("Unpack file: " + file_name)
-                for file in tqdm(iterable=tar_ref.getmembers(), total=len(tar_ref.getmembers())):
-                    tar_ref.extract(member=file, path=target_dir)
+            for future in finished:
 
-            tar_ref.close()
+                file_name = futures[future]
 
+                if future.exception() != None:
+                    logger.error(f"Archive {file_name} could not be unpacked: {repr(future.exception())}")
+                    progress_bar.write(f"Archive {file_name} could not be unpacked: {repr(future.exception())}")
+                    continue
 
-        # remove packed file
-        os.remove(file_path)
+                counter += 1
 
-        # set unpacked date in database
-        db.set_unpacked_for_tile(tile["rowid"])
+                # set unpacked date in database
+                if tiles[file_name] != None:
+                    db.set_unpacked_for_tile(tiles[file_name]["rowid"])
+
+    return counter
 
 
 def crop_tiles(poi_id):
+    """Crops all downloaded tiles of a POI.
+
+    The crop states are collected and stored afterwards in one transaction.
+    """
+
+    cropped_tiles = []
+    cancelled_tiles = []
+
+    try:
+        crop_tiles_for_poi(poi_id, cropped_tiles, cancelled_tiles)
+    finally:
+        # store the states of the processed tiles even if cropping got interrupted
+        with db.transaction():
+            db.set_tiles_cropped(cropped_tiles)
+            db.set_cancelled_tiles_for_poi_list(cancelled_tiles)
+
+
+def crop_tiles_for_poi(poi_id, cropped_tiles, cancelled_tiles):
     
     print("\nCrop tiles:")
     print("-----------------")
@@ -1161,7 +1366,12 @@ def crop_tiles(poi_id):
 
                 print("Cropping %s ..." % tile["folderName"])
 
-                if download.check_for_existing_big_tile_folder(tile) == False:
+                # product folder or folder within the archive (keepArchivesPacked)
+                tile_dir = get_big_tile_path(tile)
+                is_packed = is_virtual_path(tile_dir)
+
+                if download.check_for_existing_big_tile_folder(tile) == False and \
+                   download.check_for_existing_packed_big_tile(tile) == False:
 
                     print("Big tile folder missing!")
                     print("Cropping not possible.")
@@ -1169,8 +1379,7 @@ def crop_tiles(poi_id):
                     if download.check_for_existing_big_tile_archive(tile) == False:
 
                         logger.warning("Big tile missing although marked as unzipped in database.")
-                        db.clear_download_complete_for_tile(tile['rowid'])
-                        db.clear_unpacked_for_tile(tile['rowid'])
+                        db.reset_tile_for_download(tile['rowid'])
                         print("Big tile archive missing!")
                         print("The internal database got updated (missing download).")
                         print("Please start the download process again.")
@@ -1223,10 +1432,14 @@ def crop_tiles(poi_id):
 
                         target_file = sensor_target_dir / "s1_cropped.tif"
 
-                        # preprocess and crop using SNAP GPT
+                        # preprocess and crop using SNAP GPT (SNAP reads the zip archives of Sentinel-1 directly)
+                        if is_packed:
+                            in_dir = download.get_big_tile_archive_path(tile)
+                        else:
+                            in_dir = tile_dir
                         poly = Polygon([[p.x, p.y] for p in corner_coordinates])
                         command = [str(config.gptSnap), os.path.realpath(str(config.xmlSnap)), 
-                                   ("-PinDir=" + os.path.realpath(str(config.bigTilesDir / tile["folderName"]))),
+                                   ("-PinDir=" + os.path.realpath(str(in_dir))),
                                    ("-Psubset=" + poly.wkt),
                                    ("-PoutFile=" + os.path.realpath(str(target_file))),
                                    ("-PmapProjection=" + projection)]
@@ -1240,21 +1453,20 @@ def crop_tiles(poi_id):
                             create_preview_rg_image(str(target_file), main_target_folder, exponential_scale=None)
 
                             # set date for tile cropped 
-                            db.set_tile_cropped(poi_id, tile["rowid"], main_target_folder)
+                            cropped_tiles.append((poi_id, tile["rowid"], main_target_folder))
 
                         else:
 
                             print("Sentinel-1 crop could not be created!")
 
                             # cancel crop
-                            db.set_cancelled_tile_for_poi(poi_id, tile["rowid"])
+                            cancelled_tiles.append((poi_id, tile["rowid"]))
 
 
-                        # copy or link metadata
-                        if config.copyMetadata:                            
+                        # copy or link metadata (metadata of packed tiles is not copied)
+                        if config.copyMetadata and not is_packed:                            
                             print("Copy metadata...")
                             meta_target_dir.mkdir(parents = True)
-                            tile_dir = config.bigTilesDir / tile["folderName"]
                             for item in tile_dir.rglob('*'):
                                 if item.is_file() and item.suffix.lower() != ".tiff" and item.suffix.lower() != ".safe":
                                     sensor_target_dir = meta_target_dir / item.parent.relative_to(tile_dir)
@@ -1264,7 +1476,8 @@ def crop_tiles(poi_id):
                             print("done.\n")    
 
                         if config.createSymlink:
-                            tile_dir = config.bigTilesDir / tile["folderName"]
+                            if is_packed:
+                                tile_dir = download.get_big_tile_archive_path(tile)
                             if not meta_target_dir.exists():
                                 # TODO: set config parameter for realpath or relpath for symlinks
                                 try:
@@ -1279,7 +1492,7 @@ def crop_tiles(poi_id):
 
                     else:
                         print("SNAP GPT not configured. Sentinel-1 tiles cannot be cropped.\n")
-                        db.set_cancelled_tile_for_poi(poi_id, tile["rowid"])  
+                        cancelled_tiles.append((poi_id, tile["rowid"]))  
 
 
                 # SENTINEL 2 CROPPING
@@ -1296,18 +1509,18 @@ def crop_tiles(poi_id):
 
                     is_s2l1 = True
 
-                    path_granule = config.bigTilesDir / tile["folderName"] / "GRANULE"
-                    for main_folder in os.listdir(path_granule):
+                    path_granule = tile_dir / "GRANULE"
+                    for main_folder in list_dir(path_granule):
 
                         path_image_data = path_granule / main_folder / "IMG_DATA"
-                        for image_data_item in os.listdir(path_image_data):
+                        for image_data_item in list_dir(path_image_data):
 
                             path_image_data_item = path_image_data / image_data_item
 
                             # if Level-1 data path_image_data_item is already an image file
                             # if Level-2 data path_image_data_item is a directory with image files
 
-                            if os.path.isdir(path_image_data_item):
+                            if is_dir(path_image_data_item):
 
                                 # Level-2 data
 
@@ -1315,7 +1528,7 @@ def crop_tiles(poi_id):
 
                                 target_sub_dir = sensor_target_dir / image_data_item
                             
-                                for item in os.listdir(path_image_data_item):
+                                for item in list_dir(path_image_data_item):
 
                                     # set path of img file
                                     path = path_image_data_item / item
@@ -1348,10 +1561,9 @@ def crop_tiles(poi_id):
 
                     print("done.\n")        
 
-                    if config.copyMetadata:                            
+                    if config.copyMetadata and not is_packed:                            
                         print("Copy metadata...")
                         meta_target_dir.mkdir(parents = True)
-                        tile_dir = config.bigTilesDir / tile["folderName"]
                         for item in tile_dir.rglob('*'):
                             if item.is_file() and item.suffix.lower() != ".jp2":
                                 sensor_target_dir = meta_target_dir / item.parent.relative_to(tile_dir)
@@ -1361,7 +1573,8 @@ def crop_tiles(poi_id):
                         print("done.\n")
 
                     if config.createSymlink:
-                        tile_dir = config.bigTilesDir / tile["folderName"]
+                        if is_packed:
+                            tile_dir = download.get_big_tile_archive_path(tile)
                         if not meta_target_dir.exists():
                             try:
                                 # TODO: set config parameter for realpath or relpath for symlinks
@@ -1375,7 +1588,7 @@ def crop_tiles(poi_id):
                                 print(f"Could not create symlink to meta dir due to permission error!\n{str(e)}\n")                                
 
                     # set date for tile cropped 
-                    db.set_tile_cropped(poi_id, tile["rowid"], main_target_folder)
+                    cropped_tiles.append((poi_id, tile["rowid"], main_target_folder))
 
 
                 # LANDSAT CROPPING
@@ -1383,7 +1596,7 @@ def crop_tiles(poi_id):
                 if poi["platform"].startswith("LANDSAT"):
                 
                     print("Cropping of Landsat data not yet supported.\n")
-                    db.set_cancelled_tile_for_poi(poi_id, tile["rowid"])
+                    cancelled_tiles.append((poi_id, tile["rowid"]))
 
                     # # Landsat img data are in GeoTiff-format
                     # # set appropriate format for GDAL lib
@@ -1544,14 +1757,14 @@ def save_tile_projection(product_id=None, tile=None):
 
     if tile != None and tile["downloadComplete"] != None:
 
-        main_folder = config.bigTilesDir / tile["folderName"]
+        main_folder = get_big_tile_path(tile)
         projection = None
 
         if tile["platform"] == "Sentinel-1":
 
             image_folder = main_folder / "measurement"
 
-            image = list(image_folder.glob("*.tiff"))[0]
+            image = find_files(image_folder, "*.tiff")[0]
 
             projection = get_projection_from_file(image, tile["platform"])
 
@@ -1559,7 +1772,7 @@ def save_tile_projection(product_id=None, tile=None):
 
             image_folder = main_folder / "GRANULE"
 
-            image = list(image_folder.rglob("*_B02*.jp2"))[0]
+            image = find_files(image_folder, "*_B02*.jp2", recursive=True)[0]
 
             projection = get_projection_from_file(image, tile["platform"])
 
@@ -1572,7 +1785,7 @@ def save_tile_projection(product_id=None, tile=None):
 
 def get_projection_from_file(path, platform):
 
-    if path != None and path.exists():
+    if path != None and path_exists(path):
 
         img = rasterio.open(str(path))
 
@@ -1652,15 +1865,19 @@ def retrieve_scene_classes(crops_path):
 
 
 def refresh_unzipped_big_tiles():
-    tiles = db.get_all_tiles()
-    for tile in tiles:
-        if download.check_for_existing_big_tile_folder(tile) == True:
-            db.set_unpacked_for_tile(tile['rowid'])
-        elif download.check_for_existing_big_tile_archive(tile) == True:
-            db.set_download_complete_for_tile(tile['rowid'])
-        else:
-            db.clear_download_complete_for_tile(tile['rowid'])
-            db.clear_unpacked_for_tile(tile['rowid'])
+    # all updates in one transaction, tiles are streamed in chunks
+    with db.transaction():
+        for tile in db.iterate_all_tiles():
+            if download.check_for_existing_big_tile_folder(tile) == True:
+                db.set_unpacked_for_tile(tile['rowid'])
+            elif download.check_for_existing_packed_big_tile(tile) == True:
+                # packed tiles are cropped directly from the archive
+                db.set_download_complete_for_tile(tile['rowid'])
+                db.set_unpacked_for_tile(tile['rowid'])
+            elif download.check_for_existing_big_tile_archive(tile) == True:
+                db.set_download_complete_for_tile(tile['rowid'])
+            else:
+                db.reset_tile_for_download(tile['rowid'])
 
 
 def copy_big_tiles(target_path, required_only=False):
@@ -1684,7 +1901,7 @@ def copy_big_tiles(target_path, required_only=False):
     if required_only:
         tiles = db.get_required_tiles()
     else:
-        tiles = db.get_all_tiles()
+        tiles = db.iterate_all_tiles()
 
     for tile in tiles:
         required_tiles.add(tile['folderName'])
@@ -1768,6 +1985,8 @@ def filter_and_move_crops(crops_path, output_path, lower_boundaries=None, upper_
         Assumes that crops and shape file are using UTM as CRS.
     """
 
+    import fiona
+
     try:
         output_path.mkdir(exist_ok=True, parents=True)
     except OSError as error:
@@ -2327,6 +2546,8 @@ def standardize_rasterio_image(rasterio_image, standardization_procedure="layerw
         "Robustscaler" = transforms the values by subtracting the median and then dividing by the interquartile range (75% value — 25% value)
     """
 
+    from sklearn import preprocessing
+
     image_array = rasterio_image.read()
     num_layers, num_pixel_y, num_pixel_x = image_array.shape
 
@@ -2425,7 +2646,9 @@ def reduce_image_dimensionality(image_dir, image_name, target_dir, crop, dim_red
         elif dim_reduction_method == "pca":
 
             # check if otbApplication is installed since this is required for the PCA
-            if "otbApplication" not in sys.modules:
+            try:
+                import otbApplication
+            except ImportError:
                 print("'pca' was chosen as dimensionality reduction method but otbApplication is not installed!")
                 print("Please, install otbApplication on your machine or use 'max_values' as dimensionality reduction method!")
                 return
@@ -2452,6 +2675,8 @@ def reduce_image_dimensionality(image_dir, image_name, target_dir, crop, dim_red
 
 def shift_images_reference_based(image_dict, target_dir, crop, target_pixel_size, reference_dir):
 
+    from tifffile import imsave
+
     try:
         lon, lat = crop.split("_")
         reference_crop = list(reference_dir.glob(f"*_{lon}*_{lat}*"))[0]
@@ -2521,6 +2746,8 @@ def shift_images_randomly(image_dict, target_dir, crop, target_pixel_size, shift
         1: Image is shifted up to 100%. Therefore, the initial center of the original image appears at the edge of the cropped image.
     """
 
+    from tifffile import imsave
+
     original_image_shape = image_dict[list(image_dict.keys())[0]].shape
 
     # Calculate the center point of the original image
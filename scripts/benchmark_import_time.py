@@ -0,0 +1,59 @@
+import os
+import sys
+import argparse
+import subprocess
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+os.chdir('../')
+
+# Measures the import time of the geocropper package with "python -X importtime"
+# and serves as regression guard for the package startup:
+# the script fails (exit code 1) if the import takes longer than the limit
+# or if one of the heavy modules below gets loaded at import.
+
+# modules which must only be imported inside the functions that need them
+lazy_modules = ["matplotlib", "sklearn", "skimage", "tifffile", "fiona", "rtree", "otbApplication",
+                "cv2", "sentinelsat", "landsatxplore"]
+
+parser = argparse.ArgumentParser(description="Measures the import time of the geocropper package.")
+parser.add_argument("--module", default="geocropper.geocropper", help="module to import")
+parser.add_argument("--max-seconds", type=float, default=3.0, help="max cumulative import time")
+parser.add_argument("--top", type=int, default=15, help="number of slowest imports to print")
+args = parser.parse_args()
+
+result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {args.module}"],
+                        cwd=os.getcwd(), stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+if result.returncode != 0:
+    print(result.stderr)
+    print(f"Import of {args.module} failed!")
+    sys.exit(1)
+
+# lines: "import time: self [us] | cumulative | imported package"
+imports = []
+for line in result.stderr.splitlines():
+    if not line.startswith("import time:") or "[us]" in line:
+        continue
+    _, cumulative, name = line[len("import time:"):].split("|")
+    imports.append((int(cumulative), name.rstrip()))
+
+total = max(cumulative for cumulative, name in imports) / 1000000
+loaded = sorted(set(name.strip().split(".")[0] for cumulative, name in imports) & set(lazy_modules))
+
+print(f"Slowest imports of {args.module}:")
+for cumulative, name in sorted(imports, reverse=True)[:args.top]:
+    print(f"{cumulative / 1000:10.1f} ms  {name}")
+
+print(f"\nimport time: {total:.2f} s (limit: {args.max_seconds:.2f} s)")
+
+failed = False
+
+if total > args.max_seconds:
+    print("Import time exceeds the limit!")
+    failed = True
+
+if len(loaded) > 0:
+    print(f"Heavy modules loaded at import: {', '.join(loaded)}")
+    failed = True
+
+sys.exit(1 if failed else 0)
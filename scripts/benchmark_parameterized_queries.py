@@ -0,0 +1,67 @@
+import os
+import sys
+import sqlite3
+import time
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+os.chdir('../')
+sys.path.append(os.getcwd())
+
+import geocropper.config as config
+import geocropper.database as database
+
+# Compares the per-call overhead of string-built INSERT statements (one SQL text per row)
+# with the prepared import_csv_row_query (one SQL text for all rows).
+# Both variants run in an in-memory database within one transaction,
+# so the numbers show statement preparation and execution without fsync.
+
+rows = 100000
+
+def create_connection():
+    connection = sqlite3.connect(":memory:")
+    columns = ", ".join(f"{name} {data_type}" for name, data_type in database.tables["CSVInput"].items())
+    connection.execute(f"CREATE TABLE CSVInput ({columns})")
+    return connection
+
+def csv_row(i):
+    return {"groupname": "benchmark", "lat": 48 + i / rows, "lon": 16 + i / rows, "dateFrom": "2020-06-01",
+            "dateTo": "2020-06-30", "platform": "Sentinel-2", "width": "2000", "height": "2000",
+            "description": f"row {i}", "cloudcoverpercentage": "10", "producttype": "S2MSI2A"}
+
+def insert_string_built(connection, file_name, row):
+    keys = "csvFileName, groupname, lat, lon, dateFrom, dateTo, platform"
+    values = "'%s', '%s', %s, %s, '%s', '%s', '%s'" % (file_name, row["groupname"], 
+        row["lat"], row["lon"], row["dateFrom"], row["dateTo"], row["platform"])
+    for key, value in row.items():
+        if key in config.optionalSentinelParameters or key in database.csv_optional_fields:
+            if len(str(value)) > 0:
+                keys = "%s, %s" % (keys, key)
+                if key in ["width", "height", "tileLimit", "tileStart"]:
+                    values = "%s, %s" % (values, value)
+                else:
+                    values = "%s, '%s'" % (values, value)
+    connection.execute("INSERT INTO CSVInput (%s, csvImported) VALUES (%s, datetime('now', 'localtime'))" % (keys, values))
+
+def insert_prepared(connection, file_name, row):
+    values = [file_name, row["groupname"], row["lat"], row["lon"], row["dateFrom"], row["dateTo"], row["platform"]]
+    for key in config.optionalSentinelParameters + database.csv_optional_fields:
+        value = row.get(key)
+        values.append(value if value != None and len(str(value)) > 0 else None)
+    connection.execute(database.import_csv_row_query, values)
+
+def run(name, insert):
+    connection = create_connection()
+    data = [csv_row(i) for i in range(rows)]
+    start = time.perf_counter()
+    with connection:
+        for row in data:
+            insert(connection, "benchmark.csv", row)
+    duration = time.perf_counter() - start
+    count = connection.execute("SELECT COUNT(*) FROM CSVInput").fetchone()[0]
+    connection.close()
+    print(f"{name}: {count} inserts in {duration:.2f} s ({duration / rows * 1000000:.1f} us per call)")
+    return duration
+
+before = run("string-built statements", insert_string_built)
+after = run("prepared statement     ", insert_prepared)
+print(f"speedup: {before / after:.1f}x")
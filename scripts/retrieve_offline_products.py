@@ -0,0 +1,11 @@
+import os
+import sys
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+os.chdir('../')
+sys.path.append(os.getcwd())
+
+from geocropper import *
+
+# checks the requested tiles every ltaPollMinutes for 24 hours
+geocropper.retrieve_offline_products(hours=24)